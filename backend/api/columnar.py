@@ -0,0 +1,342 @@
+"""
+Columnar binary exports. A report is written as a NumPy `.npz` archive (a zip of
+`.npy` arrays) with one string column per field:
+
+    discrepancies/key, discrepancies/field, discrepancies/source,
+    discrepancies/target          one entry per differing field
+    <section>/key                 one entry per record, for the record sections
+    <section>/columns/<column>    the record fields, for the record sections
+
+Columns are laid out like Arrow lays strings out, as two arrays: `<column>/data`,
+the UTF-8 bytes of every value one after the other (uint8), and
+`<column>/offsets`, where each value starts in them with the end of the last
+one (int64, one more than there are values). Value `i` is
+`data[offsets[i]:offsets[i + 1]]`, and a column takes as much room as its text
+does, however wide its widest value is.
+
+`numpy.load` reads it as it is. The arrays are stored uncompressed, so their
+bytes sit in the file as they sit in memory: they can be memory-mapped at their
+offset (`numpy.frombuffer(mmap, dtype, count, offset)`) instead of being read,
+which is what `NpzReport` does without numpy. Nulls are exported as empty
+strings, like the CSV export does.
+
+Neither numpy nor pyarrow is needed to write or read these files, the `.npy`
+format is simple enough to be written with the standard library.
+"""
+
+import ast
+import collections.abc
+import mmap
+import struct
+import zipfile
+
+from .keys import DEFAULT_KEY
+from .storage import SECTIONS
+
+NPY_MAGIC = b'\x93NUMPY'
+
+# numpy aligns the data of .npy files on this many bytes
+NPY_ALIGN = 64
+
+# How many values are encoded and written at a time
+BATCH_SIZE = 4096
+
+# The discrepancy columns, in the order they are written
+DISCREPANCY_COLUMNS = ('key', 'field', 'source', 'target')
+
+# The dtypes of the two arrays of a column
+OFFSETS_DTYPE = '<i8'
+DATA_DTYPE = '|u1'
+OFFSET_SIZE = 8
+
+
+def _text(value):
+    return '' if value is None else str(value)
+
+
+def _size(value):
+    return len(value.encode('utf-8', 'surrogatepass'))
+
+
+def _discrepancy_rows(discrepancies, key):
+    for discrepancy in discrepancies:
+        formatted = _text(key.format(discrepancy['id']))
+        for field, difference in discrepancy['differences'].items():
+            yield (
+                formatted,
+                _text(field),
+                _text(difference['source']),
+                _text(difference['target']),
+            )
+
+
+def _record_column(records, key, column):
+    if column is None:
+        key_function = key.function
+        return (_text(key.format(key_function(record))) for record in records)
+
+    return (_text(record.get(column)) for record in records)
+
+
+def _layout(results, key):
+    """
+    The columns of the archive as (name, length, size, values) tuples, `size`
+    being the UTF-8 length of all of its values and `values` a function that
+    iterates them again. Sizing the columns takes a first pass over the report.
+    """
+    arrays = []
+
+    for section in SECTIONS:
+        records = results.get(section, ())
+
+        if section == 'discrepancies':
+            sizes = [0] * len(DISCREPANCY_COLUMNS)
+            length = 0
+            for row in _discrepancy_rows(records, key):
+                length += 1
+                sizes = [size + _size(value) for size, value in zip(sizes, row)]
+
+            for index, (column, size) in enumerate(zip(DISCREPANCY_COLUMNS, sizes)):
+                arrays.append(
+                    (
+                        f'{section}/{column}',
+                        length,
+                        size,
+                        lambda records=records, index=index: (
+                            row[index] for row in _discrepancy_rows(records, key)
+                        ),
+                    )
+                )
+            continue
+
+        # The key, then every column any record has, in order of appearance
+        key_function = key.function
+        sizes = {None: 0}
+        length = 0
+        for record in records:
+            length += 1
+            sizes[None] += _size(_text(key.format(key_function(record))))
+            for column, value in record.items():
+                sizes[column] = sizes.get(column, 0) + _size(_text(value))
+
+        for column, size in sizes.items():
+            name = f'{section}/key' if column is None else f'{section}/columns/{column}'
+            arrays.append(
+                (
+                    name,
+                    length,
+                    size,
+                    lambda records=records, column=column: _record_column(
+                        records, key, column
+                    ),
+                )
+            )
+
+    return arrays
+
+
+def npy_header(descr, length):
+    """The header of a one dimensional `.npy` array, padded like numpy pads it."""
+    header = repr({'descr': descr, 'fortran_order': False, 'shape': (length,)})
+    # magic, version, header length, header, newline
+    size = len(NPY_MAGIC) + 2 + 2 + len(header) + 1
+    header += ' ' * (-size % NPY_ALIGN) + '\n'
+
+    return NPY_MAGIC + b'\x01\x00' + struct.pack('<H', len(header)) + header.encode()
+
+
+class _Buffer:
+    # A write-only file that hands out what was written to it, so the zip can be
+    # streamed out as it is written
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def generate_npz(results, fields=(), key=None):
+    """
+    Turn the results dictionary into a `.npz` archive of columns (see the module
+    docstring), yielded in pieces so it can be streamed out. Only a batch of
+    values is held at a time, the report is read once to size the columns and
+    twice per column to write its offsets and its data. Records are keyed with
+    `key`, the `api.keys.KeySpec` they were matched on; `fields` is accepted for
+    symmetry with `generate_csv`, the columns are taken from the records.
+    """
+    key = key or DEFAULT_KEY
+    buffer = _Buffer()
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED, allowZip64=True) as bundle:
+        for name, length, size, values in _layout(results, key):
+            with _member(
+                bundle, f'{name}/offsets', OFFSETS_DTYPE, length + 1, OFFSET_SIZE
+            ) as offsets:
+                position = 0
+                batch = [position]
+                for value in values():
+                    position += _size(value)
+                    batch.append(position)
+                    if len(batch) == BATCH_SIZE:
+                        offsets.write(struct.pack(f'<{len(batch)}q', *batch))
+                        batch.clear()
+                        yield buffer.drain()
+                offsets.write(struct.pack(f'<{len(batch)}q', *batch))
+            yield buffer.drain()
+
+            with _member(bundle, f'{name}/data', DATA_DTYPE, size, 1) as data:
+                batch = []
+                for value in values():
+                    batch.append(value)
+                    if len(batch) == BATCH_SIZE:
+                        data.write(''.join(batch).encode('utf-8', 'surrogatepass'))
+                        batch.clear()
+                        yield buffer.drain()
+                data.write(''.join(batch).encode('utf-8', 'surrogatepass'))
+            yield buffer.drain()
+
+    yield buffer.drain()
+
+
+def _member(bundle, name, descr, length, itemsize):
+    # Open an array of the archive for writing, its .npy header written
+    header = npy_header(descr, length)
+    info = zipfile.ZipInfo(f'{name}.npy')
+    info.compress_type = zipfile.ZIP_STORED
+    info.file_size = len(header) + length * itemsize
+    force_zip64 = info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    member = bundle.open(info, 'w', force_zip64=force_zip64)
+    member.write(header)
+
+    return member
+
+
+class NpzColumn(collections.abc.Sequence):
+    """
+    A string column of a memory-mapped `.npz` archive. Values are decoded from
+    the mapping when they are indexed, nothing is read up front. `offsets` and
+    `offset` locate its offsets and data arrays in the file, for numpy.
+    """
+
+    def __init__(self, mapping, offsets, offset, length):
+        self._map = mapping
+        self.offsets = offsets
+        self.offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def _decode(self, start, stop):
+        offsets = struct.unpack_from(
+            f'<{stop - start + 1}q', self._map, self.offsets + start * OFFSET_SIZE
+        )
+
+        return [
+            self._map[self.offset + first : self.offset + last].decode(
+                'utf-8', 'surrogatepass'
+            )
+            for first, last in zip(offsets, offsets[1:])
+        ]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self._decode(start, max(start, stop))
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('column index out of range')
+
+        return self._decode(index, index + 1)[0]
+
+
+class NpzReport(collections.abc.Mapping):
+    """
+    A `.npz` export opened by memory-mapping it: column names map to
+    `NpzColumn`s. Opening only reads the zip directory and the `.npy` headers,
+    so it takes the same time for any size of report.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            with zipfile.ZipFile(self._file) as bundle:
+                members = bundle.infolist()
+            arrays = {
+                info.filename.removesuffix('.npy'): self._array(info)
+                for info in members
+            }
+            self._columns = {}
+            for name, (descr, offset, length) in arrays.items():
+                if not name.endswith('/data'):
+                    continue
+                name = name.removesuffix('/data')
+                offsets_descr, offsets, offsets_length = arrays[f'{name}/offsets']
+                if (descr, offsets_descr) != (DATA_DTYPE, OFFSETS_DTYPE):
+                    raise ValueError(f'{name} is not a string column.')
+                self._columns[name] = NpzColumn(
+                    self._map, offsets, offset, offsets_length - 1
+                )
+        except BaseException:
+            self.close()
+            raise
+
+    def _array(self, info):
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f'{info.filename} is compressed, it cannot be mapped.')
+
+        # The data follows the local file header, its name and extra field
+        name_length, extra_length = struct.unpack_from(
+            '<HH', self._map, info.header_offset + 26
+        )
+        start = info.header_offset + 30 + name_length + extra_length
+
+        if self._map[start : start + len(NPY_MAGIC)] != NPY_MAGIC:
+            raise ValueError(f'{info.filename} is not a .npy array.')
+        major = self._map[start + len(NPY_MAGIC)]
+        prefix, size_format = (10, '<H') if major == 1 else (12, '<I')
+        (header_length,) = struct.unpack_from(
+            size_format, self._map, start + len(NPY_MAGIC) + 2
+        )
+        header = ast.literal_eval(
+            self._map[start + prefix : start + prefix + header_length].decode('latin1')
+        )
+        if header['fortran_order']:
+            raise ValueError(f'{info.filename} is not a one dimensional array.')
+        (length,) = header['shape']
+
+        return header['descr'], start + prefix + header_length, length
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def close(self):
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,121 @@
+"""
+Compressed uploads. Ledgers are often kept compressed, so uploads are sniffed for
+the magic bytes of gzip, bzip2, xz, zstd and zip and read through a decompressor
+that inflates them as they are read: nothing is ever inflated in full, in memory
+or on disk. zstd needs the optional `zstandard` package, zip bundles must hold a
+single CSV.
+"""
+
+import bz2
+import gzip
+import lzma
+import zipfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+# Format -> the bytes its files start with
+MAGIC_BYTES = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'xz': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'zip': b'PK\x03\x04',
+}
+
+# What a corrupt or truncated compressed upload raises while it is read
+DECOMPRESSION_ERRORS = (
+    EOFError,
+    OSError,
+    zlib.error,
+    lzma.LZMAError,
+    zipfile.BadZipFile,
+    *((zstandard.ZstdError,) if zstandard is not None else ()),
+)
+
+
+class CompressionError(ValueError):
+    """A compressed upload that cannot be read."""
+
+
+def detect_compression(file_obj):
+    """
+    The compression format of a file from its first bytes, or None. The file
+    is left where it was.
+    """
+    position = file_obj.tell()
+    head = file_obj.read(max(map(len, MAGIC_BYTES.values())))
+    file_obj.seek(position)
+
+    for compression, magic in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return compression
+
+    return None
+
+
+def _open_zip_member(file_obj):
+    try:
+        bundle = zipfile.ZipFile(file_obj)
+    except zipfile.BadZipFile as e:
+        raise CompressionError(f'Could not read the zip upload: {e}') from None
+
+    members = [info for info in bundle.infolist() if not info.is_dir()]
+    if len(members) > 1:
+        members = [info for info in members if info.filename.lower().endswith('.csv')]
+    if len(members) != 1:
+        raise CompressionError(
+            f'A zip upload must hold a single CSV file, not {len(members)}.'
+        )
+
+    return bundle.open(members[0])
+
+
+def open_decompressed(file_obj):
+    """
+    `file_obj` as it is, or a file that decompresses it as it is read if it is
+    compressed (see `MAGIC_BYTES`). Decompressing reads fail with
+    `CompressionError` when the upload is corrupt or truncated.
+    """
+    compression = detect_compression(file_obj)
+    if compression is None:
+        return file_obj
+
+    if compression == 'gzip':
+        # Handles concatenated members, like `cat a.gz b.gz` produces
+        decompressed = gzip.GzipFile(fileobj=file_obj, mode='rb')
+    elif compression == 'bz2':
+        decompressed = bz2.BZ2File(file_obj)
+    elif compression == 'xz':
+        decompressed = lzma.LZMAFile(file_obj)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise CompressionError('zstd uploads need the zstandard package.')
+        decompressed = zstandard.ZstdDecompressor().stream_reader(
+            file_obj, read_across_frames=True
+        )
+    else:
+        decompressed = _open_zip_member(file_obj)
+
+    return _Decompressed(decompressed, compression)
+
+
+class _Decompressed:
+    # Passes reads through, turning decompression errors into CompressionError
+    def __init__(self, decompressed, compression):
+        self.decompressed = decompressed
+        self.compression = compression
+
+    def read(self, size=-1):
+        try:
+            return self.decompressed.read(size)
+        except DECOMPRESSION_ERRORS as e:
+            raise CompressionError(
+                f'Could not decompress the {self.compression} upload: {e}'
+            ) from None
+
+    def close(self):
+        self.decompressed.close()
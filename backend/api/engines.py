@@ -0,0 +1,340 @@
+"""
+Reconciliation engines. Every engine takes two iterables of normalized records,
+a `key` function and optionally `compare`, a dict of field -> `differs(source,
+target)` functions for the fields not compared by plain equality (see
+`api.matching.CompareSpec`), and returns `(fields, missing_in_target, missing_in_source,
+discrepancies, duplicates_in_source, duplicates_in_target)`. When a side holds
+several records with the same key, the last one is matched and the others are
+reported as duplicates. `reconcile_data` picks an engine and stores the report.
+"""
+
+import heapq
+import itertools
+import operator
+import os
+import pickle
+import tempfile
+
+# How many records the external sort keeps in memory before spilling a sorted run
+SORT_RUN_SIZE = 100_000
+
+
+def compare_records(s_record, t_record, fields, compare=None):
+    """
+    Compare two records field by field, adding every field seen to `fields`, and
+    return the differences as {field: {'source': ..., 'target': ...}}. Fields in
+    `compare` are compared with their own `differs` function. Identical records
+    are not compared field by field.
+    """
+    # Nearly every matched pair is identical, and whole records compare in C
+    # (mostly by identity, the normalization cache shares values between records)
+    if s_record == t_record:
+        fields.update(s_record)
+        return {}
+
+    compare = compare or {}
+    record_diffs = {}
+    all_fields = set(s_record.keys()).union(set(t_record.keys()))
+    for field in all_fields:
+        fields.add(field)
+        s_val = s_record.get(field)
+        t_val = t_record.get(field)
+        if s_val != t_val and (field not in compare or compare[field](s_val, t_val)):
+            record_diffs[field] = {'source': s_val, 'target': t_val}
+
+    return record_diffs
+
+
+def index_records(records, key):
+    """
+    Index records by key, the last record of a key wins. Returns the index and
+    the records it shadowed, in input order.
+    """
+    records = list(records)
+    keys = list(map(key, records))
+    index = dict(zip(keys, records))
+    if len(index) == len(records):
+        return index, []
+
+    # Only inputs with duplicates pay for finding which records were shadowed
+    last = dict(zip(keys, range(len(keys))))
+    return index, [
+        record
+        for position, (k, record) in enumerate(zip(keys, records))
+        if last[k] != position
+    ]
+
+
+def hash_engine(source_data, target_data, key, compare=None):
+    """
+    Index both sides in dictionaries and compare matching records field by field.
+    """
+    # Build dictionaries keyed by some unique ID or combination
+    source_dict, duplicates_in_source = index_records(source_data, key)
+    target_dict, duplicates_in_target = index_records(target_data, key)
+
+    # Key views, not copies: only the (small) differences become sets
+    source_keys = source_dict.keys()
+    target_keys = target_dict.keys()
+
+    # Missing in target => in source but not in target
+    missing_in_target = []
+    for k in source_keys - target_keys:
+        missing_in_target.append(source_dict[k])
+
+    # Missing in source => in target but not in source
+    missing_in_source = []
+    for k in target_keys - source_keys:
+        missing_in_source.append(target_dict[k])
+
+    # Discrepancies => records that exist in both but differ in at least one field
+    discrepancies = []
+    fields = set()
+    for k, s_record in source_dict.items():
+        if k not in target_dict:
+            continue
+        # Compare field by field
+        record_diffs = compare_records(s_record, target_dict[k], fields, compare)
+        if record_diffs:
+            discrepancies.append({'id': k, 'differences': record_diffs})
+
+    return (
+        fields,
+        missing_in_target,
+        missing_in_source,
+        discrepancies,
+        duplicates_in_source,
+        duplicates_in_target,
+    )
+
+
+def columnar_engine(source_data, target_data, key, compare=None):
+    """
+    Hash join both sides on the key, then lay the matched records out as column
+    arrays and compare a whole column at a time. All the per-row work happens in
+    `map`/`compress` over the columns, so there is no Python-level loop per field
+    per row, and the diff only touches the rows whose mask is set.
+    """
+    source_index, duplicates_in_source = index_records(source_data, key)
+    target_index, duplicates_in_target = index_records(target_data, key)
+
+    missing_in_target = list(
+        map(
+            source_index.__getitem__,
+            itertools.filterfalse(target_index.__contains__, source_index),
+        )
+    )
+    missing_in_source = list(
+        map(
+            target_index.__getitem__,
+            itertools.filterfalse(source_index.__contains__, target_index),
+        )
+    )
+
+    # Align the matched records: row i of both sides belongs to matched_keys[i]
+    matched_keys = list(filter(target_index.__contains__, source_index))
+    source_rows = list(map(source_index.__getitem__, matched_keys))
+    target_rows = list(map(target_index.__getitem__, matched_keys))
+    del source_index, target_index
+
+    # Iterating a record yields its field names
+    fields = set(
+        itertools.chain.from_iterable(itertools.chain(source_rows, target_rows))
+    )
+
+    # Whole records compare in C, so narrow the column arrays down to the rows
+    # that differ somewhere before diffing column by column
+    changed = list(
+        itertools.compress(
+            range(len(matched_keys)), map(operator.ne, source_rows, target_rows)
+        )
+    )
+    source_rows = list(map(source_rows.__getitem__, changed))
+    target_rows = list(map(target_rows.__getitem__, changed))
+
+    compare = compare or {}
+    differences = [{} for _ in changed]
+    for field in fields:
+        column = operator.methodcaller('get', field)
+        source_column = list(map(column, source_rows))
+        target_column = list(map(column, target_rows))
+        mask = map(compare.get(field, operator.ne), source_column, target_column)
+
+        for i in itertools.compress(range(len(changed)), mask):
+            differences[i][field] = {
+                'source': source_column[i],
+                'target': target_column[i],
+            }
+
+    discrepancies = [
+        {'id': matched_keys[row], 'differences': record_diffs}
+        for row, record_diffs in zip(changed, differences)
+        # Records can differ only by a missing vs None field, which is not a diff
+        if record_diffs
+    ]
+
+    return (
+        fields,
+        missing_in_target,
+        missing_in_source,
+        discrepancies,
+        duplicates_in_source,
+        duplicates_in_target,
+    )
+
+
+def _key_part_order(value):
+    # Ledgers numbered 1, 2, ... 10 are sorted by value, not as text: digit-only
+    # values sort by their value (their length without leading zeros, then their
+    # digits), before any other value, which sorts as text. The value itself
+    # breaks ties between zero-padded values, so only equal keys order the same
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        digits = value.lstrip('0')
+        return (0, len(digits), digits, value)
+
+    return (1, value)
+
+
+def _order(key):
+    # Records without a key sort first, so None is never compared with a string
+    if key is None:
+        return (False,)
+    if isinstance(key, tuple):
+        return (True, tuple(map(_key_part_order, key)))
+
+    return (True, _key_part_order(key))
+
+
+def _is_sorted(records, key):
+    previous = None
+    for record in records:
+        current = _order(key(record))
+        if previous is not None and current < previous:
+            return False
+        previous = current
+
+    return True
+
+
+def _spill(run, directory):
+    fd, path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+        for record in run:
+            pickler.dump(record)
+
+    return path
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        unpickler = pickle.Unpickler(f)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+
+def external_sort(records, key, directory, run_size=None):
+    """
+    Sort records by key using at most `run_size` records of memory: sorted runs are
+    spilled to `directory` and lazily merged back. Input that fits in a single run
+    is sorted in memory. The sort is stable, so duplicates keep their input order.
+    """
+    run_size = run_size or SORT_RUN_SIZE
+    records = iter(records)
+
+    def order(record):
+        return _order(key(record))
+
+    runs = []
+    while run := list(itertools.islice(records, run_size)):
+        run.sort(key=order)
+        if not runs and len(run) < run_size:
+            return iter(run)
+        runs.append(_spill(run, directory))
+
+    return heapq.merge(*map(_read_run, runs), key=order)
+
+
+def _in_key_order(records, key, directory):
+    # Re-iterable inputs (lists, re-readable uploads) get a cheap O(1) memory pass
+    # to check whether they are already sorted, anything else is sorted externally
+    if iter(records) is not records and _is_sorted(records, key):
+        return iter(records)
+
+    return external_sort(records, key, directory)
+
+
+def _last_per_key(records, key, duplicates):
+    # Like the dictionaries of the other engines, the last duplicate wins and the
+    # others are reported
+    for k, group in itertools.groupby(records, key):
+        record = next(group)
+        for later in group:
+            duplicates.append(record)
+            record = later
+        yield _order(k), k, record
+
+
+def sort_merge_engine(source_data, target_data, key, compare=None):
+    """
+    Walk both sides in key order at the same time, like the merge step of a merge
+    sort. Pre-sorted inputs (numeric keys sorted by value, other keys as text) are
+    reconciled with O(1) extra memory, unsorted inputs go through an on-disk
+    external sort first, so files larger than RAM work too.
+    """
+    missing_in_target = []
+    missing_in_source = []
+    discrepancies = []
+    duplicates_in_source = []
+    duplicates_in_target = []
+    fields = set()
+
+    with tempfile.TemporaryDirectory(prefix='reconciliation-') as directory:
+        source = _last_per_key(
+            _in_key_order(source_data, key, directory), key, duplicates_in_source
+        )
+        target = _last_per_key(
+            _in_key_order(target_data, key, directory), key, duplicates_in_target
+        )
+
+        s = next(source, None)
+        t = next(target, None)
+        while s is not None and t is not None:
+            if s[0] < t[0]:
+                missing_in_target.append(s[2])
+                s = next(source, None)
+            elif s[0] > t[0]:
+                missing_in_source.append(t[2])
+                t = next(target, None)
+            else:
+                record_diffs = compare_records(s[2], t[2], fields, compare)
+                if record_diffs:
+                    discrepancies.append({'id': s[1], 'differences': record_diffs})
+                s = next(source, None)
+                t = next(target, None)
+
+        if s is not None:
+            missing_in_target.append(s[2])
+            missing_in_target.extend(record for _, _, record in source)
+        if t is not None:
+            missing_in_source.append(t[2])
+            missing_in_source.extend(record for _, _, record in target)
+
+    return (
+        fields,
+        missing_in_target,
+        missing_in_source,
+        discrepancies,
+        duplicates_in_source,
+        duplicates_in_target,
+    )
+
+
+ENGINES = {
+    'hash': hash_engine,
+    'columnar': columnar_engine,
+    'sort_merge': sort_merge_engine,
+}
@@ -0,0 +1,615 @@
+"""
+Incremental reconciliation. A run can keep a snapshot of its ledgers: for every
+key of both sides, a blake2b fingerprint of the raw row and the normalized
+record. A later run that references that report only normalizes and compares
+the keys that were added, changed or removed since, carries everything else over
+from the previous report, and records what changed between the two reports.
+
+Uploads are either the full ledgers (every row is fingerprinted, keys missing
+from the upload are removed) or, with `delta`, only the changed rows, where a
+truthy `_deleted` column removes a key. Either way normalizing, comparing and
+storing records costs as much as the churn: upload rows are checked against the
+snapshot a batch at a time, and new reports are stored on top of the first
+report of their chain (see `api.storage.LayeredSection`), dropping the entries
+of the touched keys, which the snapshot indexes by key. Once what a report
+drops and adds outgrows that first report, it is stored in full instead and
+becomes the base of the reports built on it.
+
+Snapshots are SQLite files in `settings.SNAPSHOTS_ROOT` named after their report.
+A snapshot moves on to the report built on top of it, so a chain of runs keeps a
+single snapshot and every run references the latest report of its chain.
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+import operator
+import os
+import sqlite3
+import uuid
+
+from django.conf import settings
+
+from .engines import compare_records
+from .instrumentation import Instrumentation
+from .keys import DEFAULT_KEY, KeySpec, format_key
+from .matching import CompareSpec
+from .reconciliation_engine import (
+    SAMPLE_SIZE,
+    RecordNormalizer,
+    build_partition_key,
+    iter_csv,
+    store_report,
+)
+from .records import as_dict
+from .storage import SECTIONS, LayeredSection, field_histogram, get_report_store
+
+# The column of delta uploads marking rows whose key was removed
+DELETED_COLUMN = '_deleted'
+DELETED_VALUES = frozenset({'1', 'true', 'yes', 'y', 't'})
+
+SIDES = ('source', 'target')
+
+# Snapshot keys are strings: composite keys are formatted like everywhere else
+# (see `api.keys.format_key`) and records without a key get their own value
+NO_KEY = '\x00'
+
+# Snapshot rows are read and written in batches of this size
+BATCH_SIZE = 5000
+
+
+class SnapshotError(ValueError):
+    """An incremental run references a report it cannot build on."""
+
+
+def fingerprinter(columns):
+    """
+    Return a function giving a 16 byte blake2b digest of a raw row of a file with
+    the given columns. The digest does not depend on the order of the columns,
+    which is only worked out once per file.
+    """
+    columns = sorted(columns)
+    values = operator.itemgetter(*columns) if columns else lambda row: ()
+    header = hashlib.blake2b(repr(columns).encode(), digest_size=16)
+
+    def fingerprint(row):
+        digest = header.copy()
+        digest.update(repr(values(row)).encode('utf-8', 'surrogatepass'))
+        return digest.digest()
+
+    return fingerprint
+
+
+def _encode(key):
+    return NO_KEY if key is None else format_key(key)
+
+
+class Snapshot:
+    """
+    The fingerprints and normalized records of both sides of a report, the
+    positions of the entries of the report its chain is stored on, by key, and
+    the `api.matching.CompareSpec` its discrepancies were found with.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rows (
+                side INTEGER, key TEXT, fingerprint BLOB, record TEXT,
+                PRIMARY KEY (side, key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS entries (
+                section INTEGER, key TEXT, position INTEGER,
+                PRIMARY KEY (section, key, position)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TEMP TABLE seen (key TEXT PRIMARY KEY) WITHOUT ROWID;
+            """
+        )
+
+    @property
+    def compare(self):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE name = 'compare'"
+        ).fetchone()
+
+        return '' if row is None else row[0]
+
+    @compare.setter
+    def compare(self, compare):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('compare', ?)",
+            (str(compare),),
+        )
+
+    @staticmethod
+    def path_for(report_id):
+        return os.path.join(settings.SNAPSHOTS_ROOT, f'{report_id}.sqlite3')
+
+    def count(self, side):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM rows WHERE side = ?', (SIDES.index(side),)
+        ).fetchone()[0]
+
+    def _select(self, column, side, keys):
+        keys = iter(keys)
+        while batch := list(itertools.islice(keys, BATCH_SIZE)):
+            yield from self.connection.execute(
+                f'SELECT key, {column} FROM rows WHERE side = ? AND key IN '
+                f'({",".join("?" * len(batch))})',
+                (SIDES.index(side), *batch),
+            )
+
+    def fingerprints(self, side, keys):
+        """{key: fingerprint} of the given keys of `side` that exist."""
+        return dict(self._select('fingerprint', side, keys))
+
+    def records(self, side, keys):
+        """{key: normalized record} of the given keys of `side` that exist."""
+        return {
+            key: json.loads(record)
+            for key, record in self._select('record', side, keys)
+        }
+
+    def forget_seen(self):
+        """Start over the keys marked with `see`, for the next upload."""
+        self.connection.execute('DELETE FROM seen')
+
+    def see(self, keys):
+        """Mark keys of the upload being read, returning those marked already."""
+        keys = set(keys)
+        seen = set()
+        batches = iter(keys)
+        while batch := list(itertools.islice(batches, BATCH_SIZE)):
+            seen.update(
+                key
+                for (key,) in self.connection.execute(
+                    f'SELECT key FROM seen WHERE key IN ({",".join("?" * len(batch))})',
+                    batch,
+                )
+            )
+        self.connection.executemany(
+            'INSERT INTO seen (key) VALUES (?)', ((key,) for key in keys - seen)
+        )
+
+        return seen
+
+    def unseen(self, side):
+        """The keys of `side` that were not marked with `see`."""
+        return (
+            key
+            for (key,) in self.connection.execute(
+                'SELECT key FROM rows WHERE side = ? AND key NOT IN (SELECT key FROM '
+                'seen)',
+                (SIDES.index(side),),
+            )
+        )
+
+    def index(self, sections, key):
+        """Index the entries of `sections`, those of a new base report, by key."""
+        self.connection.execute('DELETE FROM entries')
+        self.connection.executemany(
+            'INSERT INTO entries (section, key, position) VALUES (?, ?, ?)',
+            (
+                (number, key.entry_key(section, entry, NO_KEY), position)
+                for number, (section, entries) in enumerate(sections.items())
+                for position, entry in enumerate(entries)
+            ),
+        )
+
+    def positions(self, section, keys):
+        """The positions of the entries of the base report with the given keys."""
+        number = SECTIONS.index(section)
+        keys = iter(keys)
+        positions = set()
+        while batch := list(itertools.islice(keys, BATCH_SIZE)):
+            positions.update(
+                position
+                for (position,) in self.connection.execute(
+                    'SELECT position FROM entries WHERE section = ? AND key IN '
+                    f'({",".join("?" * len(batch))})',
+                    (number, *batch),
+                )
+            )
+
+        return positions
+
+    def update(self, side, changes):
+        """Apply {key: (fingerprint, record) or None when removed} to `side`."""
+        number = SIDES.index(side)
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO rows (side, key, fingerprint, record) '
+            'VALUES (?, ?, ?, ?)',
+            (
+                (number, key, change[0], json.dumps(change[1]))
+                for key, change in changes.items()
+                if change is not None
+            ),
+        )
+        self.connection.executemany(
+            'DELETE FROM rows WHERE side = ? AND key = ?',
+            ((number, key) for key, change in changes.items() if change is None),
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def _scan(file_obj, side, snapshot, key, delta, cache, progress, instrumentation):
+    """
+    Fingerprint the rows of one upload against the snapshot. Returns the changed
+    keys as {key: (fingerprint, normalized record) or None when removed}, the
+    records shadowed by a later row with the same key, and the key counts. Only
+    the changed rows are normalized.
+    """
+    file_obj.seek(0)
+    reader = iter_csv(file_obj)
+    rows = instrumentation.iterate('parse', reader)
+    if progress is not None:
+        rows = progress.track(rows, f'{side}_rows')
+
+    # The normalizer is compiled from the same sample a full run would use
+    sample = list(itertools.islice(rows, SAMPLE_SIZE))
+    normalizer = RecordNormalizer.from_sample(
+        sample, fieldnames=reader.fieldnames, cache=cache
+    )
+
+    fingerprint = fingerprinter(
+        column for column in reader.fieldnames or () if column != DELETED_COLUMN
+    )
+    total = snapshot.count(side)
+    snapshot.forget_seen()
+    # Changed rows are kept raw and normalized together once the upload is read
+    changes = {}
+    # The changed keys the snapshot holds
+    existing = set()
+    duplicates = []
+    with instrumentation.phase('fingerprint'):
+        rows = itertools.chain(sample, rows)
+        # Rows are looked up against the snapshot a batch at a time, so that only
+        # the changes are held rather than every key of the ledgers
+        while batch := list(itertools.islice(rows, BATCH_SIZE)):
+            keyed = []
+            for row in batch:
+                deleted = False
+                if delta:
+                    flag = row.pop(DELETED_COLUMN, None)
+                    deleted = (flag or '').strip().lower() in DELETED_VALUES
+                keyed.append((_encode(build_partition_key(row, key)), deleted, row))
+            keys = {k for k, _, _ in keyed}
+            known = snapshot.fingerprints(side, keys)
+            seen = snapshot.see(keys)
+
+            for k, deleted, row in keyed:
+                if k in seen:
+                    # Like in the engines, the last row of a key wins
+                    if k in changes:
+                        if changes[k] is not None:
+                            duplicates.append((True, changes[k][1]))
+                    else:
+                        duplicates.extend(
+                            (False, record)
+                            for record in snapshot.records(side, [k]).values()
+                        )
+                seen.add(k)
+
+                if deleted:
+                    if k in known:
+                        changes[k] = None
+                        existing.add(k)
+                    else:
+                        changes.pop(k, None)
+                    continue
+
+                digest = fingerprint(row)
+                if known.get(k) == digest:
+                    changes.pop(k, None)
+                else:
+                    changes[k] = (digest, row)
+                    if k in known:
+                        existing.add(k)
+
+        if not delta:
+            for k in snapshot.unseen(side):
+                changes[k] = None
+                existing.add(k)
+
+    with instrumentation.phase('normalize') as stats:
+        for k, change in changes.items():
+            if change is not None:
+                changes[k] = (change[0], as_dict(normalizer(change[1])))
+                stats.rows += 1
+        # Shadowed rows read from the snapshot are normalized already
+        duplicates = [
+            as_dict(normalizer(record)) if raw else record for raw, record in duplicates
+        ]
+
+    removed = sum(1 for change in changes.values() if change is None)
+    changed = sum(
+        1 for k, change in changes.items() if change is not None and k in existing
+    )
+    counts = {
+        'added': len(changes) - removed - changed,
+        'changed': changed,
+        'removed': removed,
+        'unchanged': total - changed - removed,
+    }
+
+    return changes, duplicates, counts
+
+
+def _layer(store, previous_report, snapshot, touched, recomputed, key, delta):
+    """
+    Work out what the previous report holds for the `touched` keys, and the layer
+    of the new report on top of the base report of the chain, as {'report',
+    'dropped', 'own'}. A full upload holds every duplicate, so those sections are
+    replaced.
+    """
+    layer = previous_report.base or {'report': previous_report.id, 'dropped': {}}
+    base_counts = store.summary(layer['report']).counts
+
+    before = {}
+    dropped = {}
+    own = {}
+    for section in SECTIONS:
+        layered = getattr(previous_report, section)
+        previous_own = layered.own if isinstance(layered, LayeredSection) else ()
+        previously_dropped = set(layer['dropped'].get(section, ()))
+        if section.startswith('duplicates') and not delta:
+            positions = set(range(base_counts[section]))
+            kept, replaced = [], list(previous_own)
+        else:
+            positions = snapshot.positions(section, touched)
+            kept, replaced = [], []
+            for entry in previous_own:
+                if key.entry_key(section, entry, NO_KEY) in touched:
+                    replaced.append(entry)
+                else:
+                    kept.append(entry)
+        positions -= previously_dropped
+
+        before[section] = store.entries(layer['report'], section, positions) + replaced
+        dropped[section] = sorted(previously_dropped | positions)
+        own[section] = kept + recomputed[section]
+
+    return before, {'report': layer['report'], 'dropped': dropped, 'own': own}
+
+
+def _flatten(store, layer):
+    """
+    The sections of a layer in full when it drops and adds more entries than its
+    base holds, or None. The report is then stored as it is and becomes the base
+    of the next runs of its chain, so that runs keep costing what the churn does.
+    """
+    base_report = store.get(layer['report'])
+    if sum(
+        len(layer['dropped'][section]) + len(layer['own'][section])
+        for section in SECTIONS
+    ) <= sum(len(getattr(base_report, section)) for section in SECTIONS):
+        return None
+
+    return {
+        section: list(
+            LayeredSection(
+                getattr(base_report, section),
+                layer['dropped'][section],
+                layer['own'][section],
+            )
+        )
+        for section in SECTIONS
+    }
+
+
+def _field_counts(previous_counts, before, after):
+    # The field counts of the previous report, less its touched discrepancies and
+    # plus the recomputed ones
+    counts = collections.Counter(previous_counts)
+    counts.subtract(field_histogram(before))
+    counts.update(field_histogram(after))
+
+    return dict((field, count) for field, count in counts.most_common() if count > 0)
+
+
+def _canonical(entry):
+    # Keys read back from JSON are lists, so entries compare through JSON
+    return json.dumps(entry, sort_keys=True)
+
+
+def _section_changes(before, after):
+    """
+    The entries only in `after` ('added') and only in `before` ('removed'), the
+    entries of the touched keys of a section before and after a run.
+    """
+    before_entries = {_canonical(entry): entry for entry in before}
+    after_entries = {_canonical(entry): entry for entry in after}
+
+    return {
+        'added': [e for c, e in after_entries.items() if c not in before_entries],
+        'removed': [e for c, e in before_entries.items() if c not in after_entries],
+    }
+
+
+def reconcile_incremental(
+    source_file,
+    target_file,
+    key=None,
+    compare=None,
+    previous=None,
+    delta=False,
+    cache=None,
+    progress=None,
+    instrumentation=None,
+):
+    """
+    Reconcile two uploads against the snapshot of the `previous` report and store
+    the new report, or, without `previous`, reconcile them from scratch and keep
+    a first snapshot. The new report records what changed since the previous one
+    under `changes`. Returns `(report_id, fields, changes, *sections)` with the
+    sections in `SECTIONS` order, like `api.pipeline.run_reconciliation`.
+
+    Raises `SnapshotError` when the previous report does not exist, has no
+    snapshot (it is not the latest of its chain) or was matched on another key
+    or compared with another `compare` spec. Without a `key`, the run is matched
+    on the key of the previous report.
+    """
+    store = get_report_store()
+    compare = compare or CompareSpec()
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    os.makedirs(settings.SNAPSHOTS_ROOT, exist_ok=True)
+    working_path = os.path.join(
+        settings.SNAPSHOTS_ROOT, f'{uuid.uuid4().hex}.sqlite3.partial'
+    )
+
+    previous_report = None
+    if previous is not None:
+        previous_report = store.get(previous)
+        if previous_report is None:
+            raise SnapshotError(f'Report {previous} does not exist.')
+        key = key or KeySpec.parse(previous_report.key)
+        if str(key) != previous_report.key:
+            raise SnapshotError(
+                f'Report {previous} was matched on "{previous_report.key}", not '
+                f'"{key}".'
+            )
+        # Taking the snapshot over also keeps two runs from building on it at once
+        try:
+            os.replace(Snapshot.path_for(previous), working_path)
+        except FileNotFoundError:
+            raise SnapshotError(
+                f'Report {previous} has no snapshot, only the latest report of a '
+                'chain of incremental runs can be built on.'
+            ) from None
+    key = key or DEFAULT_KEY
+
+    snapshot = Snapshot(working_path)
+    try:
+        # Discrepancies carried over from the chain were found with its spec
+        if previous is not None and snapshot.compare != str(compare):
+            raise SnapshotError(
+                f'Report {previous} was compared with "{snapshot.compare}", not '
+                f'"{compare}".'
+            )
+        source_changes, source_duplicates, source_counts = _scan(
+            source_file,
+            'source',
+            snapshot,
+            key,
+            delta,
+            cache,
+            progress,
+            instrumentation,
+        )
+        target_changes, target_duplicates, target_counts = _scan(
+            target_file,
+            'target',
+            snapshot,
+            key,
+            delta,
+            cache,
+            progress,
+            instrumentation,
+        )
+        if progress is not None:
+            progress.advance('reconciling')
+
+        with instrumentation.phase('reconcile'):
+            touched = source_changes.keys() | target_changes.keys()
+            source_records = snapshot.records('source', touched - source_changes.keys())
+            target_records = snapshot.records('target', touched - target_changes.keys())
+
+            def current(changes, records, k):
+                if k in changes:
+                    return changes[k] and changes[k][1]
+                return records.get(k)
+
+            fields = set(previous_report.fields if previous_report else ())
+            recomputed = {section: [] for section in SECTIONS}
+            for k in touched:
+                s_record = current(source_changes, source_records, k)
+                t_record = current(target_changes, target_records, k)
+                if s_record is not None and t_record is not None:
+                    record_diffs = compare_records(
+                        s_record, t_record, fields, compare.functions
+                    )
+                    if record_diffs:
+                        recomputed['discrepancies'].append(
+                            {'id': key.function(s_record), 'differences': record_diffs}
+                        )
+                elif s_record is not None:
+                    recomputed['missing_in_target'].append(s_record)
+                elif t_record is not None:
+                    recomputed['missing_in_source'].append(t_record)
+            recomputed['duplicates_in_source'] = source_duplicates
+            recomputed['duplicates_in_target'] = target_duplicates
+
+            before = {section: [] for section in SECTIONS}
+            layer = sections = None
+            if previous_report is not None:
+                before, layer = _layer(
+                    store, previous_report, snapshot, touched, recomputed, key, delta
+                )
+                sections = _flatten(store, layer)
+
+        if progress is not None:
+            progress.advance('rendering')
+        changes = {}
+        if previous_report is not None:
+            # Entries of untouched keys are the same in both reports
+            changes = {
+                'previous': previous,
+                'keys': {'source': source_counts, 'target': target_counts},
+                'sections': {
+                    section: _section_changes(before[section], recomputed[section])
+                    for section in SECTIONS
+                },
+            }
+        with instrumentation.phase('store'):
+            if layer is None or sections is not None:
+                sections = sections or recomputed
+                report_id = store_report(
+                    fields,
+                    *sections.values(),
+                    key=key,
+                    previous=previous,
+                    changes=changes,
+                )
+                snapshot.index(sections, key)
+            else:
+                report_id = store_report(
+                    fields,
+                    *layer['own'].values(),
+                    key=key,
+                    previous=previous,
+                    changes=changes,
+                    base={'report': layer['report'], 'dropped': layer['dropped']},
+                    field_counts=_field_counts(
+                        store.summary(previous).fields,
+                        before['discrepancies'],
+                        recomputed['discrepancies'],
+                    ),
+                )
+            snapshot.update('source', source_changes)
+            snapshot.update('target', target_changes)
+            snapshot.compare = compare
+            snapshot.commit()
+    except BaseException:
+        snapshot.close()
+        # Hand the untouched snapshot back to the report it came from
+        if previous is not None:
+            os.replace(working_path, Snapshot.path_for(previous))
+        else:
+            os.remove(working_path)
+        raise
+
+    snapshot.close()
+    os.replace(working_path, Snapshot.path_for(report_id))
+    store.save_metrics(report_id, instrumentation.as_dict())
+
+    return report_id, fields, changes, *store.get(report_id).sections().values()
@@ -0,0 +1,202 @@
+"""
+Per-phase instrumentation of reconciliation runs. Every run records, for each of
+its phases (parse, normalize, reconcile, store...), the wall time, the CPU time
+of the thread doing the work (and of the worker processes of partitioned runs),
+the rows that went through and, when `RECONCILIATION_TRACE_MEMORY` is on, the
+peak traced memory. The phases of a run are pulled through each other as
+streams, so time is attributed exclusively: a phase is paused while it waits on
+the phase feeding it.
+
+Finished runs are also added up in `METRICS`, across every worker process, and
+the metrics endpoint renders the totals in the Prometheus text format.
+"""
+
+import contextlib
+import dataclasses
+import itertools
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce, Greatest
+
+# Streams are timed a batch of rows at a time, so the clocks are not read per row
+BATCH_SIZE = 256
+
+# (metric, type, description, PhaseStats attribute) of the exported metrics
+PROMETHEUS_METRICS = (
+    ('phase_seconds_total', 'counter', 'Wall time', 'wall'),
+    ('phase_cpu_seconds_total', 'counter', 'CPU time', 'cpu'),
+    ('phase_rows_total', 'counter', 'Rows processed', 'rows'),
+    ('phase_peak_memory_bytes', 'gauge', 'Peak traced memory', 'peak_memory'),
+)
+
+_tracing = 0
+_tracing_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class PhaseStats:
+    wall: float = 0.0
+    cpu: float = 0.0
+    rows: int = 0
+    peak_memory: int | None = None
+
+    def as_dict(self):
+        return {
+            'wall_seconds': round(self.wall, 6),
+            'cpu_seconds': round(self.cpu, 6),
+            'rows': self.rows,
+            'rows_per_second': (
+                round(self.rows / self.wall, 1) if self.rows and self.wall else None
+            ),
+            'peak_memory_bytes': self.peak_memory,
+        }
+
+
+class Instrumentation:
+    """
+    Collects the `PhaseStats` of one run. Code runs inside a phase with
+    `phase(name)`, and streams are attributed to a phase with `iterate(name, rows)`.
+    """
+
+    def __init__(self, trace_memory=None):
+        if trace_memory is None:
+            trace_memory = settings.RECONCILIATION_TRACE_MEMORY
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self._stack = []
+        self._wall = None
+        self._cpu = None
+
+    def _switch(self):
+        # Charge the time since the last switch to the phase on top of the stack
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        if self._stack:
+            stats = self.phases[self._stack[-1]]
+            stats.wall += wall - self._wall
+            stats.cpu += cpu - self._cpu
+            if self.trace_memory and tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1]
+                stats.peak_memory = max(stats.peak_memory or 0, peak)
+                tracemalloc.reset_peak()
+        self._wall = wall
+        self._cpu = cpu
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._switch()
+        self.phases.setdefault(name, PhaseStats())
+        self._stack.append(name)
+        try:
+            yield self.phases[name]
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def iterate(self, name, rows, batch_size=None):
+        """Pass `rows` through, charging the time spent producing them to `name`."""
+        rows = iter(rows)
+        batch_size = batch_size or BATCH_SIZE
+        while True:
+            with self.phase(name) as stats:
+                batch = list(itertools.islice(rows, batch_size))
+                stats.rows += len(batch)
+            if not batch:
+                return
+            yield from batch
+
+    @contextlib.contextmanager
+    def tracing(self):
+        """
+        Trace memory allocations for the duration of the block, if asked to. The
+        tracer is shared by the whole process, so concurrent runs each see the
+        peaks of the others.
+        """
+        global _tracing
+
+        if not self.trace_memory:
+            yield
+            return
+
+        with _tracing_lock:
+            if _tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            _tracing += 1
+        try:
+            yield
+        finally:
+            with _tracing_lock:
+                _tracing -= 1
+                if _tracing == 0:
+                    tracemalloc.stop()
+
+    def as_dict(self):
+        return {name: stats.as_dict() for name, stats in self.phases.items()}
+
+    def server_timing(self):
+        """The phases as a `Server-Timing` header value, durations in milliseconds."""
+        return ', '.join(
+            f'{name};dur={stats.wall * 1000:.3f}' for name, stats in self.phases.items()
+        )
+
+
+class MetricsRegistry:
+    """
+    Running totals of every instrumented run, rendered in the Prometheus text
+    exposition format. The totals are kept in the database rather than in the
+    process, so every worker process of the server adds to, and renders, the
+    same counters.
+    """
+
+    def record(self, instrumentation):
+        from .models import PhaseTotal
+
+        phases = [('', None), *instrumentation.phases.items()]
+        with transaction.atomic():
+            for name, stats in phases:
+                PhaseTotal.objects.get_or_create(phase=name)
+                totals = {'runs': F('runs') + 1}
+                if stats is not None:
+                    totals['wall'] = F('wall') + stats.wall
+                    totals['cpu'] = F('cpu') + stats.cpu
+                    totals['rows'] = F('rows') + stats.rows
+                    if stats.peak_memory is not None:
+                        totals['peak_memory'] = Greatest(
+                            Coalesce('peak_memory', 0), stats.peak_memory
+                        )
+                PhaseTotal.objects.filter(phase=name).update(**totals)
+
+    def render(self):
+        from .models import PhaseTotal
+
+        runs = 0
+        phases = []
+        for totals in PhaseTotal.objects.order_by('phase'):
+            if totals.phase:
+                phases.append(totals)
+            else:
+                runs = totals.runs
+
+        lines = [
+            '# HELP reconciliation_runs_total Reconciliation runs completed.',
+            '# TYPE reconciliation_runs_total counter',
+            f'reconciliation_runs_total {runs}',
+        ]
+        for metric, kind, description, attribute in PROMETHEUS_METRICS:
+            name = f'reconciliation_{metric}'
+            lines.append(f'# HELP {name} {description} per reconciliation phase.')
+            lines.append(f'# TYPE {name} {kind}')
+            for totals in phases:
+                value = getattr(totals, attribute)
+                if value is not None:
+                    lines.append(f'{name}{{phase="{totals.phase}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
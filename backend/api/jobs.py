@@ -0,0 +1,245 @@
+"""
+Asynchronous reconciliation jobs. The uploads are saved to disk and the run is
+handed to a local thread pool, so the request returns straight away and clients
+poll the job for its progress. No external broker is needed. Chunked uploads
+(see `api.uploads`) are already on disk, and are read as their chunks land.
+
+The state of every job is written to a file under `settings.JOBS_ROOT` as it
+changes, so a poll answered by any worker process sees it, and kept for
+`settings.RECONCILIATION_JOB_RETENTION` seconds after it last changed.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .pipeline import Progress, run_reconciliation
+from .uploads import ChunkedUpload, open_upload
+
+# The jobs running or queued in this process. Key = job_id, Value = Job
+JOBS = {}
+
+# Row counters are written out at most this often (in seconds) while a job runs
+SAVE_INTERVAL = 0.5
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class Job:
+    def __init__(
+        self,
+        source_path,
+        target_path,
+        engine='hash',
+        partitioned=False,
+        key=None,
+        compare=None,
+        fuzzy=None,
+        previous=None,
+        delta=False,
+        snapshot=False,
+    ):
+        self.id = uuid.uuid4().hex
+        # The saved uploads, or the `ChunkedUpload`s the job reads in place
+        self.source_path = source_path
+        self.target_path = target_path
+        self.engine = engine
+        self.partitioned = partitioned
+        self.key = key
+        self.compare = compare
+        self.fuzzy = fuzzy
+        self.previous = previous
+        self.delta = delta
+        self.snapshot = snapshot
+        self.status = 'queued'
+        self.progress = Progress(on_change=self._progressed)
+        self.report_id = None
+        self.error = None
+        self.created_at = datetime.datetime.now()
+        self.finished_at = None
+        self._saved_at = 0
+
+    @staticmethod
+    def path_for(job_id):
+        return os.path.join(settings.JOBS_ROOT, f'{job_id}.json')
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            **self.progress.as_dict(),
+            'error': self.error,
+            'report_id': self.report_id,
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at and self.finished_at.isoformat(),
+        }
+
+    def save(self):
+        """Write the state of the job out for every worker process to read."""
+        os.makedirs(settings.JOBS_ROOT, exist_ok=True)
+        path = self.path_for(self.id)
+        partial = f'{path}.{threading.get_ident()}.partial'
+        with open(partial, 'w') as f:
+            json.dump(self.as_dict(), f)
+        os.replace(partial, path)
+        self._saved_at = time.monotonic()
+
+    def _progressed(self, phase_changed):
+        if phase_changed or time.monotonic() - self._saved_at >= SAVE_INTERVAL:
+            self.save()
+
+    def run(self):
+        # The thread may hold on to connections from an earlier job
+        close_old_connections()
+        self.status = 'running'
+        try:
+            with open_upload(self.source_path) as s, open_upload(self.target_path) as t:
+                self.report_id, *_ = run_reconciliation(
+                    s,
+                    t,
+                    engine=self.engine,
+                    partitioned=self.partitioned,
+                    progress=self.progress,
+                    key=self.key,
+                    compare=self.compare,
+                    fuzzy=self.fuzzy,
+                    previous=self.previous,
+                    delta=self.delta,
+                    snapshot=self.snapshot,
+                )
+            self.status = 'completed'
+            self.progress.advance('done')
+            # Chunked uploads are kept until they are used, so failed runs can retry
+            for upload in (self.source_path, self.target_path):
+                if isinstance(upload, ChunkedUpload):
+                    upload.delete()
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished_at = datetime.datetime.now()
+            for path in (self.source_path, self.target_path):
+                if not isinstance(path, ChunkedUpload):
+                    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            self.save()
+            JOBS.pop(self.id, None)
+            close_old_connections()
+
+
+def get_job(job_id):
+    """
+    The state of job `job_id` (see `Job.as_dict`) from whichever process runs
+    or ran it, or None.
+    """
+    job = JOBS.get(job_id)
+    if job is not None:
+        return job.as_dict()
+    if not job_id.isalnum():
+        return None
+
+    try:
+        with open(Job.path_for(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def expire_jobs(max_age=None):
+    """
+    Delete the state of the jobs that have not changed for `max_age` seconds
+    (defaults to `settings.RECONCILIATION_JOB_RETENTION`).
+    """
+    max_age = settings.RECONCILIATION_JOB_RETENTION if max_age is None else max_age
+    try:
+        names = os.listdir(settings.JOBS_ROOT)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        path = os.path.join(settings.JOBS_ROOT, name)
+        with contextlib.suppress(FileNotFoundError):
+            if time.time() - os.path.getmtime(path) >= max_age:
+                os.remove(path)
+
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.RECONCILIATION_JOB_WORKERS,
+                thread_name_prefix='reconciliation-job',
+            )
+
+    return _executor
+
+
+def _save_upload(file_obj, path):
+    with open(path, 'wb') as f:
+        if hasattr(file_obj, 'chunks'):
+            for chunk in file_obj.chunks():
+                f.write(chunk)
+        else:
+            file_obj.seek(0)
+            shutil.copyfileobj(file_obj, f)
+
+
+def submit_job(
+    source_file,
+    target_file,
+    engine='hash',
+    partitioned=False,
+    key=None,
+    compare=None,
+    fuzzy=None,
+    previous=None,
+    delta=False,
+    snapshot=False,
+):
+    """
+    Store both uploads under `settings.UPLOADS_ROOT` and queue their
+    reconciliation. Returns the queued `Job`. Chunked uploads are not copied,
+    the job reads them in place (waiting for the chunks still to come).
+    """
+    directory = os.path.join(settings.UPLOADS_ROOT, 'jobs', uuid.uuid4().hex)
+    paths = []
+    for side, file_obj in (('source', source_file), ('target', target_file)):
+        if isinstance(file_obj, ChunkedUpload):
+            paths.append(file_obj)
+            continue
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{side}.csv')
+        _save_upload(file_obj, path)
+        paths.append(path)
+    source_path, target_path = paths
+
+    job = Job(
+        source_path,
+        target_path,
+        engine=engine,
+        partitioned=partitioned,
+        key=key,
+        compare=compare,
+        fuzzy=fuzzy,
+        previous=previous,
+        delta=delta,
+        snapshot=snapshot,
+    )
+    # Submitting a job is when the state of old ones is cleaned up
+    expire_jobs()
+    job.save()
+    JOBS[job.id] = job
+    _get_executor().submit(job.run)
+
+    return job
@@ -0,0 +1,146 @@
+"""
+Matching keys. A `KeySpec` says which columns identify a record and how their
+values are transformed before records are matched, e.g.
+`account, value_date, reference:alnum`. Single column keys are the (transformed)
+value itself, composite keys are a tuple of values.
+
+The key of a record is computed once, when it is indexed: key values are plain
+strings, which cache their own hash, so the dictionaries and sets the engines
+build never hash a key column twice.
+"""
+
+import operator
+import re
+
+# Transforms applied to a key column after the record itself is normalized
+KEY_TRANSFORMS = {
+    # Drop punctuation and spaces: 'INV-001' and 'inv 001' match
+    'alnum': lambda value: re.sub(r'[\W_]+', '', value),
+    # Keep the digits only: '+254 (700) 000' and '254700000' match
+    'digits': lambda value: re.sub(r'\D+', '', value),
+    # Drop leading zeros: '00042' and '42' match
+    'int': lambda value: value.lstrip('0') or ('0' if value else value),
+}
+
+# Composite keys are formatted as their parts joined with the separator, where the
+# separator and the escape character are escaped inside a part, so that no two keys
+# format the same: ('a|b', 'c') is a\|b|c and ('a', 'b|c') is a|b\|c
+KEY_SEPARATOR = '|'
+KEY_ESCAPE = '\\'
+
+
+def format_key(key):
+    """A key (a value, a tuple of values or None) as a single string, or None."""
+    if isinstance(key, (tuple, list)):
+        return KEY_SEPARATOR.join(
+            part.replace(KEY_ESCAPE, KEY_ESCAPE * 2).replace(
+                KEY_SEPARATOR, KEY_ESCAPE + KEY_SEPARATOR
+            )
+            for part in key
+        )
+
+    return key
+
+
+class KeySpec:
+    """
+    The columns (and optional per-column transforms) records are matched on.
+    Build one from its string form with `KeySpec.parse`.
+    """
+
+    def __init__(self, columns=('id',), transforms=None):
+        if not columns:
+            raise ValueError('A key needs at least one column.')
+        transforms = transforms or {}
+        unknown = set(transforms.values()) - set(KEY_TRANSFORMS)
+        if unknown:
+            raise ValueError(f'Unknown key transforms: {", ".join(sorted(unknown))}.')
+
+        self.columns = tuple(columns)
+        self.transforms = dict(transforms)
+        self._function = None
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse 'column[:transform], ...', e.g. 'account, reference:alnum'."""
+        columns = []
+        transforms = {}
+        for part in spec.split(','):
+            column, _, transform = (value.strip() for value in part.partition(':'))
+            if not column:
+                raise ValueError(f'Invalid key "{spec}".')
+            columns.append(column)
+            if transform:
+                transforms[column] = transform
+
+        return cls(columns, transforms)
+
+    def __str__(self):
+        return ','.join(
+            f'{column}:{self.transforms[column]}'
+            if column in self.transforms
+            else column
+            for column in self.columns
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, KeySpec) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __getstate__(self):
+        # The key function is a closure, workers rebuild it
+        return {'columns': self.columns, 'transforms': self.transforms}
+
+    def __setstate__(self, state):
+        self.__init__(state['columns'], state['transforms'])
+
+    def _transform(self, column):
+        transform = KEY_TRANSFORMS.get(self.transforms.get(column))
+        if transform is None:
+            return operator.methodcaller('get', column)
+
+        def get(record):
+            value = record.get(column)
+            return transform(value) if value else value
+
+        return get
+
+    @property
+    def function(self):
+        """
+        The key function handed to the engines. Records missing every key column
+        get a None key; in composite keys, missing columns are empty strings, so
+        keys always compare.
+        """
+        if self._function is None:
+            getters = [self._transform(column) for column in self.columns]
+            if len(getters) == 1:
+                self._function = getters[0]
+            else:
+
+                def function(record):
+                    key = tuple([getter(record) or '' for getter in getters])
+                    return key if any(key) else None
+
+                self._function = function
+
+        return self._function
+
+    def format(self, key):
+        """A key as a single string, for exports and key range filters."""
+        return format_key(key)
+
+    def entry_key(self, section, entry, default=None):
+        """
+        The formatted key of an entry of a report `section`: discrepancies carry
+        their key, records are keyed with this spec. Entries without a key get
+        `default`.
+        """
+        key = entry['id'] if section == 'discrepancies' else self.function(entry)
+
+        return default if key is None else format_key(key)
+
+
+DEFAULT_KEY = KeySpec()
@@ -0,0 +1,192 @@
+"""
+Time reconciliation on synthetic ledgers (see `benchmarks.generator`) and write
+the results as JSON. Every engine is timed stage by stage through the pipeline,
+and through the whole `ReconciliationViewSet.create` path. Pass `--baseline`
+with the results of an earlier run to fail on regressions.
+
+    python manage.py benchmark --rows 10000 100000 --output results.json
+"""
+
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from rest_framework.test import APIRequestFactory
+
+from api.engines import ENGINES
+from api.instrumentation import Instrumentation
+from api.pipeline import run_reconciliation
+from api.reconciliation_engine import generate_csv
+from api.storage import SECTIONS, get_report_store
+from api.views import ReconciliationViewSet
+from benchmarks.generator import DEFAULTS, write_ledgers
+
+SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+
+
+class Command(BaseCommand):
+    help = (
+        'Time every reconciliation stage and the create endpoint on synthetic '
+        'ledgers and write the results as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=list(SIZES))
+        parser.add_argument(
+            '--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES)
+        )
+        parser.add_argument('--columns', type=int, default=DEFAULTS['columns'])
+        parser.add_argument(
+            '--discrepancy-rate', type=float, default=DEFAULTS['discrepancy_rate']
+        )
+        parser.add_argument(
+            '--missing-rate', type=float, default=DEFAULTS['missing_rate']
+        )
+        parser.add_argument(
+            '--date-density', type=float, default=DEFAULTS['date_density']
+        )
+        parser.add_argument('--key-skew', type=float, default=DEFAULTS['key_skew'])
+        parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+        parser.add_argument(
+            '--no-create',
+            action='store_true',
+            help='Skip the create endpoint, which holds each upload in memory.',
+        )
+        parser.add_argument('--output', default='benchmark-results.json')
+        parser.add_argument(
+            '--baseline', help='Results of an earlier run to compare against.'
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help='How much slower than the baseline a stage may get (0.25 = 25%%).',
+        )
+
+    def handle(self, *args, **options):
+        generator = {
+            name: options[name]
+            for name in (
+                'columns',
+                'discrepancy_rate',
+                'missing_rate',
+                'date_density',
+                'key_skew',
+                'seed',
+            )
+        }
+        results = []
+
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as directory:
+            for rows in options['rows']:
+                paths = write_ledgers(directory, rows, **generator)
+                for engine in options['engines']:
+                    results.append(self.time_pipeline(rows, engine, *paths))
+                    if not options['no_create']:
+                        results.append(self.time_create(rows, engine, *paths))
+
+        payload = {
+            'meta': {
+                'created_at': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'generator': generator,
+            },
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(payload, f, indent=2)
+        self.stdout.write(f'Results written to {options["output"]}')
+
+        if options['baseline']:
+            self.check_regressions(results, options['baseline'], options['tolerance'])
+
+    def report(self, result):
+        self.stdout.write(
+            f'{result["rows"]:>10} {result["engine"]:>10} {result["stage"]:>8} '
+            f'{result["seconds"]:>8.2f}s'
+        )
+
+        return result
+
+    def time_pipeline(self, rows, engine, source_path, target_path):
+        """Run the reconciliation pipeline and the CSV export, phase by phase."""
+        instrumentation = Instrumentation(trace_memory=False)
+
+        started = time.perf_counter()
+        with open(source_path, 'rb') as s, open(target_path, 'rb') as t:
+            report_id, fields, _, *sections = run_reconciliation(
+                s, t, engine=engine, instrumentation=instrumentation
+            )
+        results = dict(zip(SECTIONS, sections))
+        with instrumentation.phase('render'):
+            for _ in generate_csv(results, fields):
+                pass
+        elapsed = time.perf_counter() - started
+        get_report_store().delete(report_id)
+
+        return self.report(
+            {
+                'rows': rows,
+                'engine': engine,
+                'stage': 'pipeline',
+                'seconds': round(elapsed, 6),
+                'phases': instrumentation.as_dict(),
+            }
+        )
+
+    def time_create(self, rows, engine, source_path, target_path):
+        """Post the ledgers to `ReconciliationViewSet.create` and render the JSON."""
+        view = ReconciliationViewSet.as_view({'post': 'create'})
+        with open(source_path, 'rb') as s, open(target_path, 'rb') as t:
+            request = APIRequestFactory(SERVER_NAME='localhost').post(
+                reverse('api:reconciliation-list'),
+                {'source_file': s, 'target_file': t, 'engine': engine},
+                format='multipart',
+            )
+
+        started = time.perf_counter()
+        response = view(request)
+        response.render()
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            raise CommandError(f'create answered {response.status_code}')
+        get_report_store().delete(response.data['id'])
+
+        return self.report(
+            {
+                'rows': rows,
+                'engine': engine,
+                'stage': 'create',
+                'seconds': round(elapsed, 6),
+                'phases': response.data['metrics'],
+            }
+        )
+
+    def check_regressions(self, results, baseline_path, tolerance):
+        with open(baseline_path) as f:
+            baseline = {
+                (result['rows'], result['engine'], result['stage']): result['seconds']
+                for result in json.load(f)['results']
+            }
+
+        regressions = []
+        for result in results:
+            before = baseline.get((result['rows'], result['engine'], result['stage']))
+            if before and result['seconds'] > before * (1 + tolerance):
+                regressions.append(
+                    f'{result["stage"]} with {result["engine"]} on {result["rows"]} '
+                    f'rows: {before:.2f}s -> {result["seconds"]:.2f}s'
+                )
+
+        if regressions:
+            raise CommandError('Regressions:\n' + '\n'.join(regressions))
+        self.stdout.write('No regressions against the baseline.')
@@ -0,0 +1,27 @@
+"""
+Delete chunked uploads that have not received a chunk, been completed or been
+read for `RECONCILIATION_UPLOAD_EXPIRY` seconds. Starting an upload does the
+same, run this from cron to clean up when no uploads are being started.
+
+    python manage.py expire_uploads --max-age 3600
+"""
+
+from django.core.management.base import BaseCommand
+
+from api.uploads import ChunkedUpload
+
+
+class Command(BaseCommand):
+    help = 'Delete expired chunked uploads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age',
+            type=float,
+            default=None,
+            help='Seconds since the last activity, defaults to the expiry setting.',
+        )
+
+    def handle(self, *args, **options):
+        expired = ChunkedUpload.expire(options['max_age'])
+        self.stdout.write(f'Deleted {len(expired)} expired uploads.')
@@ -0,0 +1,350 @@
+"""
+Tolerant matching. A `CompareSpec` says how the values of some columns are
+compared instead of by exact equality, e.g. `amount:numeric=0.01,
+value_date:date=1, name:text`, and `link_records` pairs up leftover missing
+records whose keys only differ by a typo.
+
+Linking uses a sorted neighbourhood index: the records of both sides are sorted
+together on a blocking key and each record is only scored against its
+neighbours within a small window. Three passes (the key, the key reversed, so
+typos at either end are caught, and the other fields of the record, for typos
+in the middle of dense keys) keep linking at O(n log n) instead of comparing
+every pair.
+"""
+
+import datetime
+import decimal
+import difflib
+import itertools
+import operator
+import re
+
+from .engines import compare_records
+
+# How `api.reconciliation_engine` formats the dates it recognises
+NORMALIZED_DATE_FORMAT = '%a, %d %B, %Y'
+
+# How many sorted neighbours each key is scored against
+LINK_WINDOW = 8
+
+# The score (between 0 and 1) two records need to be linked
+LINK_THRESHOLD = 0.8
+
+
+# Commas are only read as thousands separators, between groups of three digits,
+# so '1,5' (a decimal comma) is not taken for 15
+THOUSANDS = re.compile(r'\s*[+-]?\d{1,3}(,\d{3})+(\.\d*)?([eE][+-]?\d+)?\s*')
+
+
+def _parse_number(value):
+    if not isinstance(value, str):
+        return None
+    if ',' in value:
+        if not THOUSANDS.fullmatch(value):
+            return None
+        value = value.replace(',', '')
+
+    try:
+        number = decimal.Decimal(value.replace('_', ''))
+    except decimal.InvalidOperation:
+        return None
+
+    return number if number.is_finite() else None
+
+
+def _parse_date(value):
+    if not isinstance(value, str):
+        return None
+
+    try:
+        parsed = datetime.datetime.strptime(value, NORMALIZED_DATE_FORMAT)
+    except ValueError:
+        try:
+            parsed = datetime.datetime.fromisoformat(value.upper())
+        except ValueError:
+            return None
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+def numeric(tolerance='0'):
+    """Numbers differ when they are more than `tolerance` apart: 100 == 100.00 == 1e2."""
+    tolerance = _parse_number(tolerance)
+    if tolerance is None or tolerance < 0:
+        raise ValueError('A numeric tolerance must be a number of at least 0.')
+
+    def differs(source, target):
+        if source == target:
+            return False
+        source, target = _parse_number(source), _parse_number(target)
+        if source is None or target is None:
+            return True
+
+        try:
+            return abs(source - target) > tolerance
+        except decimal.DecimalException:
+            # Their difference overflows, so they are too far apart to match
+            return True
+
+    return differs
+
+
+def date(days='0'):
+    """Dates and timestamps differ when they are more than `days` days apart."""
+    try:
+        days = float(days)
+        # Also false for NaN
+        if not days >= 0:
+            raise ValueError
+        window = datetime.timedelta(days=days)
+    except (ValueError, OverflowError):
+        raise ValueError(
+            'A date window must be a number of days of at least 0.'
+        ) from None
+
+    def differs(source, target):
+        if source == target:
+            return False
+        source, target = _parse_date(source), _parse_date(target)
+        if source is None or target is None:
+            return True
+
+        return abs(source - target) > window
+
+    return differs
+
+
+def text():
+    """Text differs when it does apart from case and whitespace."""
+
+    def fold(value):
+        return ' '.join(value.split()).casefold()
+
+    def differs(source, target):
+        if source == target:
+            return False
+        if not isinstance(source, str) or not isinstance(target, str):
+            return True
+
+        return fold(source) != fold(target)
+
+    return differs
+
+
+# Comparator name -> factory of a `differs(source, target)` function, which takes
+# the comparator's optional argument
+COMPARATORS = {
+    'numeric': numeric,
+    'date': date,
+    'text': text,
+}
+
+
+class CompareSpec:
+    """
+    How the values of some columns are compared, every other column is compared
+    exactly. Build one from its string form with `CompareSpec.parse`.
+    """
+
+    def __init__(self, comparators=None):
+        self.comparators = dict(comparators or {})
+        self.functions = {}
+        for column, (name, argument) in self.comparators.items():
+            if name not in COMPARATORS:
+                raise ValueError(f'Unknown comparator "{name}".')
+            factory = COMPARATORS[name]
+            try:
+                self.functions[column] = (
+                    factory() if argument is None else factory(argument)
+                )
+            except TypeError:
+                raise ValueError(f'The {name} comparator takes no argument.') from None
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse 'column:comparator[=argument], ...', e.g. 'amount:numeric=0.01'."""
+        comparators = {}
+        for part in filter(str.strip, spec.split(',')):
+            column, _, comparator = (value.strip() for value in part.partition(':'))
+            name, equals, argument = (
+                value.strip() for value in comparator.partition('=')
+            )
+            if not column or not name:
+                raise ValueError(f'Invalid comparison "{part.strip()}".')
+            comparators[column] = (name, argument if equals else None)
+
+        return cls(comparators)
+
+    def __str__(self):
+        return ','.join(
+            f'{column}:{name}' + (f'={argument}' if argument is not None else '')
+            for column, (name, argument) in self.comparators.items()
+        )
+
+    def __bool__(self):
+        return bool(self.comparators)
+
+    def __eq__(self, other):
+        return isinstance(other, CompareSpec) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __getstate__(self):
+        # The comparators are closures, workers rebuild them
+        return {'comparators': self.comparators}
+
+    def __setstate__(self, state):
+        self.__init__(state['comparators'])
+
+
+def _neighbours(source_blocks, target_blocks, window):
+    """
+    Candidate (source, target) position pairs. Every pass of blocking keys sorts
+    both sides together and pairs each record with the other side's records
+    within `window` places. Records without a blocking key are left out.
+    """
+    candidates = set()
+    for source_pass, target_pass in zip(source_blocks, target_blocks):
+        entries = sorted(
+            [(block, 0, i) for i, block in enumerate(source_pass) if block]
+            + [(block, 1, i) for i, block in enumerate(target_pass) if block]
+        )
+        for position, (_, side, i) in enumerate(entries):
+            for _, other_side, j in entries[position + 1 : position + window]:
+                if other_side != side:
+                    candidates.add((i, j) if side == 0 else (j, i))
+
+    return candidates
+
+
+def _blocks(records, keys, key_columns):
+    # The key, the key reversed and the other fields, for records that have a key
+    rest = [
+        '\x1f'.join(
+            f'{field}={value}'
+            for field, value in sorted(record.items(), key=str)
+            if field not in key_columns
+        )
+        if k
+        else None
+        for k, record in zip(keys, records)
+    ]
+
+    return keys, [k[::-1] if k else None for k in keys], rest
+
+
+def link_records(
+    missing_in_target,
+    missing_in_source,
+    key,
+    fields,
+    compare=None,
+    threshold=None,
+    window=None,
+):
+    """
+    Link records missing on either side whose keys (as formatted by `key`, an
+    `api.keys.KeySpec`) are close and whose other fields mostly agree. A pair
+    scores the mean of its key similarity and the share of its other fields that
+    are equal (under `compare`, a dict of `differs` functions). Pairs scoring at
+    least `threshold` are linked best first, each record at most once.
+
+    Returns the discrepancies of the linked pairs (keyed by the source key and
+    marked `'match': 'fuzzy'`, their key columns show up as differences) and
+    what is left of both missing lists.
+    """
+    threshold = LINK_THRESHOLD if threshold is None else threshold
+    window = window or LINK_WINDOW
+    compare = compare or {}
+
+    def formatted(record):
+        return key.format(key.function(record))
+
+    source_keys = list(map(formatted, missing_in_target))
+    target_keys = list(map(formatted, missing_in_source))
+    key_columns = set(key.columns)
+    candidates = _neighbours(
+        _blocks(missing_in_target, source_keys, key_columns),
+        _blocks(missing_in_source, target_keys, key_columns),
+        window,
+    )
+
+    scored = []
+    for i, j in candidates:
+        s_record, t_record = missing_in_target[i], missing_in_source[j]
+
+        # Field agreement is cheap, so it rules out most pairs before the keys
+        # are scored: even identical keys cannot lift a pair whose fields disagree
+        others = (s_record.keys() | t_record.keys()) - key_columns
+        if others:
+            agreement = sum(
+                not compare.get(field, operator.ne)(
+                    s_record.get(field), t_record.get(field)
+                )
+                for field in others
+            ) / len(others)
+            if (1 + agreement) / 2 < threshold:
+                continue
+
+        matcher = difflib.SequenceMatcher(None, source_keys[i], target_keys[j])
+        # quick_ratio is an upper bound of ratio, skip pairs that cannot make it
+        bound = matcher.quick_ratio()
+        if (bound + agreement) / 2 < threshold if others else bound < threshold:
+            continue
+        similarity = matcher.ratio()
+        score = (similarity + agreement) / 2 if others else similarity
+
+        if score >= threshold:
+            scored.append((-score, i, j))
+
+    linked = []
+    used_source = set()
+    used_target = set()
+    for _, i, j in sorted(scored):
+        if i in used_source or j in used_target:
+            continue
+        used_source.add(i)
+        used_target.add(j)
+        linked.append(
+            {
+                'id': key.function(missing_in_target[i]),
+                'differences': compare_records(
+                    missing_in_target[i], missing_in_source[j], fields, compare
+                ),
+                'match': 'fuzzy',
+            }
+        )
+
+    return (
+        linked,
+        [r for i, r in enumerate(missing_in_target) if i not in used_source],
+        [r for j, r in enumerate(missing_in_source) if j not in used_target],
+    )
+
+
+def link_sections(fields, sections, key, compare=None, threshold=None):
+    """
+    Run `link_records` over the missing sections of engine results (in
+    `SECTIONS` order) and return the sections with the linked pairs moved to
+    the discrepancies.
+    """
+    missing_in_target, missing_in_source, discrepancies, *rest = sections
+    linked, missing_in_target, missing_in_source = link_records(
+        missing_in_target,
+        missing_in_source,
+        key,
+        fields,
+        compare=compare,
+        threshold=threshold,
+    )
+
+    return [
+        missing_in_target,
+        missing_in_source,
+        list(itertools.chain(discrepancies, linked)),
+        *rest,
+    ]
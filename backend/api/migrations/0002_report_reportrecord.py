@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Report',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('fields', models.JSONField(default=list)),
+                ('missing_in_target_count', models.PositiveIntegerField(default=0)),
+                ('missing_in_source_count', models.PositiveIntegerField(default=0)),
+                ('discrepancies_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReportRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('section', models.CharField(choices=[('missing_in_target', 'Missing in target'), ('missing_in_source', 'Missing in source'), ('discrepancies', 'Discrepancies')], max_length=20)),
+                ('position', models.PositiveIntegerField()),
+                ('data', models.JSONField()),
+                ('report', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records', to='api.report')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['report', 'section', 'position'], name='api_reportr_report__e15aae_idx')],
+            },
+        ),
+    ]
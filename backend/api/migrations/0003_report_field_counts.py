@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_report_reportrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='field_counts',
+            field=models.JSONField(default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_report_field_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='metrics',
+            field=models.JSONField(default=dict),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_report_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='duplicates_in_source_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='duplicates_in_target_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='key',
+            field=models.CharField(default='id', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='reportrecord',
+            name='section',
+            field=models.CharField(choices=[('missing_in_target', 'Missing in target'), ('missing_in_source', 'Missing in source'), ('discrepancies', 'Discrepancies'), ('duplicates_in_source', 'Duplicates in source'), ('duplicates_in_target', 'Duplicates in target')], max_length=20),
+        ),
+    ]
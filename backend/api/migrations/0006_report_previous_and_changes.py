@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_report_keys_and_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='changes',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='previous',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_report_previous_and_changes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='base',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_report_base'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhaseTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phase', models.CharField(max_length=50, unique=True)),
+                ('runs', models.PositiveBigIntegerField(default=0)),
+                ('wall', models.FloatField(default=0.0)),
+                ('cpu', models.FloatField(default=0.0)),
+                ('rows', models.PositiveBigIntegerField(default=0)),
+                ('peak_memory', models.PositiveBigIntegerField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -7,3 +7,60 @@ class Book(models.Model):
     published_date = models.DateField()
     def __str__(self):
         return self.title
+
+
+class Report(models.Model):
+    """The summary of a reconciliation report stored by DatabaseReportStore."""
+    created_at = models.DateTimeField()
+    fields = models.JSONField(default=list)
+    field_counts = models.JSONField(default=list)
+    metrics = models.JSONField(default=dict)
+    missing_in_target_count = models.PositiveIntegerField(default=0)
+    missing_in_source_count = models.PositiveIntegerField(default=0)
+    discrepancies_count = models.PositiveIntegerField(default=0)
+    duplicates_in_source_count = models.PositiveIntegerField(default=0)
+    duplicates_in_target_count = models.PositiveIntegerField(default=0)
+    key = models.CharField(max_length=255, default='id')
+    previous = models.CharField(max_length=64, null=True, blank=True)
+    changes = models.JSONField(default=dict)
+    # The report this one is stored on top of, and the positions it drops
+    base = models.JSONField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Report #{self.pk}'
+
+
+class ReportRecord(models.Model):
+    """One missing record or discrepancy of a stored report."""
+    SECTIONS = [
+        ('missing_in_target', 'Missing in target'),
+        ('missing_in_source', 'Missing in source'),
+        ('discrepancies', 'Discrepancies'),
+        ('duplicates_in_source', 'Duplicates in source'),
+        ('duplicates_in_target', 'Duplicates in target'),
+    ]
+
+    report = models.ForeignKey(Report, related_name='records', on_delete=models.CASCADE)
+    section = models.CharField(max_length=20, choices=SECTIONS)
+    position = models.PositiveIntegerField()
+    data = models.JSONField()
+
+    class Meta:
+        indexes = [models.Index(fields=['report', 'section', 'position'])]
+
+
+class PhaseTotal(models.Model):
+    """
+    The running totals of one phase over the instrumented runs of every worker
+    process (see `api.instrumentation.MetricsRegistry`). The row of the empty
+    phase only counts the runs.
+    """
+    phase = models.CharField(max_length=50, unique=True)
+    runs = models.PositiveBigIntegerField(default=0)
+    wall = models.FloatField(default=0.0)
+    cpu = models.FloatField(default=0.0)
+    rows = models.PositiveBigIntegerField(default=0)
+    peak_memory = models.PositiveBigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return self.phase or 'runs'
@@ -0,0 +1,83 @@
+import base64
+import binascii
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class SectionCursorPagination(BasePagination):
+    """
+    Cursor pagination over one section of a stored report. Reports never change,
+    so the cursor is simply an opaque position in the section: following `next`
+    resumes the scan where the previous page stopped, even when filters skip
+    records, and no page ever needs to count or re-read the pages before it.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_section(self, records, request, matches=None):
+        """
+        Return the next page of `records` (any sequence that can be sliced) that
+        satisfy `matches`.
+        """
+        self.request = request
+        start = self.decode_cursor(request)
+        limit = self.get_page_size(request)
+
+        # Records are read a page-sized slice at a time, which is a single query
+        # for sections backed by a database
+        page = []
+        position = start
+        while position < len(records) and len(page) < limit:
+            for record in records[position : position + limit]:
+                if len(page) == limit:
+                    break
+                position += 1
+                if matches is None or matches(record):
+                    page.append(record)
+
+        self.next_position = position if position < len(records) else None
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return 0
+
+        try:
+            position = int(base64.urlsafe_b64decode(encoded.encode('ascii')))
+        except (TypeError, ValueError, binascii.Error, UnicodeEncodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if position < 0:
+            raise NotFound(self.invalid_cursor_message)
+
+        return position
+
+    def encode_cursor(self, position):
+        encoded = base64.urlsafe_b64encode(str(position).encode('ascii')).decode()
+        url = self.request.build_absolute_uri()
+
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+
+        return self.encode_cursor(self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
@@ -0,0 +1,330 @@
+"""
+Partitioned execution: both uploads are hash-partitioned on their (normalized)
+key into buckets, and every bucket pair is normalized and reconciled on its own
+in a process pool. A key always lands in the same bucket on both sides, so the
+per-bucket results simply add up to the results of a single run.
+
+The parent process only splits each upload into byte ranges of whole records:
+the workers parse and partition a range each, then reconcile a bucket pair
+each, so no per-row work is left serial. Ranges are partitioned in file order
+and their buckets read back in that order, so rows keep their order within a
+bucket (later rows still shadow earlier ones with the same key).
+"""
+
+import contextlib
+import csv
+import mmap
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .compression import detect_compression, open_decompressed
+from .engines import ENGINES
+from .keys import DEFAULT_KEY
+from .matching import CompareSpec, link_sections
+from .reconciliation_engine import (
+    CHUNK_SIZE,
+    NormalizationCache,
+    build_partition_key,
+    iter_chunks,
+    iter_lines,
+    normalize_records,
+)
+from .records import plain_sections
+from .storage import SECTIONS
+
+# Rows are pickled to the bucket files in batches of this size
+BATCH_SIZE = 1000
+
+# Quotes are counted over slices of this size, so the file is never copied whole
+COUNT_SIZE = 2**20
+
+
+def _bucket(key, partitions):
+    # Every worker process salts `hash` differently, so keys are routed by a
+    # checksum that is the same in all of them
+    return zlib.crc32(repr(key).encode()) % partitions
+
+
+def partition_rows(rows, partitions, directory, prefix, key=None):
+    """
+    Spread raw CSV rows over `partitions` bucket files by the checksum of their
+    normalized `key` (an `api.keys.KeySpec`) and return the paths of the bucket
+    files.
+    """
+    paths = [os.path.join(directory, f'{prefix}-{i}.bucket') for i in range(partitions)]
+    files = [open(path, 'wb') for path in paths]
+    batches = [[] for _ in range(partitions)]
+    try:
+        for row in rows:
+            bucket = _bucket(build_partition_key(row, key), partitions)
+            batch = batches[bucket]
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                pickle.dump(batch, files[bucket], protocol=pickle.HIGHEST_PROTOCOL)
+                batch.clear()
+
+        for batch, f in zip(batches, files):
+            if batch:
+                pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+
+    return paths
+
+
+def _read_bucket(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+
+def upload_path(file_obj, directory, prefix):
+    """
+    The path of an upload as a plain CSV file that workers can read ranges of:
+    the file the upload is kept in when there is one and it is not compressed,
+    or else a decompressed copy written to `directory`.
+    """
+    file_obj.seek(0)
+    if detect_compression(file_obj) is None:
+        if hasattr(file_obj, 'temporary_file_path'):
+            return file_obj.temporary_file_path()
+        # A file opened straight from disk, as the benchmarks and jobs do
+        with contextlib.suppress(AttributeError, TypeError, OSError, ValueError):
+            path = file_obj.name
+            if os.path.isabs(path) and os.path.samestat(
+                os.fstat(file_obj.fileno()), os.stat(path)
+            ):
+                return path
+
+    path = os.path.join(directory, f'{prefix}.csv')
+    with open(path, 'wb') as f:
+        for chunk in iter_chunks(open_decompressed(file_obj)):
+            f.write(chunk)
+
+    return path
+
+
+def _count(data, value, start, end):
+    return sum(
+        data[position : min(position + COUNT_SIZE, end)].count(value)
+        for position in range(start, end, COUNT_SIZE)
+    )
+
+
+def split_records(path, parts):
+    """
+    Split the CSV at `path` into its header row and up to `parts` byte ranges of
+    whole records, of about the same size. Quoted fields may hold newlines, but
+    quotes inside them are doubled, so a newline ends a record when the number
+    of quotes before it is even. Quotes are counted in bulk over the mapped file,
+    without parsing it. Returns `(fieldnames, [(start, end), ...])`.
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return None, []
+
+    with (
+        open(path, 'rb') as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        ends = []
+        position = quotes = 0
+        # The first record is the header
+        for target in (0, *(size * part // parts for part in range(1, parts))):
+            if ends and target < position:
+                continue
+            quotes += _count(data, b'"', position, target)
+            position = target
+            while position < size:
+                newline = data.find(b'\n', position)
+                if newline == -1:
+                    position = size
+                    break
+                quotes += _count(data, b'"', position, newline)
+                position = newline + 1
+                if quotes % 2 == 0:
+                    break
+            ends.append(position)
+        header = data[: ends[0]]
+
+    fieldnames = next(csv.reader(iter_lines([header])), None)
+    ranges = [
+        (start, end) for start, end in zip(ends, (*ends[1:], size)) if start < end
+    ]
+
+    return fieldnames, ranges
+
+
+def _read_range(f, start, end):
+    f.seek(start)
+    while start < end and (chunk := f.read(min(CHUNK_SIZE, end - start))):
+        start += len(chunk)
+        yield chunk
+
+
+def partition_range(path, fieldnames, start, end, partitions, directory, prefix, key):
+    """
+    Parse the records between `start` and `end` of the CSV at `path` and spread
+    them over `partitions` bucket files (see `partition_rows`). This runs inside
+    a worker process, and returns the paths of the buckets, how many rows it read
+    and the CPU time it took.
+    """
+    started = time.process_time()
+    rows = 0
+
+    def counted(records):
+        nonlocal rows
+        for record in records:
+            rows += 1
+            yield record
+
+    with open(path, 'rb') as f:
+        records = csv.DictReader(
+            iter_lines(_read_range(f, start, end)), fieldnames=fieldnames
+        )
+        paths = partition_rows(counted(records), partitions, directory, prefix, key=key)
+
+    return paths, rows, time.process_time() - started
+
+
+def _read_buckets(paths):
+    for path in paths:
+        yield from _read_bucket(path)
+
+
+def reconcile_partition(source_paths, target_paths, engine, key, compare):
+    """
+    Normalize and reconcile one bucket pair, each side read from its bucket files
+    in order. This runs inside a worker process, so it gets its own normalization
+    cache and returns its counters, along with the CPU time it took (which the
+    parent's thread clock never sees).
+    """
+    started = time.process_time()
+    cache = NormalizationCache()
+    source_data = normalize_records(_read_buckets(source_paths), cache=cache)
+    target_data = normalize_records(_read_buckets(target_paths), cache=cache)
+    fields, *sections = ENGINES[engine](
+        source_data, target_data, key=key.function, compare=compare.functions
+    )
+
+    sections = plain_sections(sections)
+
+    return (fields, *sections, cache.stats(), time.process_time() - started)
+
+
+def reconcile_partitioned(
+    source_file,
+    target_file,
+    engine='hash',
+    workers=None,
+    cache=None,
+    progress=None,
+    instrumentation=None,
+    key=None,
+    compare=None,
+    fuzzy=None,
+):
+    """
+    Reconcile two uploads across a pool of `workers` processes (defaults to
+    `settings.RECONCILIATION_WORKERS`), matching records on `key` and comparing
+    fields with `compare`, and return the merged `(fields, *sections)` with the
+    sections in `SECTIONS` order. A typo can send the two records it splits to
+    different buckets, so `fuzzy` linking runs on the merged results. An optional
+    `api.pipeline.Progress` is kept up to date with the rows read per side, and
+    an optional `api.instrumentation.Instrumentation` times the partition phase
+    (parsing happens in the workers, as part of it) and the reconcile phase
+    (normalization happens in the workers, as part of it). Both are charged the
+    CPU time of the workers too.
+    """
+    workers = workers or settings.RECONCILIATION_WORKERS
+    key = key or DEFAULT_KEY
+    compare = compare or CompareSpec()
+    fields = set()
+    sections = [[] for _ in SECTIONS]
+
+    if instrumentation is not None:
+        partition_phase = instrumentation.phase('partition')
+        reconcile_phase = instrumentation.phase('reconcile')
+        link_phase = instrumentation.phase('link')
+    else:
+        partition_phase = reconcile_phase = link_phase = contextlib.nullcontext()
+
+    # Spawned (rather than forked) workers are safe to start from a threaded server
+    with (
+        tempfile.TemporaryDirectory(prefix='reconciliation-') as directory,
+        ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn')
+        ) as executor,
+    ):
+        with partition_phase as partition_stats:
+            ranges = {}
+            for side, file_obj in (('source', source_file), ('target', target_file)):
+                path = upload_path(file_obj, directory, side)
+                fieldnames, side_ranges = split_records(path, workers)
+                ranges[side] = [
+                    executor.submit(
+                        partition_range,
+                        path,
+                        fieldnames,
+                        start,
+                        end,
+                        workers,
+                        directory,
+                        f'{side}-{i}',
+                        key,
+                    )
+                    for i, (start, end) in enumerate(side_ranges)
+                ]
+
+            # side -> the bucket files of every partition, in file order
+            buckets = {}
+            for side, futures in ranges.items():
+                buckets[side] = [[] for _ in range(workers)]
+                for future in futures:
+                    paths, rows, cpu = future.result()
+                    for partition, path in zip(buckets[side], paths):
+                        partition.append(path)
+                    if progress is not None:
+                        progress.counters[f'{side}_rows'] += rows
+                    if partition_stats is not None:
+                        partition_stats.rows += rows
+                        partition_stats.cpu += cpu
+        if progress is not None:
+            progress.advance('reconciling')
+
+        with reconcile_phase as reconcile_stats:
+            partitions = executor.map(
+                reconcile_partition,
+                buckets['source'],
+                buckets['target'],
+                [engine] * workers,
+                [key] * workers,
+                [compare] * workers,
+            )
+            for p_fields, *p_sections, stats, cpu in partitions:
+                fields.update(p_fields)
+                for section, p_section in zip(sections, p_sections):
+                    section.extend(p_section)
+                if cache is not None:
+                    cache.merge(stats)
+                if reconcile_stats is not None:
+                    reconcile_stats.cpu += cpu
+
+    if fuzzy is not None:
+        with link_phase:
+            sections = link_sections(
+                fields, sections, key, compare=compare.functions, threshold=fuzzy
+            )
+
+    return fields, *sections
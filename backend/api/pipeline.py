@@ -0,0 +1,173 @@
+"""
+The end to end reconciliation run shared by the synchronous endpoint and the
+background jobs: parse -> normalize -> reconcile -> store, reporting progress as
+it goes, and timing every phase.
+"""
+
+from .incremental import reconcile_incremental
+from .instrumentation import METRICS, Instrumentation
+from .parallel import reconcile_partitioned
+from .reconciliation_engine import (
+    NormalizationCache,
+    NormalizedCSV,
+    iter_csv,
+    normalize_records,
+    reconcile_data,
+    store_report,
+)
+from .storage import SECTIONS, get_report_store
+
+PHASES = ('queued', 'parsing', 'normalizing', 'reconciling', 'rendering', 'done')
+
+
+class Progress:
+    """
+    Tracks which phase a run is in and how many rows it has gone through. It is
+    written by the thread doing the work and read by whoever polls it.
+    `on_change` is called with True when the phase changes, and with False every
+    `TRACK_EVERY` rows.
+    """
+
+    TRACK_EVERY = 10_000
+
+    def __init__(self, on_change=None):
+        self.phase = 'queued'
+        self.counters = {'source_rows': 0, 'target_rows': 0}
+        self.on_change = on_change
+
+    def advance(self, phase):
+        self.phase = phase
+        if self.on_change is not None:
+            self.on_change(True)
+
+    def track(self, rows, counter):
+        """Pass `rows` through, counting them under `counter`."""
+        counters = self.counters
+        if self.on_change is None:
+            for row in rows:
+                counters[counter] += 1
+                yield row
+            return
+
+        for count, row in enumerate(rows, start=1):
+            counters[counter] += 1
+            if count % self.TRACK_EVERY == 0:
+                self.on_change(False)
+            yield row
+
+    def as_dict(self):
+        return {'phase': self.phase, 'counters': dict(self.counters)}
+
+
+class _TrackedCSV(NormalizedCSV):
+    # Rows are parsed and normalized as the engine pulls them, so the phase moves
+    # to normalizing on the first row and to reconciling once the input runs out
+    def __init__(self, file_obj, cache, progress, counter, instrumentation):
+        super().__init__(file_obj, cache=cache)
+        self.progress = progress
+        self.counter = counter
+        self.instrumentation = instrumentation
+
+    def __iter__(self):
+        self.progress.counters[self.counter] = 0
+        self.progress.advance('normalizing')
+        self.file_obj.seek(0)
+        rows = self.instrumentation.iterate('parse', iter_csv(self.file_obj))
+        records = self.instrumentation.iterate(
+            'normalize', normalize_records(rows, cache=self.cache)
+        )
+        yield from self.progress.track(records, self.counter)
+        self.progress.advance('reconciling')
+
+
+def run_reconciliation(
+    source_file,
+    target_file,
+    engine='hash',
+    partitioned=False,
+    cache=None,
+    progress=None,
+    instrumentation=None,
+    key=None,
+    compare=None,
+    fuzzy=None,
+    previous=None,
+    delta=False,
+    snapshot=False,
+):
+    """
+    Reconcile two uploaded CSV files, matching records on `key` (an
+    `api.keys.KeySpec`) and comparing fields with `compare` (an
+    `api.matching.CompareSpec`), optionally linking missing records whose score
+    is at least `fuzzy`, and store the report.
+
+    Runs that build on a `previous` report, or keep a `snapshot` to be built on,
+    go through `api.incremental.reconcile_incremental` instead of an engine (and
+    without partitions or fuzzy linking); `delta` says the uploads only hold the
+    changed rows. Returns `(report_id, fields, changes, *sections)` with what
+    changed since the previous report (empty for other runs) and the sections in
+    `SECTIONS` order. The phases are timed with `instrumentation` and added to
+    `METRICS`.
+    """
+    cache = cache if cache is not None else NormalizationCache()
+    progress = progress if progress is not None else Progress()
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    progress.advance('parsing')
+    changes = {}
+
+    with instrumentation.tracing():
+        if previous is not None or snapshot:
+            report_id, fields, changes, *sections = reconcile_incremental(
+                source_file,
+                target_file,
+                key=key,
+                compare=compare,
+                previous=previous,
+                delta=delta,
+                cache=cache,
+                progress=progress,
+                instrumentation=instrumentation,
+            )
+        elif partitioned:
+            # Partitions are normalized and reconciled in a pool of worker processes
+            fields, *sections = reconcile_partitioned(
+                source_file,
+                target_file,
+                engine=engine,
+                cache=cache,
+                progress=progress,
+                instrumentation=instrumentation,
+                key=key,
+                compare=compare,
+                fuzzy=fuzzy,
+            )
+            progress.advance('rendering')
+            with instrumentation.phase('store'):
+                report_id = store_report(fields, *sections, key=key)
+            get_report_store().save_metrics(report_id, instrumentation.as_dict())
+        else:
+            source_data = _TrackedCSV(
+                source_file, cache, progress, 'source_rows', instrumentation
+            )
+            target_data = _TrackedCSV(
+                target_file, cache, progress, 'target_rows', instrumentation
+            )
+            report_id, fields, *sections = reconcile_data(
+                source_data,
+                target_data,
+                engine=engine,
+                key=key,
+                instrumentation=instrumentation,
+                compare=compare,
+                fuzzy=fuzzy,
+            )
+            progress.advance('rendering')
+
+    METRICS.record(instrumentation)
+
+    progress.counters.update(
+        (section, len(records)) for section, records in zip(SECTIONS, sections)
+    )
+
+    return report_id, fields, changes, *sections
@@ -1,12 +1,71 @@
+import calendar
+import codecs
+import collections
 import csv
 import datetime
-import io
+import itertools
+import operator
+import re
 
 from django.template import loader
 
-# Temporary in-memory database
-# Key = report_id (string/UUID), Value = reconciliation results (dict, etc.)
-REPORTS = {}
+from .compression import open_decompressed
+from .engines import ENGINES
+from .instrumentation import Instrumentation
+from .keys import DEFAULT_KEY
+from .matching import CompareSpec, link_sections
+from .records import plain_sections, record_type
+from .storage import SECTIONS, get_report_store
+
+# The sections that hold whole records, as opposed to discrepancies
+RECORD_SECTIONS = tuple(section for section in SECTIONS if section != 'discrepancies')
+
+# Size of the byte chunks we pull from an upload at a time (64 KB, Django's default)
+CHUNK_SIZE = 64 * 2**10
+
+
+def iter_chunks(file_obj, chunk_size=None):
+    """
+    Yield the raw bytes of an uploaded file in chunks. Django's `UploadedFile`
+    knows how to chunk itself (from memory or from a temporary file), anything
+    else file-like is read in `chunk_size` pieces.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    if hasattr(file_obj, 'chunks'):
+        yield from file_obj.chunks(chunk_size)
+        return
+
+    while chunk := file_obj.read(chunk_size):
+        yield chunk
+
+
+def iter_lines(chunks, encoding='utf-8'):
+    """
+    Incrementally decode byte chunks and yield complete lines (with their line
+    endings) so they can be fed straight into the csv module. Multi-byte
+    characters split across chunk boundaries are handled by the incremental
+    decoder, so only one chunk and one partial line are ever held in memory.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def iter_csv(file_obj):
+    """
+    Stream CSV rows from an uploaded file as dictionaries with headers as keys.
+    Rows are produced one at a time, so memory does not grow with file size.
+    Compressed uploads are decompressed as they are read (see `api.compression`).
+    """
+    return csv.DictReader(iter_lines(iter_chunks(open_decompressed(file_obj))))
 
 
 def parse_csv(file_obj):
@@ -14,39 +73,248 @@ def parse_csv(file_obj):
     Read CSV from an uploaded file and return a list of dictionaries.
     Each dictionary is one row of the CSV with headers as keys.
     """
-    data = file_obj.read().decode('utf-8', errors='ignore')
-    # We use StringIO to treat the string data as a file-like object
-    csv_data = csv.DictReader(io.StringIO(data))
+    return list(iter_csv(file_obj))
 
-    return list(csv_data)
 
+# Mirrors exactly what `datetime.strptime(value, '%Y-%m-%d')` accepts, so dates can be
+# recognised without raising and catching a ValueError for every other cell
+DATE_PATTERN = re.compile(
+    r'(\d\d\d\d)-(1[0-2]|0[1-9]|[1-9])-(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])'
+)
+DATE_FORMAT = '%a, %-d %B, %Y'
+NUMERIC_PATTERN = re.compile(r'[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?')
 
-def normalize_record(record):
+# How many leading rows we look at to work out what each column holds
+SAMPLE_SIZE = 100
+
+# How many distinct normalized values we remember per column
+CACHE_SIZE = 4096
+
+
+def _format_date(match, value):
+    year, month, day = int(match[1]), int(match[2]), int(match[3])
+    # Impossible calendar dates (e.g. 2025-02-30) are not dates, just like strptime
+    if year < 1 or (day > 28 and day > calendar.monthrange(year, month)[1]):
+        return value.lower()
+
+    return datetime.datetime(year, month, day).strftime(DATE_FORMAT)
+
+
+def _normalize_date_value(value):
+    """Normalize a cell from a column that mostly holds dates."""
+    if value is None:
+        return None
+
+    value = value.strip()
+    match = DATE_PATTERN.fullmatch(value)
+    if match:
+        return _format_date(match, value)
+
+    return value.lower()
+
+
+def _normalize_value(value):
     """
-    Perform any normalization needed (trimming, lower-casing, date-formatting, etc.)
-    and return the cleaned record.
+    Normalize a cell from any other column. A cheap fixed-width check (dates are 8
+    to 10 characters with a dash after the year) gates the date regex.
     """
-    normalized = {}
-    for k, v in record.items():
-        if v is None:
-            normalized[k] = None
-            continue
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value[4:5] == '-' and 8 <= len(value) <= 10:
+        match = DATE_PATTERN.fullmatch(value)
+        if match:
+            return _format_date(match, value)
+
+    return value.lower()
+
+
+def infer_column_type(name, values):
+    """
+    Guess what a column holds ('date', 'numeric', 'id' or 'text') from its name
+    and a sample of its raw values.
+    """
+    if isinstance(name, str) and (name.lower() == 'id' or name.lower().endswith('_id')):
+        return 'id'
+
+    values = [v.strip() for v in values if isinstance(v, str) and v.strip()]
+    if not values:
+        return 'text'
+    if all(DATE_PATTERN.fullmatch(v) for v in values):
+        return 'date'
+    if all(NUMERIC_PATTERN.fullmatch(v) for v in values):
+        return 'numeric'
 
-        # Trim spaces
-        v_clean = v.strip()
+    return 'text'
 
-        # Let us attempt to parse the date or any other data format we want to parse
-        try:
-            parsed_date = datetime.datetime.strptime(v_clean, '%Y-%m-%d')
-            # reformat to a standard ISO date
-            v_clean = parsed_date.strftime('%a, %-d %B, %Y')
-        except ValueError:
-            # If not a date, just do case normalization.
-            v_clean = v_clean.lower()
 
-        normalized[k] = v_clean
+class NormalizationCache:
+    """
+    Per-column intern tables of raw cell value -> normalized value. Ledgers repeat
+    a small set of values (currencies, statuses, dates...) so each distinct value
+    is normalized once and every occurrence shares the same string object. A table
+    stops growing once it holds `max_size` values, which keeps high-cardinality
+    columns from eating memory.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or CACHE_SIZE
+        self.tables = {}
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+    def wrap(self, column, transform):
+        """Return `transform` memoized through the intern table of `column`."""
+        table = self.tables.setdefault(column, {})
+        max_size = self.max_size
+
+        def normalize(value):
+            normalized = table.get(value, table)
+            if normalized is not table:
+                self.hits += 1
+                return normalized
+
+            self.misses += 1
+            normalized = transform(value)
+            if len(table) < max_size:
+                table[value] = normalized
+                self.size += 1
 
-    return normalized
+            return normalized
+
+        return normalize
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'size': self.size,
+        }
+
+    def merge(self, stats):
+        """Add the counters of another cache (e.g. from a worker process)."""
+        self.hits += stats['hits']
+        self.misses += stats['misses']
+        self.size += stats['size']
+
+
+class RecordNormalizer:
+    """
+    A normalizer compiled once per file: every column gets a transform picked
+    from its inferred type, and rows are then normalized without any per-cell
+    exception handling. The output equals that of `normalize_record`, but rows
+    that have exactly the columns the normalizer was built with come out as
+    compact `api.records.Record`s (anything else stays a dict).
+
+    When given a `NormalizationCache`, every column except identifiers (which
+    never repeat) is memoized through it.
+    """
+
+    TRANSFORMS = {
+        'date': _normalize_date_value,
+        'numeric': _normalize_value,
+        'id': _normalize_value,
+        'text': _normalize_value,
+    }
+
+    def __init__(self, column_types, cache=None):
+        self.column_types = dict(column_types)
+        transforms = {}
+        for column, column_type in self.column_types.items():
+            transform = self.TRANSFORMS[column_type]
+            if cache is not None and column_type != 'id':
+                transform = cache.wrap(column, transform)
+            transforms[column] = transform
+
+        # Columns we have not seen in the sample fall back to the generic transform
+        self._transforms = collections.defaultdict(lambda: _normalize_value, transforms)
+
+        columns = tuple(self.column_types)
+        self._record = record_type(columns)
+        self._width = len(columns)
+        self._column_transforms = [transforms[column] for column in columns]
+        self._values = None
+        if len(columns) > 1:
+            self._values = operator.itemgetter(*columns)
+        elif columns:
+            (column,) = columns
+            self._values = lambda row: (row[column],)
+
+    @classmethod
+    def from_sample(cls, rows, fieldnames=None, cache=None):
+        """Build a normalizer from the header and a sample of rows."""
+        columns = dict.fromkeys(fieldnames or ())
+        for row in rows:
+            columns.update(dict.fromkeys(row))
+
+        return cls(
+            {
+                column: infer_column_type(column, [row.get(column) for row in rows])
+                for column in columns
+            },
+            cache=cache,
+        )
+
+    def __call__(self, record):
+        if self._values is not None and len(record) == self._width:
+            try:
+                values = self._values(record)
+            except KeyError:
+                pass
+            else:
+                return self._record(
+                    [
+                        transform(value)
+                        for transform, value in zip(self._column_transforms, values)
+                    ]
+                )
+
+        transforms = self._transforms
+        return {k: transforms[k](v) for k, v in record.items()}
+
+
+def normalize_records(rows, sample_size=None, cache=None):
+    """
+    Lazily normalize a stream of rows. The first `sample_size` rows are used to
+    compile a `RecordNormalizer` which is then applied to the whole stream. Pass
+    the same `cache` when normalizing both sides of a reconciliation so they share
+    their normalized values.
+    """
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, sample_size or SAMPLE_SIZE))
+    normalizer = RecordNormalizer.from_sample(
+        sample, fieldnames=getattr(rows, 'fieldnames', None), cache=cache
+    )
+
+    return map(normalizer, itertools.chain(sample, rows))
+
+
+class NormalizedCSV:
+    """
+    The normalized records of an uploaded CSV as a re-iterable stream: every
+    iteration reads the file again from the start, so engines that need more than
+    one pass (e.g. to check the sort order) never hold the whole file in memory.
+    """
+
+    def __init__(self, file_obj, cache=None):
+        self.file_obj = file_obj
+        self.cache = cache
+
+    def __iter__(self):
+        self.file_obj.seek(0)
+        return normalize_records(iter_csv(self.file_obj), cache=self.cache)
+
+
+def normalize_record(record):
+    """
+    Perform any normalization needed (trimming, lower-casing, date-formatting, etc.)
+    and return the cleaned record.
+    """
+    return {k: _normalize_value(v) for k, v in record.items()}
 
 
 def build_key(record):
@@ -58,91 +326,158 @@ def build_key(record):
     return record.get('id')
 
 
-def reconcile_data(source_data, target_data):
+def build_partition_key(record, key=None):
+    """
+    The key of a raw, not yet normalized, record normalized the same way the
+    record itself will be. Used to route rows before they are normalized.
+    """
+    key = key or DEFAULT_KEY
+    normalized = {
+        column: _normalize_value(record.get(column)) for column in key.columns
+    }
+
+    return key.function(normalized)
+
+
+def reconcile_data(
+    source_data,
+    target_data,
+    engine='hash',
+    key=None,
+    instrumentation=None,
+    compare=None,
+    fuzzy=None,
+):
     """
-    Given two lists of normalized dictionaries, return:
+    Given two iterables of normalized dictionaries, match them on `key` (an
+    `api.keys.KeySpec`, the 'id' column by default) and return the report id,
+    the fields seen and the report sections:
     - records_missing_in_target
     - records_missing_in_source
     - discrepancies: a list of (key, differences_dict) where differences_dict
       shows which fields differ
+    - duplicates_in_source/duplicates_in_target: records shadowed by a later
+      record with the same key
+
+    `engine` picks how the comparison is done (see `api.engines.ENGINES`), all
+    engines produce the same results. Fields in `compare` (an
+    `api.matching.CompareSpec`) are compared with a tolerance, and when `fuzzy`
+    is a score threshold, records missing on both sides are linked with
+    `api.matching.link_records`. The reconcile and store phases are timed
+    with `instrumentation`, and what it recorded is stored with the report.
     """
-    # Build dictionaries keyed by some unique ID or combination
-    source_dict = {build_key(r): r for r in source_data}
-    target_dict = {build_key(r): r for r in target_data}
-
-    source_keys = set(source_dict.keys())
-    target_keys = set(target_dict.keys())
-
-    # Missing in target => in source but not in target
-    missing_in_target = []
-    for key in source_keys.difference(target_keys):
-        missing_in_target.append(source_dict[key])
-
-    # Missing in source => in target but not in source
-    missing_in_source = []
-    for key in target_keys.difference(source_keys):
-        missing_in_source.append(target_dict[key])
-
-    # Discrepancies => records that exist in both but differ in at least one field
-    discrepancies = []
-    intersection_keys = source_keys.intersection(target_keys)
-    fields = set()
-    for key in intersection_keys:
-        s_record = source_dict[key]
-        t_record = target_dict[key]
-
-        # Compare field by field
-        record_diffs = {}
-        all_fields = set(s_record.keys()).union(set(t_record.keys()))
-        for field in all_fields:
-            fields.add(field)
-            s_val = s_record.get(field)
-            t_val = t_record.get(field)
-            if s_val != t_val:
-                record_diffs[field] = {'source': s_val, 'target': t_val}
-
-        if record_diffs:
-            discrepancies.append({'id': key, 'differences': record_diffs})
-
-    if len(REPORTS) > 0:
-        report_id = str(max(int(key) for key in REPORTS.keys()) + 1)
-    else:
-        report_id = '1'
-
-    REPORTS[report_id] = {
+    key = key or DEFAULT_KEY
+    compare = compare or CompareSpec()
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+
+    with instrumentation.phase('reconcile'):
+        fields, *sections = ENGINES[engine](
+            source_data, target_data, key=key.function, compare=compare.functions
+        )
+        sections = plain_sections(sections)
+    if fuzzy is not None:
+        with instrumentation.phase('link'):
+            sections = link_sections(
+                fields, sections, key, compare=compare.functions, threshold=fuzzy
+            )
+    with instrumentation.phase('store'):
+        report_id = store_report(fields, *sections, key=key)
+    get_report_store().save_metrics(report_id, instrumentation.as_dict())
+
+    return report_id, fields, *sections
+
+
+def store_report(
+    fields,
+    *sections,
+    key=None,
+    metrics=None,
+    previous=None,
+    changes=None,
+    base=None,
+    field_counts=None,
+):
+    """
+    Save the results of a reconciliation (its sections in `SECTIONS` order), the
+    key records were matched on and the metrics of the run that produced them,
+    and return the id of the new report. Incremental runs also save the report
+    they were built on and what changed since, and can store the report on top of
+    a `base` report with its `field_counts` (see `api.incremental`).
+    """
+    report = {
         'fields': fields,
-        'missing_in_target': missing_in_target,
-        'missing_in_source': missing_in_source,
-        'discrepancies': discrepancies,
-        'created_at': datetime.datetime.now(),
+        **dict(zip(SECTIONS, sections)),
+        'key': str(key or DEFAULT_KEY),
+        'metrics': metrics or {},
+        'previous': previous,
+        'changes': changes or {},
+        'base': base,
     }
+    if field_counts is not None:
+        report['field_counts'] = field_counts
 
-    return report_id, fields, missing_in_target, missing_in_source, discrepancies
+    return get_report_store().save(report)
 
 
-def generate_csv(results):
+class _Echo:
+    """A file-like object that hands back whatever is written to it."""
+
+    def write(self, value):
+        return value
+
+
+def generate_csv(results, fields=(), key=None):
     """
-    Turn the results dictionary into a CSV file in-memory and return it.
+    Turn the results dictionary into CSV lines, yielded one row at a time so they
+    can be streamed out. Every record field gets its own column: missing and
+    duplicate records fill in their fields, discrepancies get one row per
+    differing field with its source and target values. Records are keyed with
+    `key`, the `api.keys.KeySpec` they were matched on.
     """
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Section', 'Record'])
+    key = key or DEFAULT_KEY
+    key_function = key.function
 
-    for record in results['missing_in_target']:
-        writer.writerow(['missing_in_target', record])
-    for record in results['missing_in_source']:
-        writer.writerow(['missing_in_source', record])
-    for discrepancy in results['discrepancies']:
-        writer.writerow(['discrepancy', discrepancy])
+    # The columns are known up front from the compared fields and the first
+    # record of each record section
+    columns = dict.fromkeys(sorted(fields, key=str))
+    for section in RECORD_SECTIONS:
+        for record in itertools.islice(results.get(section, ()), 1):
+            columns.update(dict.fromkeys(record))
+    columns = [column for column in columns if column is not None]
+
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['section', 'key', 'field', 'source', 'target', *columns])
+
+    for section in SECTIONS:
+        if section != 'discrepancies':
+            for record in results.get(section, ()):
+                yield writer.writerow(
+                    [section, key.format(key_function(record)), '', '', '']
+                    + [record.get(column) for column in columns]
+                )
+            continue
 
-    return output
+        for discrepancy in results[section]:
+            for field, difference in discrepancy['differences'].items():
+                yield writer.writerow(
+                    [
+                        'discrepancy',
+                        key.format(discrepancy['id']),
+                        field,
+                        difference['source'],
+                        difference['target'],
+                    ]
+                )
 
 
-def generate_html(results):
+def generate_html(context):
     """
-    Convert the results into minimal HTML.
+    Render the HTML report page from a summary context (the report id, section
+    counts, field histogram and section URLs). The records themselves are not
+    rendered here, the page pages them in from the JSON API as they are scrolled.
     """
     template = loader.get_template('reconciliation-rich.html')
-    html = template.render(results)
+    html = template.render(context)
 
     return html
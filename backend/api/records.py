@@ -0,0 +1,136 @@
+"""
+Compact records. The normalized rows are most of what a reconciliation holds in
+memory, and a dict per row spends more on its hash table than on its values
+(280 bytes for six columns, against 104 for a tuple of them). So normalized rows
+are tuples of their values instead, of a `Record` class made once per header
+(see `record_type`) which holds the column names and their positions.
+
+Records read like the dicts they replace: `record['id']`, `get`, `keys`,
+`items`, `in` and iterating all go by column, and a record equals a dict with
+the same items, so engines, key functions and exporters take either. json does
+not take them for dicts though: they are tuples that iterate over their columns,
+so `json.dumps(record)` quietly gives the list of their column names. Engine
+results are turned back into dicts by `plain_sections` as they come out, which
+is the one place records leave their sections, so what is stored or rendered
+after it needs no further check.
+
+`benchmarks.records` measures a peak about 1.5 times lower than with dicts, for
+every engine, short of the 3 times this set out to reach: the values themselves
+are most of what is left.
+"""
+
+import copyreg
+import functools
+
+from .storage import SECTIONS
+
+# How many record classes (one per distinct header) are kept around
+RECORD_TYPES = 256
+
+
+class RecordType(type):
+    """
+    The type of record classes. They are made on the fly, so they cannot be
+    pickled by name: pickles rebuild them from their columns instead.
+    """
+
+
+class Record(tuple, metaclass=RecordType):
+    """The values of a row, in the order of the `columns` of its class."""
+
+    __slots__ = ()
+
+    columns = ()
+    _positions = {}
+    _keys = {}.keys()
+    _new = None
+
+    def __getitem__(self, column):
+        return tuple.__getitem__(self, self._positions[column])
+
+    def get(self, column, default=None):
+        position = self._positions.get(column)
+        if position is None:
+            return default
+
+        return tuple.__getitem__(self, position)
+
+    def __contains__(self, column):
+        return column in self._positions
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def keys(self):
+        return self._keys
+
+    def values(self):
+        return tuple.__iter__(self)
+
+    def items(self):
+        return zip(self.columns, tuple.__iter__(self))
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return tuple.__eq__(self, other)
+        if isinstance(other, (dict, Record)):
+            return dict(self.items()) == dict(other.items())
+
+        # Not NotImplemented, or tuples would compare by their values
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    # Unhashable, like the dicts they stand in for
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        return self._new, tuple.__getnewargs__(self)
+
+
+@functools.lru_cache(maxsize=RECORD_TYPES)
+def record_type(columns):
+    """The `Record` class of a header (a tuple of column names)."""
+    cls = RecordType(
+        'Record',
+        (Record,),
+        {
+            '__slots__': (),
+            'columns': columns,
+            '_positions': {column: i for i, column in enumerate(columns)},
+            '_keys': dict.fromkeys(columns).keys(),
+        },
+    )
+    # What records unpickle through. Pickles hold it (and so the class) once and
+    # every record as just its values
+    cls._new = functools.partial(tuple.__new__, cls)
+
+    return cls
+
+
+copyreg.pickle(RecordType, lambda cls: (record_type, (cls.columns,)))
+
+
+def as_dict(record):
+    """A record as a plain dict, dicts are returned as they are."""
+    if isinstance(record, Record):
+        return dict(record.items())
+
+    return record
+
+
+def plain_sections(sections):
+    """
+    Engine results (sections in `SECTIONS` order) with their records as dicts.
+    Every engine result goes through here before it is linked, stored or
+    rendered. Discrepancies hold values rather than records and are kept as they
+    are.
+    """
+    return [
+        section if name == 'discrepancies' else list(map(as_dict, section))
+        for name, section in zip(SECTIONS, sections)
+    ]
@@ -0,0 +1,251 @@
+"""
+Report segments: a report written once, by appending, to a single file that is
+read back through `mmap`. The file holds
+
+    the records         every entry of every section, as compact JSON, in order
+    the offset index    per section, where each of its entries starts and ends
+    the key index       per section, its formatted keys in sorted order with the
+                        position of their entry
+    the footer          the rest of the report (fields, key, metrics, counts...)
+                        and where the indexes are, as JSON, then its length
+
+Opening a segment only reads its footer. The indexes are used in place, as
+memoryviews over the mapping, and an entry is only decoded when it is indexed,
+so reading a page of a section, or a key range through the key index, costs the
+same for any size of report and the process only ever holds the pages it read.
+"""
+
+import array
+import bisect
+import collections.abc
+import json
+import mmap
+import os
+import struct
+import sys
+
+from .storage import Section
+
+MAGIC = b'RECSEG1\x00'
+
+# The footer length, at the very end of the file
+FOOTER_LENGTH = struct.Struct('<Q')
+
+# Indexes are arrays of unsigned 64 bit offsets, aligned on their size
+OFFSET = 'Q'
+ALIGN = array.array(OFFSET).itemsize
+
+
+class SegmentError(ValueError):
+    """A file that is not a complete report segment."""
+
+
+def _encode(entry):
+    return json.dumps(entry, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+class _Writer:
+    # Appends to the segment file, keeping track of where it is
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.position += len(data)
+
+    def align(self):
+        self.write(b'\0' * (-self.position % ALIGN))
+
+    def write_array(self, values):
+        self.align()
+        start = self.position
+        self.write(array.array(OFFSET, values).tobytes())
+
+        return start
+
+
+def write_segment(path, sections, meta, key):
+    """
+    Write the `sections` ({section: entries}) of a report to a segment at
+    `path`, with `meta` (a JSON-serializable dict) in its footer. Entries are
+    keyed with `key`, the `api.keys.KeySpec` they were matched on. The segment is
+    written next to `path` and moved in place once complete, so readers never
+    see half a segment.
+    """
+    partial = f'{path}.partial'
+    index = {}
+
+    with open(partial, 'wb') as f:
+        writer = _Writer(f)
+        writer.write(MAGIC)
+
+        layout = {}
+        for section, entries in sections.items():
+            offsets = array.array(OFFSET, [writer.position])
+            keys = []
+            for position, entry in enumerate(entries):
+                writer.write(_encode(entry))
+                offsets.append(writer.position)
+                formatted = key.entry_key(section, entry)
+                if formatted is not None:
+                    keys.append((str(formatted), position))
+            layout[section] = (offsets, sorted(keys))
+
+        for section, (offsets, keys) in layout.items():
+            key_offsets = array.array(OFFSET, [0])
+            blob = bytearray()
+            for formatted, _ in keys:
+                blob += formatted.encode()
+                key_offsets.append(len(blob))
+
+            blob_start = writer.position
+            writer.write(blob)
+            index[section] = {
+                'count': len(offsets) - 1,
+                'offsets': writer.write_array(offsets),
+                'keys': blob_start,
+                'key_count': len(keys),
+                'key_offsets': writer.write_array(key_offsets),
+                'key_positions': writer.write_array(position for _, position in keys),
+            }
+
+        footer = json.dumps(
+            {**meta, 'byteorder': sys.byteorder, 'sections': index}
+        ).encode()
+        writer.write(footer)
+        writer.write(FOOTER_LENGTH.pack(len(footer)))
+
+    os.replace(partial, path)
+
+
+def read_footer(path):
+    """The footer of the segment at `path`, without mapping the rest of it."""
+    with open(path, 'rb') as f:
+        return _footer(f.read(len(MAGIC)), f)
+
+
+def _footer(head, f):
+    if head != MAGIC:
+        raise SegmentError(f'{f.name} is not a report segment.')
+    size = f.seek(0, os.SEEK_END)
+    if size < len(MAGIC) + FOOTER_LENGTH.size:
+        raise SegmentError(f'{f.name} is truncated.')
+
+    f.seek(size - FOOTER_LENGTH.size)
+    (length,) = FOOTER_LENGTH.unpack(f.read(FOOTER_LENGTH.size))
+    f.seek(size - FOOTER_LENGTH.size - length)
+    footer = json.loads(f.read(length))
+    if footer['byteorder'] != sys.byteorder:
+        raise SegmentError(f'{f.name} was written on a {footer["byteorder"]} machine.')
+
+    return footer
+
+
+class Segment:
+    """
+    A report segment mapped into memory. `meta` is its footer, `sections` maps
+    each section to a `SegmentSection`. The mapping stays open for as long as
+    any of the sections is used.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.meta = _footer(f.read(len(MAGIC)), f)
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapping)
+        self.sections = {}
+        for section, index in self.meta.pop('sections').items():
+            self.sections[section] = SegmentSection(mapping, view, index)
+
+
+def _offsets(view, start, count):
+    return view[start : start + count * ALIGN].cast(OFFSET)
+
+
+class SegmentSection(Section):
+    """
+    One section of a mapped segment, as a read-only sequence of its entries.
+    Entries are decoded when they are indexed or iterated over.
+    """
+
+    def __init__(self, mapping, view, index):
+        self._map = mapping
+        self._offsets = _offsets(view, index['offsets'], index['count'] + 1)
+        self._keys = _Keys(
+            mapping,
+            index['keys'],
+            _offsets(view, index['key_offsets'], index['key_count'] + 1),
+        )
+        self._key_positions = _offsets(view, index['key_positions'], index['key_count'])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _entry(self, position):
+        return json.loads(
+            self._map[self._offsets[position] : self._offsets[position + 1]]
+        )
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._entry(position) for position in range(len(self))[index]]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('section index out of range')
+
+        return self._entry(index)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self._entry(position)
+
+    def key_range(self, key_from=None, key_to=None):
+        """
+        The entries whose formatted key is between `key_from` and `key_to`
+        (inclusive, either may be None), in section order, looked up in the key
+        index rather than scanned for.
+        """
+        start = 0 if key_from is None else bisect.bisect_left(self._keys, key_from)
+        stop = (
+            len(self._keys)
+            if key_to is None
+            else bisect.bisect_right(self._keys, key_to, lo=start)
+        )
+
+        return _Selection(self, sorted(self._key_positions[start:stop]))
+
+
+class _Keys(collections.abc.Sequence):
+    # The sorted keys of a section, decoded as the binary search reads them
+    def __init__(self, mapping, start, offsets):
+        self._map = mapping
+        self._start = start
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._map[
+            self._start + self._offsets[index] : self._start + self._offsets[index + 1]
+        ].decode()
+
+
+class _Selection(Section):
+    # Some of the entries of a section, by position
+    def __init__(self, section, positions):
+        self._section = section
+        self._positions = positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._section[position] for position in self._positions[index]]
+
+        return self._section[self._positions[index]]
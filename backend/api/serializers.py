@@ -1,5 +1,10 @@
+from django.conf import settings
 from rest_framework import serializers
+from .engines import ENGINES
+from .keys import KeySpec
+from .matching import CompareSpec
 from .models import Book
+from .uploads import MAX_CHUNK_SIZE, ChunkedUpload
 
 class BookSerializer(serializers.ModelSerializer):
     class Meta:
@@ -7,10 +12,129 @@ class BookSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 class ReconciliationSerializer(serializers.Serializer):
-    source_file = serializers.FileField(required=True)
-    target_file = serializers.FileField(required=True)
+    source_file = serializers.FileField(required=False)
+    target_file = serializers.FileField(required=False)
+    # The ids of chunked uploads (see `api.uploads`), instead of the files
+    source_upload = serializers.CharField(default=None, required=False, allow_null=True)
+    target_upload = serializers.CharField(default=None, required=False, allow_null=True)
     output_format = serializers.ChoiceField(
-        choices=['json', 'csv', 'html'],
+        choices=['json', 'csv', 'html', 'npz'],
         default='json',
         required=False
     )
+    engine = serializers.ChoiceField(
+        choices=list(ENGINES),
+        default='hash',
+        required=False
+    )
+    partitioned = serializers.BooleanField(default=False, required=False)
+    asynchronous = serializers.BooleanField(default=False, required=False)
+    # The columns records are matched on, e.g. 'account, value_date, reference:alnum'.
+    # Defaults to 'id', or to the key of the previous report
+    key = serializers.CharField(required=False)
+    # Columns compared with a tolerance, e.g. 'amount:numeric=0.01, value_date:date=1'
+    compare = serializers.CharField(default='', required=False, allow_blank=True)
+    # Link records missing on both sides that score at least this (0 to 1)
+    fuzzy = serializers.FloatField(
+        default=None,
+        required=False,
+        allow_null=True,
+        min_value=0,
+        max_value=1
+    )
+
+    # Build on the snapshot of an earlier report, uploading full files or a delta
+    previous = serializers.CharField(default=None, required=False, allow_null=True)
+    delta = serializers.BooleanField(default=False, required=False)
+    # Keep a snapshot of the ledgers, so later runs can build on this one
+    snapshot = serializers.BooleanField(default=False, required=False)
+
+    def validate(self, data):
+        if data.get('delta') and data.get('previous') is None:
+            raise serializers.ValidationError(
+                {'delta': 'Delta uploads need a previous report.'}
+            )
+        # Incremental runs compare the churn key by key, on their own
+        if data.get('previous') is not None or data.get('snapshot'):
+            if data.get('engine', 'hash') != 'hash':
+                raise serializers.ValidationError(
+                    {'engine': 'Incremental runs do not use an engine.'}
+                )
+            if data.get('partitioned'):
+                raise serializers.ValidationError(
+                    {'partitioned': 'Incremental runs are not partitioned.'}
+                )
+            if data.get('fuzzy') is not None:
+                raise serializers.ValidationError(
+                    {'fuzzy': 'Incremental runs do not link records.'}
+                )
+        for side in ('source', 'target'):
+            file, upload = data.get(f'{side}_file'), data.get(f'{side}_upload')
+            if (file is None) == (upload is None):
+                raise serializers.ValidationError(
+                    {f'{side}_file': f'Send either {side}_file or {side}_upload.'}
+                )
+            # Only jobs wait for the rest of an upload, requests would hang
+            if (
+                upload is not None
+                and not upload.is_complete
+                and not data.get('asynchronous')
+            ):
+                raise serializers.ValidationError(
+                    {f'{side}_upload': 'Complete the upload first or run it as a job.'}
+                )
+        return data
+
+    def _validate_upload(self, value):
+        if value is None:
+            return None
+        upload = ChunkedUpload.get(value)
+        if upload is None:
+            raise serializers.ValidationError('Upload not found.')
+        return upload
+
+    def validate_source_upload(self, value):
+        return self._validate_upload(value)
+
+    def validate_target_upload(self, value):
+        return self._validate_upload(value)
+
+    def validate_key(self, value):
+        try:
+            return KeySpec.parse(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+    def validate_compare(self, value):
+        try:
+            return CompareSpec.parse(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+
+class UploadSerializer(serializers.Serializer):
+    size = serializers.IntegerField(min_value=0)
+    chunk_size = serializers.IntegerField(
+        default=None,
+        required=False,
+        allow_null=True,
+        min_value=1,
+        max_value=MAX_CHUNK_SIZE
+    )
+
+    def validate_size(self, value):
+        if value > settings.RECONCILIATION_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(
+                'Ensure this value is less than or equal to '
+                f'{settings.RECONCILIATION_UPLOAD_MAX_SIZE}.'
+            )
+        return value
+
+    def validate_chunk_size(self, value):
+        # Only the last chunk may be smaller, so uploads never have too many chunks
+        if value is not None and value < settings.RECONCILIATION_UPLOAD_MIN_CHUNK_SIZE:
+            raise serializers.ValidationError(
+                'Ensure this value is greater than or equal to '
+                f'{settings.RECONCILIATION_UPLOAD_MIN_CHUNK_SIZE}.'
+            )
+        return value
@@ -0,0 +1,750 @@
+"""
+Report storage backends. The backend in use is picked with the
+`RECONCILIATION_REPORT_STORE` setting: the in-memory dictionary (the default,
+handy for tests and development), the configured Django database, or segment
+files read back through mmap (see `api.segments`). The last two survive restarts
+and are shared by every worker process.
+
+A report can be stored on top of another one, its base (see `LayeredSection`):
+only the positions of the base entries it drops and its own entries are written,
+which is how incremental runs store a report in proportion to the churn.
+"""
+
+import bisect
+import collections
+import collections.abc
+import contextlib
+import dataclasses
+import datetime
+import functools
+import itertools
+import json
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+SECTIONS = (
+    'missing_in_target',
+    'missing_in_source',
+    'discrepancies',
+    'duplicates_in_source',
+    'duplicates_in_target',
+)
+
+CREATED_AT_FORMAT = '%I:%M %p on %a, %-d %B, %Y'
+
+# Temporary in-memory database
+# Key = report_id (string/UUID), Value = reconciliation results (dict, etc.)
+REPORTS = {}
+
+# Lazy sections are read this many entries at a time when iterated over
+PAGE_SIZE = 5000
+
+
+def _frozen(entries):
+    # Lists are copied into tuples, the lazy sequences of the stores kept as is
+    if isinstance(entries, collections.abc.Sequence) and not isinstance(entries, list):
+        return entries
+
+    return tuple(entries)
+
+
+@dataclasses.dataclass(frozen=True)
+class StoredReport:
+    """
+    A stored report. It is immutable and its sections are tuples (or read-only
+    sequences that load their entries lazily, from the database or the segment
+    file), so views can hand them straight to the serializers and exporters
+    without copying them. Reports stored on top of another one have its id and
+    their dropped positions as `base`.
+    """
+
+    id: str
+    created_at: datetime.datetime
+    fields: frozenset
+    missing_in_target: tuple
+    missing_in_source: tuple
+    discrepancies: tuple
+    duplicates_in_source: tuple = ()
+    duplicates_in_target: tuple = ()
+    key: str = 'id'
+    metrics: dict = dataclasses.field(default_factory=dict)
+    previous: str = None
+    changes: dict = dataclasses.field(default_factory=dict)
+    base: dict = None
+
+    @classmethod
+    def build(cls, report_id, created_at, report):
+        return cls(
+            id=report_id,
+            created_at=created_at,
+            fields=frozenset(report['fields']),
+            **{section: _frozen(report.get(section, ())) for section in SECTIONS},
+            key=report.get('key') or 'id',
+            metrics=report.get('metrics') or {},
+            previous=report.get('previous'),
+            changes=report.get('changes') or {},
+            base=report.get('base'),
+        )
+
+    def sections(self):
+        """The {section: records} of the report, sharing the stored records."""
+        return {section: getattr(self, section) for section in SECTIONS}
+
+
+def field_histogram(discrepancies):
+    """
+    Count how many discrepancies each field takes part in, most frequent first.
+    """
+    counts = collections.Counter(
+        itertools.chain.from_iterable(
+            discrepancy['differences'] for discrepancy in discrepancies
+        )
+    )
+
+    return dict(counts.most_common())
+
+
+def _field_counts(report):
+    # Reports stored on top of another one come with their field counts, as they
+    # only hold some of their discrepancies
+    if 'field_counts' in report:
+        return dict(report['field_counts'])
+
+    return field_histogram(report['discrepancies'])
+
+
+@dataclasses.dataclass(frozen=True)
+class ReportSummary:
+    """
+    What listings and summaries show of a report: its section counts, per-field
+    discrepancy counts and display timestamp. Stores work it out once, when the
+    report is saved, so reading it never touches the records.
+    """
+
+    id: str
+    created_at: datetime.datetime
+    created_at_display: str
+    counts: dict
+    fields: dict
+    key: str = 'id'
+
+    @classmethod
+    def build(cls, report_id, created_at, counts, fields, key='id'):
+        return cls(
+            id=report_id,
+            created_at=created_at,
+            created_at_display=created_at.strftime(CREATED_AT_FORMAT),
+            counts=counts,
+            fields=fields,
+            key=key,
+        )
+
+    @classmethod
+    def of(cls, report):
+        """Summarize a `StoredReport`."""
+        return cls.build(
+            report.id,
+            report.created_at,
+            {section: len(getattr(report, section)) for section in SECTIONS},
+            field_histogram(report.discrepancies),
+            report.key,
+        )
+
+
+class ReportStore:
+    """
+    The interface every report storage backend implements. Reports are saved
+    from dicts with 'fields', one list per section in `SECTIONS` and optionally the
+    'key' records were matched on, the 'metrics' of the run and, for incremental
+    runs, the 'previous' report and the 'changes' since, and are read back as
+    `StoredReport`s.
+
+    A report with a 'base' ({'report': id, 'dropped': {section: positions}}) is
+    stored on top of that report: its sections only hold its own entries, which
+    come after the entries of the base that are not dropped, and it comes with
+    its 'field_counts'. The base must not be layered itself, and outlive it.
+    """
+
+    def save(self, report):
+        """Store a report and return its id."""
+        raise NotImplementedError
+
+    def get(self, report_id):
+        """Return the `StoredReport` stored under `report_id`, or None."""
+        raise NotImplementedError
+
+    def save_metrics(self, report_id, metrics):
+        """
+        Replace the metrics of the report stored under `report_id`. The metrics
+        of a run are only complete once its report is stored, so they are saved
+        again after that.
+        """
+        raise NotImplementedError
+
+    def delete(self, report_id):
+        """
+        Remove the report stored under `report_id`, if there is one. Reports
+        stored on top of it can no longer be read.
+        """
+        raise NotImplementedError
+
+    def summary(self, report_id):
+        """
+        Return the `ReportSummary` of the report stored under `report_id`, or None,
+        without loading the report itself.
+        """
+        raise NotImplementedError
+
+    def section(self, report_id, section):
+        """
+        Return the entries of a section of the report stored under `report_id`,
+        as a sequence that can be sliced into pages, or None.
+        """
+        report = self.get(report_id)
+
+        return None if report is None else getattr(report, section)
+
+    def page(self, report_id, section, start, limit):
+        """
+        Return up to `limit` entries of a section of the report stored under
+        `report_id`, from position `start` on, or None when there is no report.
+        """
+        records = self.section(report_id, section)
+
+        return None if records is None else list(records[start : start + limit])
+
+    def entries(self, report_id, section, positions):
+        """
+        Return the entries at `positions` of a section of the report stored under
+        `report_id`, in order of position, or None when there is no report.
+        """
+        records = self.section(report_id, section)
+        if records is None:
+            return None
+
+        return [records[position] for position in sorted(positions)]
+
+    def _layer(self, report, sections):
+        # The sections of a report read back: its own `sections`, on top of its
+        # base when it has one, or None when the base is gone
+        base = report.get('base')
+        if base is None:
+            return sections
+
+        base_report = self.get(base['report'])
+        if base_report is None:
+            return None
+
+        return {
+            section: LayeredSection(
+                getattr(base_report, section),
+                base['dropped'].get(section, ()),
+                sections[section],
+            )
+            for section in SECTIONS
+        }
+
+    def summaries(self):
+        """Return the `ReportSummary` of every report, oldest first."""
+        raise NotImplementedError
+
+
+class Section(collections.abc.Sequence):
+    """
+    The base of the read-only sequences that load the entries of a stored
+    section lazily, instead of holding them in a tuple.
+    """
+
+    def tolist(self):
+        """Every entry, as DRF's JSON encoder renders objects with a `tolist`."""
+        return list(self)
+
+
+class PagedSection(Section):
+    """
+    A section of a stored report of `count` entries, read with `read(start,
+    limit)` a slice at a time as it is sliced or iterated over.
+    """
+
+    def __init__(self, read, count):
+        self.read = read
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return [self[position] for position in range(start, stop, step)]
+            if stop <= start:
+                return []
+            return self.read(start, stop - start)
+
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('section index out of range')
+
+        return self[index : index + 1][0]
+
+    def __iter__(self):
+        for start in range(0, self.count, PAGE_SIZE):
+            yield from self[start : start + PAGE_SIZE]
+
+
+class LayeredSection(Section):
+    """
+    A section of a report stored on top of another one: the entries of the
+    `base` section but the `dropped` positions, in order, then the report's
+    `own` entries. Positions are mapped onto the base with a binary search, so
+    that slicing it costs what slicing the base does.
+    """
+
+    def __init__(self, base, dropped, own):
+        self.base = base
+        self.dropped = tuple(sorted(dropped))
+        self.own = own
+        # How many base entries are kept before each dropped position
+        self._kept_before = [position - i for i, position in enumerate(self.dropped)]
+        self._kept = len(base) - len(self.dropped)
+
+    def __len__(self):
+        return self._kept + len(self.own)
+
+    def _runs(self, start, stop):
+        # The (first, last) slices of the base holding the kept entries from
+        # `start` to `stop`
+        while start < stop:
+            skipped = bisect.bisect_right(self._kept_before, start)
+            first = start + skipped
+            length = stop - start
+            if skipped < len(self.dropped):
+                length = min(length, self.dropped[skipped] - first)
+            yield first, first + length
+            start += length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[position] for position in range(start, stop, step)]
+
+            entries = []
+            for first, last in self._runs(start, min(stop, self._kept)):
+                entries.extend(self.base[first:last])
+            entries.extend(
+                self.own[max(start - self._kept, 0) : max(stop - self._kept, 0)]
+            )
+            return entries
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('section index out of range')
+
+        return self[index : index + 1][0]
+
+    def __iter__(self):
+        for start in range(0, len(self), PAGE_SIZE):
+            yield from self[start : start + PAGE_SIZE]
+
+
+class InMemoryReportStore(ReportStore):
+    """
+    Keeps reports in the module level `REPORTS` dictionary of this process, and
+    their summaries in an index next to it. Ids come from a counter behind a
+    lock, so concurrent saves never share an id.
+    """
+
+    def __init__(self, reports=None):
+        self.reports = REPORTS if reports is None else reports
+        self.index = {
+            report_id: ReportSummary.of(report)
+            for report_id, report in self.reports.items()
+        }
+        self._lock = threading.Lock()
+        self._ids = itertools.count(
+            max((int(key) for key in self.reports.keys()), default=0) + 1
+        )
+
+    def save(self, report):
+        sections = self._layer(
+            report, {section: tuple(report.get(section, ())) for section in SECTIONS}
+        )
+        if sections is None:
+            raise ValueError(f'Report {report["base"]["report"]} does not exist.')
+
+        with self._lock:
+            report_id = str(next(self._ids))
+            stored = StoredReport.build(
+                report_id, datetime.datetime.now(), {**report, **sections}
+            )
+            self.reports[report_id] = stored
+            self.index[report_id] = ReportSummary.build(
+                report_id,
+                stored.created_at,
+                {section: len(sections[section]) for section in SECTIONS},
+                _field_counts(report),
+                stored.key,
+            )
+
+        return report_id
+
+    def get(self, report_id):
+        return self.reports.get(report_id)
+
+    def save_metrics(self, report_id, metrics):
+        with self._lock:
+            if report_id in self.reports:
+                self.reports[report_id] = dataclasses.replace(
+                    self.reports[report_id], metrics=metrics
+                )
+
+    def delete(self, report_id):
+        with self._lock:
+            self.reports.pop(report_id, None)
+            self.index.pop(report_id, None)
+
+    def summary(self, report_id):
+        return self.index.get(report_id)
+
+    def summaries(self):
+        return list(self.index.values())
+
+
+class DatabaseReportStore(ReportStore):
+    """
+    Keeps reports in the configured Django database: one `Report` row holding the
+    summary and one `ReportRecord` row per missing record or discrepancy, written
+    with `bulk_create` in batches of `batch_size`. Sections are read back lazily,
+    a query per slice of positions. Report ids come from the database's own
+    primary key sequence.
+    """
+
+    def __init__(self, batch_size=5000):
+        self.batch_size = batch_size
+
+    def save(self, report):
+        from .models import Report, ReportRecord
+
+        sections = self._layer(
+            report, {section: report.get(section, ()) for section in SECTIONS}
+        )
+        if sections is None:
+            raise ValueError(f'Report {report["base"]["report"]} does not exist.')
+
+        with transaction.atomic():
+            instance = Report.objects.create(
+                created_at=report.get('created_at') or timezone.now(),
+                fields=sorted(report['fields'], key=str),
+                # A list of pairs rather than an object, as JSON objects do not
+                # keep the most-common-first order on every database
+                field_counts=list(_field_counts(report).items()),
+                metrics=report.get('metrics') or {},
+                key=report.get('key') or 'id',
+                previous=report.get('previous'),
+                changes=report.get('changes') or {},
+                base=report.get('base'),
+                **{f'{section}_count': len(sections[section]) for section in SECTIONS},
+            )
+            records = (
+                ReportRecord(
+                    report=instance, section=section, position=position, data=data
+                )
+                for section in SECTIONS
+                for position, data in enumerate(report.get(section, ()))
+            )
+            while batch := list(itertools.islice(records, self.batch_size)):
+                ReportRecord.objects.bulk_create(batch)
+
+        return str(instance.pk)
+
+    def get(self, report_id):
+        from .models import Report
+
+        try:
+            instance = Report.objects.get(pk=report_id)
+        except (Report.DoesNotExist, ValueError):
+            return None
+
+        report = {
+            'fields': instance.fields,
+            'key': instance.key,
+            'metrics': instance.metrics,
+            'previous': instance.previous,
+            'changes': instance.changes,
+            'base': instance.base,
+        }
+        counts = {
+            section: getattr(instance, f'{section}_count') for section in SECTIONS
+        }
+        base_report = None
+        if instance.base is not None:
+            base_report = self.get(instance.base['report'])
+            if base_report is None:
+                return None
+            # The counts are those of the whole report, its own entries come after
+            # what is kept of the base
+            for section in SECTIONS:
+                counts[section] -= len(getattr(base_report, section)) - len(
+                    instance.base['dropped'].get(section, ())
+                )
+
+        sections = {
+            section: PagedSection(
+                functools.partial(self._records, instance.pk, section),
+                counts[section],
+            )
+            for section in SECTIONS
+        }
+        if base_report is not None:
+            sections = {
+                section: LayeredSection(
+                    getattr(base_report, section),
+                    instance.base['dropped'].get(section, ()),
+                    sections[section],
+                )
+                for section in SECTIONS
+            }
+
+        return StoredReport.build(
+            report_id, instance.created_at, {**report, **sections}
+        )
+
+    def _records(self, report_id, section, start, limit):
+        from .models import ReportRecord
+
+        return list(
+            ReportRecord.objects.filter(
+                report_id=report_id, section=section, position__gte=start
+            )
+            .order_by('position')
+            .values_list('data', flat=True)[:limit]
+        )
+
+    def save_metrics(self, report_id, metrics):
+        from .models import Report
+
+        Report.objects.filter(pk=report_id).update(metrics=metrics)
+
+    def delete(self, report_id):
+        from .models import Report
+
+        try:
+            Report.objects.filter(pk=report_id).delete()
+        except ValueError:
+            pass
+
+    def entries(self, report_id, section, positions):
+        from .models import ReportRecord
+
+        report = self.get(report_id)
+        if report is None or report.base is not None:
+            return super().entries(report_id, section, positions)
+
+        # The positions of a report that is not layered are those of its records
+        positions = iter(sorted(positions))
+        entries = []
+        while batch := list(itertools.islice(positions, self.batch_size)):
+            entries.extend(
+                ReportRecord.objects.filter(
+                    report_id=report_id, section=section, position__in=batch
+                )
+                .order_by('position')
+                .values_list('data', flat=True)
+            )
+
+        return entries
+
+    def _summarize(self, instance):
+        return ReportSummary.build(
+            str(instance['pk']),
+            instance['created_at'],
+            {section: instance[f'{section}_count'] for section in SECTIONS},
+            dict(instance['field_counts']),
+            instance['key'],
+        )
+
+    def _summary_values(self):
+        from .models import Report
+
+        return Report.objects.values(
+            'pk',
+            'created_at',
+            'field_counts',
+            'key',
+            *(f'{section}_count' for section in SECTIONS),
+        )
+
+    def summary(self, report_id):
+        try:
+            instance = self._summary_values().filter(pk=report_id).first()
+        except ValueError:
+            return None
+
+        return self._summarize(instance) if instance else None
+
+    def summaries(self):
+        return [
+            self._summarize(instance)
+            for instance in self._summary_values().order_by('pk')
+        ]
+
+
+class SegmentReportStore(ReportStore):
+    """
+    Keeps every report in a segment file of its own under
+    `settings.REPORTS_ROOT` (see `api.segments`), written once and mapped into
+    memory when read: getting a report only reads the footer of its segment, and
+    its sections decode just the entries that are paged through, exported or
+    looked up by key. Report ids are random, so every worker process can save
+    reports without coordinating with the others. Segments are never rewritten:
+    metrics saved after a report go to a small '.metrics' file next to it.
+    """
+
+    def _path(self, report_id, suffix='.segment'):
+        if not report_id.isalnum():
+            return None
+
+        return os.path.join(settings.REPORTS_ROOT, f'{report_id}{suffix}')
+
+    def save(self, report):
+        from .keys import KeySpec
+        from .segments import write_segment
+
+        sections = {section: report.get(section, ()) for section in SECTIONS}
+        layered = self._layer(report, sections)
+        if layered is None:
+            raise ValueError(f'Report {report["base"]["report"]} does not exist.')
+
+        os.makedirs(settings.REPORTS_ROOT, exist_ok=True)
+        report_id = uuid.uuid4().hex
+        key = report.get('key') or 'id'
+        write_segment(
+            self._path(report_id),
+            sections,
+            {
+                'created_at': (report.get('created_at') or timezone.now()).isoformat(),
+                'fields': sorted(report['fields'], key=str),
+                'field_counts': list(_field_counts(report).items()),
+                'counts': {section: len(layered[section]) for section in SECTIONS},
+                'key': key,
+                'metrics': report.get('metrics') or {},
+                'previous': report.get('previous'),
+                'changes': report.get('changes') or {},
+                'base': report.get('base'),
+            },
+            KeySpec.parse(key),
+        )
+
+        return report_id
+
+    def get(self, report_id):
+        from .segments import Segment
+
+        path = self._path(report_id)
+        if path is None:
+            return None
+        try:
+            segment = Segment(path)
+        except FileNotFoundError:
+            return None
+
+        meta = segment.meta
+        sections = self._layer(meta, segment.sections)
+        if sections is None:
+            return None
+
+        return StoredReport(
+            id=report_id,
+            created_at=datetime.datetime.fromisoformat(meta['created_at']),
+            fields=frozenset(meta['fields']),
+            **sections,
+            key=meta['key'],
+            metrics=self._metrics(report_id, meta['metrics']),
+            previous=meta['previous'],
+            changes=meta['changes'],
+            base=meta['base'],
+        )
+
+    def _metrics(self, report_id, metrics):
+        # The metrics saved after the segment, if any, over those in its footer
+        try:
+            with open(self._path(report_id, '.metrics')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return metrics
+
+    def save_metrics(self, report_id, metrics):
+        path = self._path(report_id, '.metrics')
+        if path is None or not os.path.exists(self._path(report_id)):
+            return
+        with open(f'{path}.partial', 'w') as f:
+            json.dump(metrics, f)
+        os.replace(f'{path}.partial', path)
+
+    def delete(self, report_id):
+        path = self._path(report_id)
+        if path is not None:
+            for suffix in ('.segment', '.metrics'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(report_id, suffix))
+
+    def summary(self, report_id):
+        from .segments import read_footer
+
+        path = self._path(report_id)
+        if path is None:
+            return None
+        try:
+            footer = read_footer(path)
+        except FileNotFoundError:
+            return None
+
+        return ReportSummary.build(
+            report_id,
+            datetime.datetime.fromisoformat(footer['created_at']),
+            footer['counts'],
+            dict(footer['field_counts']),
+            footer['key'],
+        )
+
+    def summaries(self):
+        try:
+            names = os.listdir(settings.REPORTS_ROOT)
+        except FileNotFoundError:
+            return []
+
+        summaries = [
+            self.summary(name.removesuffix('.segment'))
+            for name in names
+            if name.endswith('.segment')
+        ]
+        return sorted(
+            (summary for summary in summaries if summary is not None),
+            key=lambda summary: summary.created_at,
+        )
+
+
+# The store of every configured path, built once per process behind the lock so
+# that concurrent first requests share a single store (and its id counter)
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_report_store():
+    """Return the report store configured by `RECONCILIATION_REPORT_STORE`."""
+    path = settings.RECONCILIATION_REPORT_STORE
+    with _STORES_LOCK:
+        if path not in _STORES:
+            _STORES[path] = import_string(path)()
+
+        return _STORES[path]
@@ -0,0 +1,321 @@
+"""
+Chunked, resumable uploads for ledgers too large to POST in one go. A client
+creates an upload with its size, PUTs it in fixed-size chunks (in any order, in
+parallel, again after a dropped connection) and completes it, then passes its
+id instead of a file to the reconciliation endpoint.
+
+Every chunk is written in place in a single data file under
+`settings.UPLOADS_ROOT`, and a marker file is added once it has fully landed,
+so which chunks are missing survives restarts and is visible to every process.
+Reading an upload (`ChunkedUpload.open`) follows the chunks as they land: an
+asynchronous reconciliation can be started before the upload is complete, and it
+parses and partitions rows while the rest is still being uploaded.
+"""
+
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+
+# Chunk sizes, in bytes. Only the last chunk of an upload can be smaller than
+# `settings.RECONCILIATION_UPLOAD_MIN_CHUNK_SIZE`
+CHUNK_SIZE = 8 * 2**20
+MAX_CHUNK_SIZE = 64 * 2**20
+
+# Chunks are copied from the request to disk in pieces of this size
+COPY_SIZE = 64 * 2**10
+
+# How often a reader that caught up with the upload looks for new chunks
+POLL_INTERVAL = 0.05
+
+
+class UploadError(ValueError):
+    """A chunk or an upload is not what the upload expects."""
+
+
+class ChunkedUpload:
+    def __init__(self, upload_id, size, chunk_size, created_at):
+        self.id = upload_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.created_at = created_at
+        self.directory = self.path_for(upload_id)
+        self.data_path = os.path.join(self.directory, 'data')
+        self._chunks_path = os.path.join(self.directory, 'chunks')
+        # How many chunks at the start of the upload are known to have landed
+        self._ready = 0
+
+    @staticmethod
+    def path_for(upload_id):
+        return os.path.join(settings.UPLOADS_ROOT, 'chunked', upload_id)
+
+    @classmethod
+    def create(cls, size, chunk_size=None):
+        """Start an upload of `size` bytes, sent in chunks of `chunk_size`."""
+        upload = cls(
+            uuid.uuid4().hex,
+            size,
+            chunk_size or CHUNK_SIZE,
+            datetime.datetime.now(datetime.timezone.utc),
+        )
+        os.makedirs(upload._chunks_path)
+        with open(upload.data_path, 'wb') as f:
+            f.truncate(size)
+        with open(os.path.join(upload.directory, 'upload.json'), 'w') as f:
+            json.dump(
+                {
+                    'size': size,
+                    'chunk_size': upload.chunk_size,
+                    'created_at': upload.created_at.isoformat(),
+                },
+                f,
+            )
+
+        return upload
+
+    @classmethod
+    def expire(cls, max_age=None):
+        """
+        Delete the uploads that have not been active for `max_age` seconds
+        (defaults to `settings.RECONCILIATION_UPLOAD_EXPIRY`), and return their
+        ids. Receiving a chunk, completing the upload and opening it to read all
+        count as activity, so completed uploads that no run used (or that were
+        kept after a failed run) go too once they are left alone.
+        """
+        max_age = settings.RECONCILIATION_UPLOAD_EXPIRY if max_age is None else max_age
+        root = os.path.join(settings.UPLOADS_ROOT, 'chunked')
+        try:
+            upload_ids = os.listdir(root)
+        except FileNotFoundError:
+            return []
+
+        expired = []
+        for upload_id in upload_ids:
+            upload = cls.get(upload_id)
+            if upload is None:
+                continue
+            try:
+                # Adding a chunk marker touches the chunks directory, completing
+                # or opening the upload touches its own
+                last_active = max(
+                    os.path.getmtime(upload._chunks_path),
+                    os.path.getmtime(upload.directory),
+                )
+            except FileNotFoundError:
+                continue
+            if time.time() - last_active >= max_age:
+                upload.delete()
+                expired.append(upload_id)
+
+        return expired
+
+    @classmethod
+    def get(cls, upload_id):
+        """The upload with `upload_id`, or None."""
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(cls.path_for(upload_id), 'upload.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        return cls(
+            upload_id,
+            meta['size'],
+            meta['chunk_size'],
+            datetime.datetime.fromisoformat(meta['created_at']),
+        )
+
+    @property
+    def chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def received(self):
+        """The indexes of the chunks that have landed, in order."""
+        return sorted(map(int, os.listdir(self._chunks_path)))
+
+    def missing(self):
+        received = set(self.received())
+        return [index for index in range(self.chunks) if index not in received]
+
+    def missing_ranges(self):
+        """The missing chunks as `[first, last]` ranges of indexes, inclusive."""
+        ranges = []
+        for index in self.missing():
+            if ranges and ranges[-1][1] == index - 1:
+                ranges[-1][1] = index
+            else:
+                ranges.append([index, index])
+
+        return ranges
+
+    @property
+    def is_complete(self):
+        return os.path.exists(os.path.join(self.directory, 'complete'))
+
+    def write_chunk(self, index, stream, length=None):
+        """
+        Write chunk `index` from the file-like `stream`. The chunk only counts
+        as received when exactly its bytes came through, a chunk cut short by a
+        dropped connection is simply sent again.
+        """
+        if not 0 <= index < self.chunks:
+            raise UploadError(
+                f'Chunk {index} is out of range, the upload has {self.chunks} chunks.'
+            )
+        expected = self.chunk_length(index)
+        if length is not None and length != expected:
+            raise UploadError(
+                f'Chunk {index} should be {expected} bytes, not {length}.'
+            )
+
+        # A chunk sent again is not received until it has landed again
+        marker = os.path.join(self._chunks_path, str(index))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(marker)
+
+        written = 0
+        with open(self.data_path, 'r+b') as f:
+            f.seek(index * self.chunk_size)
+            # Read one byte past the chunk to catch oversized bodies
+            while written <= expected and (
+                piece := stream.read(min(COPY_SIZE, expected + 1 - written))
+            ):
+                f.write(piece[: expected - written])
+                written += len(piece)
+        if written != expected:
+            raise UploadError(
+                f'Chunk {index} should be {expected} bytes, got '
+                f'{"more" if written > expected else written}.'
+            )
+
+        open(marker, 'w').close()
+
+    def complete(self):
+        """Mark the upload complete, once every chunk has landed."""
+        missing = self.missing()
+        if missing:
+            raise UploadError(
+                f'The upload is missing {len(missing)} chunks, starting at chunk '
+                f'{missing[0]}.'
+            )
+        open(os.path.join(self.directory, 'complete'), 'w').close()
+
+    def ready_bytes(self):
+        """How many bytes from the start of the upload can be read."""
+        while self._ready < self.chunks and os.path.exists(
+            os.path.join(self._chunks_path, str(self._ready))
+        ):
+            self._ready += 1
+
+        return min(self._ready * self.chunk_size, self.size)
+
+    def open(self, timeout=None):
+        """Open the upload for reading, see `UploadReader`."""
+        reader = UploadReader(self, timeout)
+        # Keeps the upload from expiring while a run reads it
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self.directory)
+
+        return reader
+
+    def delete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def as_dict(self):
+        missing = self.missing_ranges()
+        missing_count = sum(last - first + 1 for first, last in missing)
+
+        return {
+            'id': self.id,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunks,
+            'received': self.chunks - missing_count,
+            'missing': missing,
+            'missing_count': missing_count,
+            'complete': self.is_complete,
+            'created_at': self.created_at.isoformat(),
+        }
+
+
+def open_upload(upload):
+    """
+    Open an upload to reconcile: a `ChunkedUpload` is read as its chunks land
+    (see `UploadReader`), the path of an upload saved to disk is opened, and an
+    uploaded file is used as it is.
+    """
+    if isinstance(upload, ChunkedUpload):
+        return upload.open()
+    if isinstance(upload, (str, os.PathLike)):
+        return open(upload, 'rb')
+
+    return upload
+
+
+class UploadReader(io.RawIOBase):
+    """
+    The bytes of an upload as a file. Reading past the chunks that have landed
+    so far waits for the next one, for up to `timeout` seconds (defaults to
+    `settings.RECONCILIATION_UPLOAD_TIMEOUT`), after which `UploadError` is
+    raised. It is raised straight away if the upload is deleted meanwhile.
+    """
+
+    def __init__(self, upload, timeout=None):
+        self.upload = upload
+        self.timeout = (
+            settings.RECONCILIATION_UPLOAD_TIMEOUT if timeout is None else timeout
+        )
+        # Unbuffered, a buffer would read ahead into chunks that have not landed
+        self._file = open(upload.data_path, 'rb', buffering=0)
+        self._ready = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def readinto(self, buffer):
+        position = self._file.tell()
+        if position >= self.upload.size:
+            return 0
+        if position >= self._ready:
+            self._wait(position)
+
+        with memoryview(buffer) as view:
+            return self._file.readinto(view[: self._ready - position])
+
+    def _wait(self, position):
+        deadline = time.monotonic() + self.timeout
+        while (ready := self.upload.ready_bytes()) <= position:
+            # A deleted upload will never get its missing chunks
+            if not os.path.isdir(self.upload.directory):
+                raise UploadError(f'Upload {self.upload.id} was deleted.')
+            if time.monotonic() >= deadline:
+                raise UploadError(
+                    f'Timed out waiting for chunk {position // self.upload.chunk_size} '
+                    f'of upload {self.upload.id}.'
+                )
+            time.sleep(POLL_INTERVAL)
+        self._ready = ready
+
+    def close(self):
+        self._file.close()
+        super().close()
@@ -1,20 +1,76 @@
-from copy import deepcopy
+import hashlib
+import io
+import json
 
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.http import HttpResponse, StreamingHttpResponse
 from django.template import loader
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.views.decorators.gzip import gzip_page
 from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
 
+from .columnar import generate_npz
+from .compression import CompressionError
+from .incremental import SnapshotError
+from .instrumentation import METRICS, Instrumentation
+from .jobs import get_job, submit_job
+from .keys import DEFAULT_KEY, KeySpec
+from .pagination import SectionCursorPagination
+from .pipeline import run_reconciliation
 from .reconciliation_engine import (
-    REPORTS,
+    NormalizationCache,
     generate_csv,
     generate_html,
-    normalize_record,
-    parse_csv,
-    reconcile_data,
 )
-from .serializers import ReconciliationSerializer
+from .serializers import ReconciliationSerializer, UploadSerializer
+from .storage import SECTIONS, get_report_store
+from .uploads import ChunkedUpload, UploadError, open_upload
+
+
+def _section_filter(section, params, key_spec):
+    """
+    Build a predicate for the records of a report section from the `field` (only
+    discrepancies touching that field) and `key_from`/`key_to` (inclusive range
+    of the keys, as formatted by `key_spec`) query parameters, or None when no
+    filter is asked for. Keys are compared as strings: numeric keys order as
+    '10' < '9' unless they are zero-padded.
+    """
+    field = params.get('field')
+    key_from = params.get('key_from')
+    key_to = params.get('key_to')
+    if field is None and key_from is None and key_to is None:
+        return None
+
+    def matches(record):
+        if section == 'discrepancies':
+            if field is not None and field not in record['differences']:
+                return False
+            key = key_spec.format(record['id'])
+        else:
+            key = key_spec.format(key_spec.function(record))
+
+        if key_from is not None or key_to is not None:
+            if key is None:
+                return False
+            if key_from is not None and key < key_from:
+                return False
+            if key_to is not None and key > key_to:
+                return False
+
+        return True
+
+    return matches
+
+
+@gzip_page
+def _export(request, response):
+    # CSV and JSON exports are large and compress well, so they are gzipped for
+    # clients that accept it. Other responses are not: compressing a page that
+    # reflects request input next to a secret (a CSRF token) exposes it to BREACH
+    return response
 
 
 def welcome(request):
@@ -22,6 +78,13 @@ def welcome(request):
     return HttpResponse(template.render())
 
 
+def metrics(request):
+    """The reconciliation metrics of every process, in the Prometheus text format."""
+    return HttpResponse(
+        METRICS.render(), content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
 class ReconciliationViewSet(viewsets.ViewSet):
     def _build_url(self, report_id):
         relative_url = reverse('api:reconciliation-detail', kwargs={'pk': report_id})
@@ -29,32 +92,88 @@ class ReconciliationViewSet(viewsets.ViewSet):
 
         return absolute_url[:-1] + '?output=html'
 
+    def _build_job_url(self, job_id):
+        relative_url = reverse('api:reconciliation-job', kwargs={'job_id': job_id})
+
+        return self.request.build_absolute_uri(relative_url)
+
+    def _build_html_context(self, summary):
+        """
+        The HTML report only renders the summary, its sections are paged in from
+        the section endpoint by the browser.
+        """
+        return {
+            'id': summary.id,
+            'counts': summary.counts,
+            'fields': summary.fields,
+            'sections': {
+                section: reverse(
+                    'api:reconciliation-section',
+                    kwargs={'pk': summary.id, 'section': section},
+                )
+                for section in SECTIONS
+            },
+        }
+
+    def _html_response(self, summary, conditional=True):
+        """
+        Stored reports never change, so their rendered page is cached under a hash
+        of what it renders and repeat views that still hold that ETag get a 304.
+        Ids are not enough: in-memory stores count them per process. Responses to
+        requests that create the report are not `conditional`.
+        """
+        context = self._build_html_context(summary)
+        digest = hashlib.blake2b(
+            json.dumps(context, sort_keys=True).encode(), digest_size=16
+        )
+        etag = quote_etag(f'{summary.id}-{digest.hexdigest()}')
+
+        response = None
+        if conditional:
+            response = get_conditional_response(self.request, etag=etag)
+        if response is None:
+            html = cache.get_or_set(
+                f'reconciliation-html:{etag}',
+                lambda: generate_html(context),
+                timeout=None,
+            )
+            response = HttpResponse(html, status=status.HTTP_200_OK)
+
+        response.headers['ETag'] = etag
+
+        return response
+
+    def _npz_response(self, content):
+        response = StreamingHttpResponse(
+            content, content_type='application/octet-stream'
+        )
+        response['Content-Disposition'] = 'attachment; filename="reconciliation.npz"'
+
+        return response
+
     def list(self, request):
         """
-        List reconciliation results that were previously computed.
-        Given more time, we could store results in a proper DB like Postgres or Redis.
-        For assement purposes, we'll use in-memory or SQLite.
+        List reconciliation results that were previously computed. Reports live in
+        the configured report store (in-memory by default, or the database).
         """
         reports = []
         payload = {'reports': reports, 'meta': {'total': 0}}
 
-        if len(REPORTS.keys()) > 0:
-            payload['meta']['total'] = len(REPORTS.keys())
+        summaries = get_report_store().summaries()
+        if len(summaries) > 0:
+            payload['meta']['total'] = len(summaries)
 
-            for report_id in REPORTS.keys():
-                report = REPORTS[report_id]
-                missing_in_target = len(report['missing_in_target'])
-                missing_in_source = len(report['missing_in_source'])
-                discrepancies = len(report['discrepancies'])
+            for summary in summaries:
+                missing_in_target = summary.counts['missing_in_target']
+                missing_in_source = summary.counts['missing_in_source']
+                discrepancies = summary.counts['discrepancies']
 
                 reports.append(
                     {
-                        'id': report_id,
-                        'created_at': report['created_at'].strftime(
-                            '%I:%M %p on %a, %-d %B, %Y'
-                        ),
+                        'id': summary.id,
+                        'created_at': summary.created_at_display,
                         'outcome': f'{missing_in_target} missing in target, {missing_in_source} missing in source, {discrepancies} discrepancies',
-                        'url': self._build_url(report_id),
+                        'url': self._build_url(summary.id),
                     }
                 )
 
@@ -62,89 +181,394 @@ class ReconciliationViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None, format=None):
         """
-        Download results that were previously computed. Given more time, we could store
-        results in a proper DB like Postgres or Redis. For assement purposes, we'll use
-        in-memory or SQLite.
+        Download results that were previously computed, from the configured report
+        store (in-memory by default, or the database).
         """
         output_format = self.request.query_params.get('output')
+        store = get_report_store()
+
+        if output_format == 'html':
+            summary = store.summary(pk)
+            if not summary:
+                return Response(
+                    {'detail': 'Report not found.'}, status=status.HTTP_404_NOT_FOUND
+                )
 
-        report = REPORTS.get(pk)
+            return self._html_response(summary)
+
+        report = store.get(pk)
         if not report:
             return Response(
                 {'detail': 'Report not found.'}, status=status.HTTP_404_NOT_FOUND
             )
 
-        results = deepcopy(report)
-        results.pop('fields')
-        results.pop('created_at')
+        # The stored sections are immutable, so they are rendered as they are
+        results = report.sections()
 
         if output_format == 'csv':
-            output = generate_csv(results)
-            response = HttpResponse(output.getvalue(), content_type='text/csv')
+            response = StreamingHttpResponse(
+                generate_csv(results, report.fields, KeySpec.parse(report.key)),
+                content_type='text/csv',
+            )
             response['Content-Disposition'] = (
                 'attachment; filename="reconciliation.csv"'
             )
 
-            return response
+            return _export(request, response)
 
-        elif output_format == 'html':
-            html = generate_html({**results, 'id': pk})
-            return HttpResponse(html, status=status.HTTP_200_OK)
+        if output_format == 'npz':
+            return self._npz_response(
+                generate_npz(results, report.fields, KeySpec.parse(report.key))
+            )
 
         # default output_format is json
+        return _export(
+            request,
+            Response(
+                {
+                    'id': pk,
+                    'key': report.key,
+                    **results,
+                    'previous': report.previous,
+                    'changes': report.changes,
+                    'report_url': self._build_url(pk),
+                    'metrics': report.metrics,
+                },
+                status=status.HTTP_200_OK,
+            ),
+        )
+
+    @action(
+        detail=True,
+        url_path=rf'(?P<section>{"|".join(SECTIONS)})',
+        url_name='section',
+    )
+    def section(self, request, pk=None, section=None):
+        """
+        Page through one section of a report with cursor pagination (`cursor`,
+        `limit`), optionally filtered by `field` and by a `key_from`/`key_to` range.
+        Keys compare as strings, so numeric keys order as '10' < '9'. Only the
+        pages that are read are loaded from the report store.
+        """
+        store = get_report_store()
+        summary = store.summary(pk)
+        records = store.section(pk, section) if summary else None
+        if records is None:
+            return Response(
+                {'detail': 'Report not found.'}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        key_from = request.query_params.get('key_from')
+        key_to = request.query_params.get('key_to')
+        if (key_from is not None or key_to is not None) and hasattr(
+            records, 'key_range'
+        ):
+            # Segment sections look key ranges up in their key index
+            records = records.key_range(key_from, key_to)
+
+        paginator = SectionCursorPagination()
+        page = paginator.paginate_section(
+            records,
+            request,
+            matches=_section_filter(
+                section, request.query_params, KeySpec.parse(summary.key)
+            ),
+        )
+
+        return paginator.get_paginated_response(page)
+
+    @action(detail=True)
+    def summary(self, request, pk=None):
+        """
+        The counts of a report and how many discrepancies each field has, without
+        any of the records.
+        """
+        summary = get_report_store().summary(pk)
+        if not summary:
+            return Response(
+                {'detail': 'Report not found.'}, status=status.HTTP_404_NOT_FOUND
+            )
+
         return Response(
-            {'id': pk, **results, 'report_url': self._build_url(pk)},
+            {
+                'id': pk,
+                'counts': summary.counts,
+                'fields': summary.fields,
+                'report_url': self._build_url(pk),
+            },
             status=status.HTTP_200_OK,
         )
 
+    @action(detail=False, url_path=r'jobs/(?P<job_id>[^/.]+)', url_name='job')
+    def job(self, request, job_id=None):
+        """
+        Report the phase and progress of an asynchronous reconciliation and, once
+        it is done, where to find its report.
+        """
+        job = get_job(job_id)
+        if not job:
+            return Response(
+                {'detail': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        report_id = job['report_id']
+        return Response(
+            {
+                'id': job['id'],
+                'status': job['status'],
+                'phase': job['phase'],
+                'counters': job['counters'],
+                'error': job['error'],
+                'report_id': report_id,
+                'report_url': self._build_url(report_id) if report_id else None,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    def _build_upload_url(self, upload_id):
+        relative_url = reverse(
+            'api:reconciliation-upload', kwargs={'upload_id': upload_id}
+        )
+
+        return self.request.build_absolute_uri(relative_url)
+
+    @action(detail=False, methods=['post'], url_path='uploads', url_name='uploads')
+    def uploads(self, request):
+        """
+        Start a chunked upload of `size` bytes. Its chunks (of `chunk_size` bytes,
+        the last one can be shorter) are PUT to `<upload_url><index>/` and the
+        upload is then completed with a POST to `<upload_url>complete/`.
+        """
+        serializer = UploadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Starting an upload is when abandoned ones are cleaned up
+        ChunkedUpload.expire()
+        upload = ChunkedUpload.create(
+            serializer.validated_data['size'],
+            serializer.validated_data.get('chunk_size'),
+        )
+
+        return Response(
+            {**upload.as_dict(), 'upload_url': self._build_upload_url(upload.id)},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(
+        detail=False,
+        methods=['get', 'delete'],
+        url_path=r'uploads/(?P<upload_id>[0-9a-f]+)',
+        url_name='upload',
+    )
+    def upload(self, request, upload_id=None):
+        """
+        Which chunks of an upload have landed and which are missing (as
+        `[first, last]` ranges), so an interrupted upload can resume, or abort
+        (DELETE) the upload.
+        """
+        upload = ChunkedUpload.get(upload_id)
+        if not upload:
+            return Response(
+                {'detail': 'Upload not found.'}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        if request.method == 'DELETE':
+            upload.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        return Response(
+            {**upload.as_dict(), 'upload_url': self._build_upload_url(upload.id)},
+            status=status.HTTP_200_OK,
+        )
+
+    @action(
+        detail=False,
+        methods=['put'],
+        url_path=r'uploads/(?P<upload_id>[0-9a-f]+)/(?P<index>[0-9]+)',
+        url_name='upload-chunk',
+    )
+    def upload_chunk(self, request, upload_id=None, index=None):
+        """
+        Store one chunk of an upload, sent as the raw request body. Chunks can be
+        sent in any order, and sent again.
+        """
+        upload = ChunkedUpload.get(upload_id)
+        if not upload:
+            return Response(
+                {'detail': 'Upload not found.'}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        # The body is copied to disk as it is read, never parsed or buffered
+        length = request.META.get('CONTENT_LENGTH')
+        try:
+            upload.write_chunk(
+                int(index),
+                request.stream or io.BytesIO(),
+                int(length) if length else None,
+            )
+        except UploadError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {
+                'id': upload.id,
+                'index': int(index),
+                'missing': upload.missing_ranges(),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @action(
+        detail=False,
+        methods=['post'],
+        url_path=r'uploads/(?P<upload_id>[0-9a-f]+)/complete',
+        url_name='upload-complete',
+    )
+    def upload_complete(self, request, upload_id=None):
+        """Complete an upload, once all its chunks have landed."""
+        upload = ChunkedUpload.get(upload_id)
+        if not upload:
+            return Response(
+                {'detail': 'Upload not found.'}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        try:
+            upload.complete()
+        except UploadError as e:
+            return Response(
+                {'detail': str(e), 'missing': upload.missing_ranges()},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        return Response(upload.as_dict(), status=status.HTTP_200_OK)
+
     def create(self, request, format=None):
         """
         Accepts two CSV files, performs reconciliation, and returns the results
-        in JSON, CSV, or HTML. The default format is JSON.
+        in JSON, CSV, HTML or as an .npz archive of columns (see `api.columnar`).
+        The default format is JSON.
         """
         serializer = ReconciliationSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        source_file = serializer.validated_data['source_file']
-        target_file = serializer.validated_data['target_file']
+        source_file = serializer.validated_data.get(
+            'source_file'
+        ) or serializer.validated_data.get('source_upload')
+        target_file = serializer.validated_data.get(
+            'target_file'
+        ) or serializer.validated_data.get('target_upload')
         output_format = serializer.validated_data.get('output_format', 'json')
+        engine = serializer.validated_data.get('engine', 'hash')
+        partitioned = serializer.validated_data.get('partitioned', False)
+        previous = serializer.validated_data.get('previous')
+        # Runs that build on a previous report are matched on its key by default
+        key = serializer.validated_data.get('key') or (
+            DEFAULT_KEY if previous is None else None
+        )
+        compare = serializer.validated_data.get('compare')
+        fuzzy = serializer.validated_data.get('fuzzy')
+        delta = serializer.validated_data.get('delta', False)
+        snapshot = serializer.validated_data.get('snapshot', False)
 
-        # Parse CSVs
-        source_raw = parse_csv(source_file)
-        target_raw = parse_csv(target_file)
-
-        # Normalize data
-        source_data = [normalize_record(row) for row in source_raw]
-        target_data = [normalize_record(row) for row in target_raw]
+        if serializer.validated_data.get('asynchronous', False):
+            job = submit_job(
+                source_file,
+                target_file,
+                engine=engine,
+                partitioned=partitioned,
+                key=key,
+                compare=compare,
+                fuzzy=fuzzy,
+                previous=previous,
+                delta=delta,
+                snapshot=snapshot,
+            )
+            return Response(
+                {
+                    'job_id': job.id,
+                    'status': job.status,
+                    'status_url': self._build_job_url(job.id),
+                },
+                status=status.HTTP_202_ACCEPTED,
+            )
 
-        # Reconcile
-        report_id, fields, missing_in_target, missing_in_source, discrepancies = (
-            reconcile_data(source_data, target_data)
-        )
+        # Parse, normalize and reconcile the CSVs as streams, rows are only kept
+        # around once they are indexed by the reconciler. Both sides share one cache
+        # so repeated values are only normalized once.
+        cache = NormalizationCache()
+        instrumentation = Instrumentation()
+        uploads = [
+            upload
+            for upload in (source_file, target_file)
+            if isinstance(upload, ChunkedUpload)
+        ]
+        try:
+            with (
+                open_upload(source_file) as source_file,
+                open_upload(target_file) as target_file,
+            ):
+                report_id, fields, changes, *sections = run_reconciliation(
+                    source_file,
+                    target_file,
+                    engine=engine,
+                    partitioned=partitioned,
+                    cache=cache,
+                    instrumentation=instrumentation,
+                    key=key,
+                    compare=compare,
+                    fuzzy=fuzzy,
+                    previous=previous,
+                    delta=delta,
+                    snapshot=snapshot,
+                )
+        except SnapshotError as e:
+            return Response({'previous': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        except CompressionError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Chunked uploads are used up by the run that read them
+        for upload in uploads:
+            upload.delete()
 
         # Prepare the results
-        results = {
-            'missing_in_target': missing_in_target,
-            'missing_in_source': missing_in_source,
-            'discrepancies': discrepancies,
-        }
+        results = dict(zip(SECTIONS, sections))
+        if key is None:
+            key = KeySpec.parse(get_report_store().summary(report_id).key)
 
         if output_format == 'csv':
-            output = generate_csv(results)
-            response = HttpResponse(output.getvalue(), content_type='text/csv')
+            response = StreamingHttpResponse(
+                generate_csv(results, fields, key), content_type='text/csv'
+            )
             response['Content-Disposition'] = (
                 'attachment; filename="reconciliation.csv"'
             )
+            response = _export(request, response)
 
-            return response
+        elif output_format == 'npz':
+            response = self._npz_response(generate_npz(results, fields, key))
 
         elif output_format == 'html':
-            html = generate_html({**results, 'fields': fields, 'id': report_id})
-            return HttpResponse(html, status=status.HTTP_200_OK)
+            with instrumentation.phase('render'):
+                response = self._html_response(
+                    get_report_store().summary(report_id), conditional=False
+                )
 
-        # default format is json
-        return Response(
-            {'id': report_id, **results, 'report_url': self._build_url(report_id)},
-            status=status.HTTP_200_OK,
-        )
+        else:
+            # default format is json
+            payload = {
+                'id': report_id,
+                'key': str(key),
+                **results,
+                'report_url': self._build_url(report_id),
+                'normalization_cache': cache.stats(),
+                'metrics': instrumentation.as_dict(),
+            }
+            if previous is not None:
+                payload['previous'] = previous
+                payload['changes'] = changes
+            response = _export(request, Response(payload, status=status.HTTP_200_OK))
+
+        response['Server-Timing'] = instrumentation.server_timing()
+
+        return response
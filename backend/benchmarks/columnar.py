@@ -0,0 +1,131 @@
+"""
+Round-trip a report through the JSON export and the columnar .npz export: the
+time to write it, the time and peak memory to load it, and the time to read a
+thousand values back.
+
+Run from the backend directory:
+
+    python -m benchmarks.columnar --discrepancies 100000 1000000
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reconciliation.settings')
+django.setup()
+
+from api.columnar import NpzReport, generate_npz  # noqa: E402
+
+
+def make_report(discrepancies):
+    missing = discrepancies // 10
+
+    return {
+        'missing_in_target': [
+            {'id': f'T{i}', 'name': f'Saiyan {i}', 'amount': str(i)}
+            for i in range(missing)
+        ],
+        'missing_in_source': [
+            {'id': f'S{i}', 'name': f'Namekian {i}', 'amount': str(i)}
+            for i in range(missing)
+        ],
+        'discrepancies': [
+            {
+                'id': (str(i),),
+                'differences': {
+                    'amount': {'source': str(i), 'target': str(i + 1)},
+                    'name': {'source': f'Saiyan {i}', 'target': f'Saiyajin {i}'},
+                },
+            }
+            for i in range(discrepancies)
+        ],
+        'duplicates_in_source': [],
+        'duplicates_in_target': [],
+    }
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+
+    return result, time.perf_counter() - started
+
+
+def traced(function):
+    tracemalloc.start()
+    result, elapsed = timed(function)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def write_json(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f)
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_npz(report, path):
+    with open(path, 'wb') as f:
+        for piece in generate_npz(report):
+            f.write(piece)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--discrepancies', type=int, nargs='+', default=[100_000])
+    args = parser.parse_args()
+
+    print(
+        f'{"discrepancies":>14} {"format":>6} {"size MB":>8} {"write s":>8} '
+        f'{"load s":>8} {"load MB":>8} {"1k reads s":>10}'
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for discrepancies in args.discrepancies:
+            report = make_report(discrepancies)
+            rows = random.Random(0).sample(range(discrepancies), 1000)
+
+            path = os.path.join(tmp, 'report.json')
+            _, write = timed(lambda: write_json(report, path))
+            loaded, load, peak = traced(lambda: load_json(path))
+            _, reads = timed(
+                lambda: [
+                    loaded['discrepancies'][row]['differences']['amount']['target']
+                    for row in rows
+                ]
+            )
+            del loaded
+            size = os.path.getsize(path) / 2**20
+            print(
+                f'{discrepancies:>14} {"json":>6} {size:>8.1f} {write:>8.2f} '
+                f'{load:>8.3f} {peak / 2**20:>8.1f} {reads:>10.4f}'
+            )
+
+            path = os.path.join(tmp, 'report.npz')
+            _, write = timed(lambda: write_npz(report, path))
+            loaded, load, peak = traced(lambda: NpzReport(path))
+            # Discrepancies get a row per differing field, amount comes first
+            column = loaded['discrepancies/target']
+            _, reads = timed(lambda: [column[row * 2] for row in rows])
+            loaded.close()
+            size = os.path.getsize(path) / 2**20
+            print(
+                f'{discrepancies:>14} {"npz":>6} {size:>8.1f} {write:>8.2f} '
+                f'{load:>8.3f} {peak / 2**20:>8.1f} {reads:>10.4f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Time every reconciliation engine on the same pair of normalized datasets.
+
+Run from the backend directory:
+
+    python -m benchmarks.engines --rows 100000 1000000
+"""
+
+import argparse
+import time
+
+from api.engines import ENGINES
+from api.reconciliation_engine import build_key
+from benchmarks.generator import make_ledgers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000])
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES))
+    args = parser.parse_args()
+
+    print(f'{"rows":>10} {"engine":>10} {"seconds":>8} {"discrepancies":>14}')
+    for rows in args.rows:
+        source, target = make_ledgers(rows)
+        for name in args.engines:
+            started = time.perf_counter()
+            _, _, _, discrepancies, *_ = ENGINES[name](source, target, key=build_key)
+            elapsed = time.perf_counter() - started
+            print(f'{rows:>10} {name:>10} {elapsed:>8.2f} {len(discrepancies):>14}')
+
+
+if __name__ == '__main__':
+    main()
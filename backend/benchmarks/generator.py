@@ -0,0 +1,134 @@
+"""
+A deterministic generator of synthetic source/target ledger pairs. The same
+arguments (and seed) always give the same ledgers, so benchmark runs on
+different commits compare like with like.
+
+The knobs:
+- `rows`: rows in the source ledger (before rows missing on one side are taken
+  out)
+- `columns`: columns per row, including the `id` key column
+- `discrepancy_rate`: share of rows present on both sides with one field changed
+  in the target
+- `missing_rate`: share of rows only present on one side, split evenly between
+  missing in target and missing in source
+- `date_density`: share of the value columns holding dates
+- `key_skew`: share of rows whose key is one of a few hot keys (1% of the row
+  count) instead of their own, giving duplicate keys and unbalanced partitions
+"""
+
+import csv
+import os
+import random
+
+DEFAULTS = {
+    'columns': 6,
+    'discrepancy_rate': 0.02,
+    'missing_rate': 0.01,
+    'date_density': 0.2,
+    'key_skew': 0.0,
+    'seed': 42,
+}
+
+
+def ledger_header(columns=None, date_density=None):
+    """The column names of the generated ledgers, e.g. ['id', 'date_1', 'name_1']."""
+    columns = DEFAULTS['columns'] if columns is None else columns
+    date_density = DEFAULTS['date_density'] if date_density is None else date_density
+    if columns < 1:
+        raise ValueError('A ledger needs at least the id column.')
+
+    values = columns - 1
+    dates = round(values * date_density)
+    kinds = ['date'] * dates + [
+        ('amount', 'name')[i % 2] for i in range(values - dates)
+    ]
+
+    return ['id'] + [
+        f'{kind}_{kinds[: i + 1].count(kind)}' for i, kind in enumerate(kinds)
+    ]
+
+
+def _value(rng, column):
+    kind = column.rsplit('_', 1)[0]
+    if kind == 'date':
+        return f'2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+    if kind == 'amount':
+        return f'{rng.random() * 10_000:.2f}'
+    return f'Customer {rng.randrange(5000)}'
+
+
+def iter_ledger_rows(rows, **options):
+    """
+    Yield a `(source_row, target_row)` pair of value lists (in `ledger_header`
+    order) for every generated row. Either side is None when the row is missing
+    from that ledger.
+    """
+    options = {**DEFAULTS, **options}
+    rng = random.Random(options['seed'])
+    header = ledger_header(options['columns'], options['date_density'])
+    value_columns = header[1:]
+    hot_keys = max(1, rows // 100)
+
+    for i in range(rows):
+        if options['key_skew'] and rng.random() < options['key_skew']:
+            key = str(rng.randrange(hot_keys))
+        else:
+            key = str(i)
+        source = [key] + [_value(rng, column) for column in value_columns]
+
+        draw = rng.random()
+        if draw < options['missing_rate'] / 2:
+            yield source, None
+            continue
+        if draw < options['missing_rate']:
+            yield None, source
+            continue
+
+        target = source
+        if value_columns and rng.random() < options['discrepancy_rate']:
+            target = list(source)
+            position = rng.randrange(1, len(header))
+            changed = target[position]
+            while target[position] == changed:
+                target[position] = _value(rng, header[position])
+
+        yield source, target
+
+
+def make_ledgers(rows, **options):
+    """Build the ledgers in memory, as lists of dicts keyed by column name."""
+    header = ledger_header(options.get('columns'), options.get('date_density'))
+    source = []
+    target = []
+    for source_row, target_row in iter_ledger_rows(rows, **options):
+        if source_row is not None:
+            source.append(dict(zip(header, source_row)))
+        if target_row is not None:
+            target.append(dict(zip(header, target_row)))
+
+    return source, target
+
+
+def write_ledgers(directory, rows, **options):
+    """
+    Stream the ledgers to `source.csv` and `target.csv` in `directory` and return
+    their paths.
+    """
+    header = ledger_header(options.get('columns'), options.get('date_density'))
+    source_path = os.path.join(directory, 'source.csv')
+    target_path = os.path.join(directory, 'target.csv')
+
+    with (
+        open(source_path, 'w', newline='') as s,
+        open(target_path, 'w', newline='') as t,
+    ):
+        source, target = csv.writer(s), csv.writer(t)
+        source.writerow(header)
+        target.writerow(header)
+        for source_row, target_row in iter_ledger_rows(rows, **options):
+            if source_row is not None:
+                source.writerow(source_row)
+            if target_row is not None:
+                target.writerow(target_row)
+
+    return source_path, target_path
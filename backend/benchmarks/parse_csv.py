@@ -0,0 +1,77 @@
+"""
+Compare the old whole-file `parse_csv` against streaming ingestion with `iter_csv`.
+
+Run from the backend directory:
+
+    python -m benchmarks.parse_csv --rows 10000 100000 1000000
+"""
+
+import argparse
+import csv
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+from api.reconciliation_engine import iter_csv
+
+
+def legacy_parse_csv(file_obj):
+    """The original implementation: read, decode and materialize everything."""
+    data = file_obj.read().decode('utf-8', errors='ignore')
+    return list(csv.DictReader(io.StringIO(data)))
+
+
+def streaming_parse_csv(file_obj):
+    """Consume the stream the way the reconciler does, one row at a time."""
+    count = 0
+    for _ in iter_csv(file_obj):
+        count += 1
+    return count
+
+
+def write_ledger(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'name', 'amount', 'currency', 'transaction_date'])
+        for i in range(rows):
+            writer.writerow([i, f'Customer {i}', f'{i * 1.5:.2f}', 'KES', '2025-01-01'])
+
+
+def measure(func, path):
+    tracemalloc.start()
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        func(f)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    print(f'{"rows":>10} {"file MB":>8} {"mode":>10} {"seconds":>8} {"peak MB":>8}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            path = os.path.join(tmp, f'ledger-{rows}.csv')
+            write_ledger(path, rows)
+            size = os.path.getsize(path) / 2**20
+
+            for mode, func in (
+                ('legacy', legacy_parse_csv),
+                ('streaming', streaming_parse_csv),
+            ):
+                elapsed, peak = measure(func, path)
+                print(
+                    f'{rows:>10} {size:>8.1f} {mode:>10} {elapsed:>8.2f} {peak / 2**20:>8.1f}'
+                )
+
+
+if __name__ == '__main__':
+    main()
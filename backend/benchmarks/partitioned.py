@@ -0,0 +1,52 @@
+"""
+Measure how partitioned reconciliation scales with the number of worker processes
+on a synthetic ledger pair (5M rows by default, pass --rows for quicker runs).
+
+Run from the backend directory:
+
+    python -m benchmarks.partitioned --rows 5000000 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reconciliation.settings')
+django.setup()
+
+from api.parallel import reconcile_partitioned  # noqa: E402
+from api.reconciliation_engine import NormalizedCSV, reconcile_data  # noqa: E402
+from benchmarks.generator import write_ledgers  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1]
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path, target_path = write_ledgers(directory, args.rows)
+
+        with open(source_path, 'rb') as s, open(target_path, 'rb') as t:
+            started = time.perf_counter()
+            reconcile_data(NormalizedCSV(s), NormalizedCSV(t))
+            baseline = time.perf_counter() - started
+        print(f'{"workers":>8} {"seconds":>8} {"speedup":>8}')
+        print(f'{"inline":>8} {baseline:>8.2f} {1:>8.2f}')
+
+        for workers in sorted(set(args.workers)):
+            with open(source_path, 'rb') as s, open(target_path, 'rb') as t:
+                started = time.perf_counter()
+                reconcile_partitioned(s, t, workers=workers)
+                elapsed = time.perf_counter() - started
+            print(f'{workers:>8} {elapsed:>8.2f} {baseline / elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare the peak memory of reconciling two uploads with compact records (what
+the normalizer produces) against plain dict records, for every engine.
+
+Run from the backend directory:
+
+    python -m benchmarks.records --rows 100000 1000000
+"""
+
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+from api.engines import ENGINES
+from api.reconciliation_engine import NormalizationCache, NormalizedCSV, build_key
+from api.records import as_dict
+from benchmarks.generator import write_ledgers
+
+
+class DictCSV(NormalizedCSV):
+    """The same stream, with every record turned into a dict."""
+
+    def __iter__(self):
+        return map(as_dict, super().__iter__())
+
+
+def measure(engine, source_path, target_path, stream):
+    with open(source_path, 'rb') as source, open(target_path, 'rb') as target:
+        cache = NormalizationCache()
+        tracemalloc.start()
+        started = time.perf_counter()
+        engine(stream(source, cache), stream(target, cache), key=build_key)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000])
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES))
+    args = parser.parse_args()
+
+    print(
+        f'{"rows":>10} {"engine":>10} {"records":>8} {"seconds":>8} '
+        f'{"peak MB":>8} {"MB/1M rows":>10}'
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            source_path, target_path = write_ledgers(tmp, rows)
+            for name in args.engines:
+                for records, stream in (('dict', DictCSV), ('compact', NormalizedCSV)):
+                    elapsed, peak = measure(
+                        ENGINES[name], source_path, target_path, stream
+                    )
+                    peak /= 2**20
+                    print(
+                        f'{rows:>10} {name:>10} {records:>8} {elapsed:>8.2f} '
+                        f'{peak:>8.1f} {peak / rows * 1_000_000:>10.0f}'
+                    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Compare GET latency of a large stored report with and without the deepcopy the
+retrieve view used to make of it.
+
+Run from the backend directory:
+
+    python -m benchmarks.retrieve --discrepancies 10000 100000
+"""
+
+import argparse
+import copy
+import os
+import time
+from unittest.mock import patch
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reconciliation.settings')
+django.setup()
+
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+from api.storage import StoredReport, get_report_store  # noqa: E402
+
+
+def store_report(discrepancies):
+    return get_report_store().save(
+        {
+            'fields': {'id', 'name', 'amount'},
+            'missing_in_target': [],
+            'missing_in_source': [],
+            'discrepancies': [
+                {
+                    'id': str(i),
+                    'differences': {'amount': {'source': str(i), 'target': '0'}},
+                }
+                for i in range(discrepancies)
+            ],
+        }
+    )
+
+
+sections = StoredReport.sections
+
+
+def deepcopy_sections(report):
+    """What retrieve used to do: copy the whole report before rendering it."""
+    return copy.deepcopy(sections(report))
+
+
+def measure(client, url, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        client.get(url)
+        timings.append(time.perf_counter() - started)
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--discrepancies', type=int, nargs='+', default=[10_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    client = APIClient()
+    print(f'{"discrepancies":>14} {"deepcopy s":>11} {"zero-copy s":>12}')
+    for discrepancies in args.discrepancies:
+        report_id = store_report(discrepancies)
+        url = reverse('api:reconciliation-detail', kwargs={'pk': report_id})
+
+        with patch.object(StoredReport, 'sections', deepcopy_sections):
+            before = measure(client, url, args.repeat)
+        after = measure(client, url, args.repeat)
+        print(f'{discrepancies:>14} {before:>11.3f} {after:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
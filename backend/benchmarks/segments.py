@@ -0,0 +1,120 @@
+"""
+Compare cold reads of a large stored report from the database store and the
+segment store: the time and peak memory to get the report and read its first
+page, and to look a key range up.
+
+Run from the backend directory (the database store writes to a throwaway test
+database):
+
+    python -m benchmarks.segments --discrepancies 100000 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reconciliation.settings')
+django.setup()
+
+from django.test.utils import (  # noqa: E402
+    override_settings,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+)
+
+from api.storage import DatabaseReportStore, SegmentReportStore  # noqa: E402
+
+PAGE_SIZE = 100
+
+
+def make_report(discrepancies):
+    return {
+        'fields': {'id', 'name', 'amount'},
+        'missing_in_target': [
+            {'id': f'M{i:09}', 'name': f'Saiyan {i}', 'amount': str(i)}
+            for i in range(discrepancies // 10)
+        ],
+        'missing_in_source': [],
+        'discrepancies': [
+            {
+                'id': f'{i:09}',
+                'differences': {'amount': {'source': str(i), 'target': '0'}},
+            }
+            for i in range(discrepancies)
+        ],
+    }
+
+
+def first_page(store, report_id):
+    report = store.get(report_id)
+    return report.discrepancies[:PAGE_SIZE]
+
+
+def key_range(store, report_id, key_from, key_to):
+    section = store.get(report_id).discrepancies
+    if hasattr(section, 'key_range'):
+        return list(section.key_range(key_from, key_to))
+
+    return [entry for entry in section if key_from <= entry['id'] <= key_to]
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--discrepancies', type=int, nargs='+', default=[100_000])
+    args = parser.parse_args()
+
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    print(
+        f'{"discrepancies":>14} {"store":>9} {"save s":>7} {"page s":>8} '
+        f'{"page MB":>8} {"range s":>8} {"range MB":>8}'
+    )
+    try:
+        with (
+            tempfile.TemporaryDirectory() as tmp,
+            override_settings(REPORTS_ROOT=tmp),
+        ):
+            for discrepancies in args.discrepancies:
+                report = make_report(discrepancies)
+                key_from = f'{discrepancies // 2:09}'
+                key_to = f'{discrepancies // 2 + PAGE_SIZE - 1:09}'
+
+                for name, store in (
+                    ('database', DatabaseReportStore()),
+                    ('segment', SegmentReportStore()),
+                ):
+                    started = time.perf_counter()
+                    report_id = store.save(report)
+                    save = time.perf_counter() - started
+                    page, page_peak = measure(first_page, store, report_id)
+                    lookup, lookup_peak = measure(
+                        key_range, store, report_id, key_from, key_to
+                    )
+                    print(
+                        f'{discrepancies:>14} {name:>9} {save:>7.2f} {page:>8.3f} '
+                        f'{page_peak / 2**20:>8.1f} {lookup:>8.3f} '
+                        f'{lookup_peak / 2**20:>8.1f}'
+                    )
+                    store.delete(report_id)
+    finally:
+        teardown_databases(databases, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
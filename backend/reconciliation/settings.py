@@ -146,7 +146,54 @@ REST_FRAMEWORK = {
 
 TEST_RUNNER = 'django_rich.test.RichRunner'
 
+# Reconciliation configuration
+# Number of worker processes (and partitions) used by partitioned reconciliations
+RECONCILIATION_WORKERS = int(
+    os.environ.get('RECONCILIATION_WORKERS', os.cpu_count() or 1)
+)
+# Where reports are kept: 'api.storage.InMemoryReportStore' (per process, lost on
+# restart), 'api.storage.DatabaseReportStore' (the database configured above) or
+# 'api.storage.SegmentReportStore' (memory-mapped files under REPORTS_ROOT)
+RECONCILIATION_REPORT_STORE = os.environ.get(
+    'RECONCILIATION_REPORT_STORE', 'api.storage.InMemoryReportStore'
+)
+# Number of background threads running asynchronous reconciliation jobs
+RECONCILIATION_JOB_WORKERS = int(os.environ.get('RECONCILIATION_JOB_WORKERS', 2))
+# How long (in seconds) the state of a job is kept after it last changed
+RECONCILIATION_JOB_RETENTION = float(
+    os.environ.get('RECONCILIATION_JOB_RETENTION', 7 * 24 * 3600)
+)
+# Record the peak memory of every reconciliation phase with tracemalloc. Tracing
+# slows every allocation down, so it is off unless set to 1
+RECONCILIATION_TRACE_MEMORY = os.environ.get('RECONCILIATION_TRACE_MEMORY') == '1'
+
 # File Uploads configuration
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 UPLOADS_URL = '/uploads/'
 UPLOADS_ROOT = os.path.join(BASE_DIR, 'uploads')
+# How long (in seconds) reading a chunked upload waits for its next chunk
+RECONCILIATION_UPLOAD_TIMEOUT = float(
+    os.environ.get('RECONCILIATION_UPLOAD_TIMEOUT', 3600)
+)
+# How long (in seconds) an upload is kept after its last chunk, its completion or
+# its last read, see `python manage.py expire_uploads`
+RECONCILIATION_UPLOAD_EXPIRY = float(
+    os.environ.get('RECONCILIATION_UPLOAD_EXPIRY', 24 * 3600)
+)
+# The largest chunked upload (in bytes) and the smallest chunks it can be sent in
+RECONCILIATION_UPLOAD_MAX_SIZE = int(
+    os.environ.get('RECONCILIATION_UPLOAD_MAX_SIZE', 50 * 2**30)
+)
+RECONCILIATION_UPLOAD_MIN_CHUNK_SIZE = int(
+    os.environ.get('RECONCILIATION_UPLOAD_MIN_CHUNK_SIZE', 2**20)
+)
+# Where incremental reconciliations keep the snapshots of their ledgers
+SNAPSHOTS_ROOT = os.environ.get(
+    'RECONCILIATION_SNAPSHOTS_ROOT', os.path.join(BASE_DIR, 'snapshots')
+)
+# Where asynchronous jobs keep their state, shared by every worker process
+JOBS_ROOT = os.environ.get('RECONCILIATION_JOBS_ROOT', os.path.join(BASE_DIR, 'jobs'))
+# Where the segment report store keeps its reports
+REPORTS_ROOT = os.environ.get(
+    'RECONCILIATION_REPORTS_ROOT', os.path.join(BASE_DIR, 'reports')
+)
@@ -0,0 +1,104 @@
+import io
+import json
+import os
+import tempfile
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from api.engines import ENGINES
+from api.reconciliation_engine import build_key
+from api.storage import get_report_store
+from benchmarks.generator import ledger_header, make_ledgers, write_ledgers
+
+
+class GeneratorTests(TestCase):
+    def test_ledgers_are_deterministic(self):
+        """The same arguments should always give the same ledgers."""
+        self.assertEqual(make_ledgers(500, seed=7), make_ledgers(500, seed=7))
+        self.assertNotEqual(make_ledgers(500, seed=7), make_ledgers(500, seed=8))
+
+    def test_header_follows_columns_and_date_density(self):
+        """Value columns should hold the asked share of dates."""
+        self.assertEqual(
+            ledger_header(columns=6, date_density=0.4),
+            ['id', 'date_1', 'date_2', 'amount_1', 'name_1', 'amount_2'],
+        )
+        self.assertEqual(ledger_header(columns=1), ['id'])
+
+    def test_rates_shape_the_reconciliation(self):
+        """Discrepancy and missing rates should show up in the results."""
+        source, target = make_ledgers(20_000, discrepancy_rate=0.1, missing_rate=0.04)
+        _, missing_in_target, missing_in_source, discrepancies, *_ = ENGINES['hash'](
+            source, target, key=build_key
+        )
+
+        self.assertAlmostEqual(len(missing_in_target) / 20_000, 0.02, delta=0.005)
+        self.assertAlmostEqual(len(missing_in_source) / 20_000, 0.02, delta=0.005)
+        self.assertAlmostEqual(len(discrepancies) / 20_000, 0.096, delta=0.01)
+
+    def test_key_skew_repeats_hot_keys(self):
+        """Skewed ledgers should have duplicate keys."""
+        source, _ = make_ledgers(10_000, key_skew=0.3)
+        keys = [row['id'] for row in source]
+
+        self.assertLess(len(set(keys)), 0.8 * len(keys))
+
+    def test_write_ledgers_streams_csv_files(self):
+        """The written ledgers should hold the same rows as the in-memory ones."""
+        source, target = make_ledgers(100, columns=3)
+        with tempfile.TemporaryDirectory() as directory:
+            source_path, target_path = write_ledgers(directory, 100, columns=3)
+            with open(source_path) as s, open(target_path) as t:
+                self.assertEqual(len(s.readlines()), len(source) + 1)
+                self.assertEqual(len(t.readlines()), len(target) + 1)
+
+
+class BenchmarkCommandTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.output = os.path.join(self.directory.name, 'results.json')
+
+    def benchmark(self, *args):
+        call_command(
+            'benchmark',
+            '--rows',
+            '300',
+            '--engines',
+            'hash',
+            '--output',
+            self.output,
+            *args,
+            stdout=io.StringIO(),
+        )
+        with open(self.output) as f:
+            return json.load(f)
+
+    def test_writes_timings_for_every_stage(self):
+        """Both the pipeline and the create endpoint should be timed."""
+        reports = len(get_report_store().summaries())
+        results = self.benchmark()['results']
+
+        self.assertEqual(
+            [(result['engine'], result['stage']) for result in results],
+            [('hash', 'pipeline'), ('hash', 'create')],
+        )
+        self.assertIn('normalize', results[0]['phases'])
+        self.assertIn('render', results[0]['phases'])
+        self.assertEqual(
+            results[1]['phases']['parse']['rows'], results[0]['phases']['parse']['rows']
+        )
+        self.assertEqual(len(get_report_store().summaries()), reports)
+
+    def test_fails_on_regressions(self):
+        """Stages slower than the baseline allows should fail the run."""
+        baseline = self.benchmark('--no-create')
+        for result in baseline['results']:
+            result['seconds'] = 1e-9
+        baseline_path = os.path.join(self.directory.name, 'baseline.json')
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f)
+
+        with self.assertRaisesRegex(CommandError, 'pipeline with hash on 300 rows'):
+            self.benchmark('--no-create', '--baseline', baseline_path)
@@ -0,0 +1,204 @@
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api.columnar import NPY_ALIGN, NpzReport, generate_npz
+from api.keys import KeySpec
+from tests.utils import make_csv_file
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def write_npz(content):
+    with tempfile.NamedTemporaryFile(suffix='.npz', delete=False) as f:
+        for piece in content:
+            f.write(piece)
+
+    return f.name
+
+
+class ColumnarExportTests(TestCase):
+    def setUp(self):
+        self.results = {
+            'missing_in_target': [
+                {'id': '1', 'name': 'Gokū', 'zeni': '100'},
+                {'id': '2', 'name': 'Vegeta', 'zeni': None},
+            ],
+            'missing_in_source': [{'id': '3', 'name': 'Piccolo', 'zeni': '7'}],
+            'discrepancies': [
+                {
+                    'id': ('4',),
+                    'differences': {
+                        'name': {'source': 'Gohan', 'target': 'Son Gohan'},
+                        'zeni': {'source': '1', 'target': None},
+                    },
+                }
+            ],
+            'duplicates_in_source': [],
+            'duplicates_in_target': [],
+        }
+
+    def load(self, results, key=None):
+        path = write_npz(generate_npz(results, key=key))
+        self.addCleanup(os.remove, path)
+        report = NpzReport(path)
+        self.addCleanup(report.close)
+
+        return report
+
+    def test_round_trip(self):
+        """Every section should come back column by column, nulls as ''."""
+        report = self.load(self.results)
+
+        self.assertEqual(list(report['missing_in_target/key']), ['1', '2'])
+        self.assertEqual(
+            list(report['missing_in_target/columns/name']), ['Gokū', 'Vegeta']
+        )
+        self.assertEqual(list(report['missing_in_target/columns/zeni']), ['100', ''])
+        self.assertEqual(list(report['missing_in_source/columns/name']), ['Piccolo'])
+        self.assertEqual(list(report['discrepancies/key']), ['4', '4'])
+        self.assertEqual(list(report['discrepancies/field']), ['name', 'zeni'])
+        self.assertEqual(list(report['discrepancies/source']), ['Gohan', '1'])
+        self.assertEqual(list(report['discrepancies/target']), ['Son Gohan', ''])
+        self.assertEqual(len(report['duplicates_in_source/key']), 0)
+
+    def test_wide_values_do_not_widen_columns(self):
+        """Columns should take the room of their text, not of their widest value."""
+        rows = [{'id': str(i), 'memo': 'ok'} for i in range(1000)]
+        rows[500]['memo'] = 'Kamehameha! ' * 10_000
+        path = write_npz(generate_npz({'missing_in_target': rows}))
+        self.addCleanup(os.remove, path)
+
+        self.assertLess(os.path.getsize(path), 200_000)
+        with NpzReport(path) as report:
+            column = report['missing_in_target/columns/memo']
+            self.assertEqual(column[499:502], ['ok', rows[500]['memo'], 'ok'])
+
+    def test_columns_slice(self):
+        """Columns should index and slice like lists, decoding only what is read."""
+        rows = [{'id': str(i), 'name': f'Saiyan {i}'} for i in range(10_000)]
+        column = self.load({'missing_in_target': rows})[
+            'missing_in_target/columns/name'
+        ]
+
+        self.assertEqual(len(column), 10_000)
+        self.assertEqual(column[-1], 'Saiyan 9999')
+        self.assertEqual(column[4096:4098], ['Saiyan 4096', 'Saiyan 4097'])
+        self.assertEqual(column[::5000], ['Saiyan 0', 'Saiyan 5000'])
+        with self.assertRaises(IndexError):
+            column[10_000]
+
+    def test_composite_keys(self):
+        """Keys should be formatted with the key spec of the report."""
+        key = KeySpec.parse('account, reference')
+        report = self.load(
+            {
+                'missing_in_target': [{'account': 'A1', 'reference': 'R1'}],
+                'discrepancies': [
+                    {
+                        'id': ('A2', 'R2'),
+                        'differences': {'amount': {'source': '1', 'target': '2'}},
+                    }
+                ],
+            },
+            key=key,
+        )
+
+        self.assertEqual(report['missing_in_target/key'][0], key.format(('A1', 'R1')))
+        self.assertEqual(report['discrepancies/key'][0], key.format(('A2', 'R2')))
+
+    def test_arrays_are_stored_and_aligned(self):
+        """Arrays should be stored uncompressed, their data aligned like numpy's."""
+        path = write_npz(generate_npz(self.results))
+        self.addCleanup(os.remove, path)
+
+        with zipfile.ZipFile(path) as bundle:
+            members = {info.filename: info for info in bundle.infolist()}
+        with NpzReport(path) as report:
+            for name, column in report.items():
+                for array, offset in (
+                    ('offsets', column.offsets),
+                    ('data', column.offset),
+                ):
+                    info = members[f'{name}/{array}.npy']
+                    self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                    # The .npy header is padded so that the data follows on a
+                    # boundary
+                    start = info.header_offset + 30 + len(info.filename.encode())
+                    self.assertEqual((offset - start) % NPY_ALIGN, 0)
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_numpy_loads_exports(self):
+        """numpy should load the archive, and map its arrays without reading them."""
+        path = write_npz(generate_npz(self.results))
+        self.addCleanup(os.remove, path)
+
+        with numpy.load(path) as arrays:
+            offsets = arrays['discrepancies/field/offsets']
+            data = arrays['discrepancies/field/data'].tobytes()
+            self.assertEqual(
+                [data[a:b].decode() for a, b in zip(offsets, offsets[1:])],
+                ['name', 'zeni'],
+            )
+
+        with NpzReport(path) as report:
+            column = report['missing_in_target/columns/name']
+            offsets = numpy.memmap(
+                path, dtype='<i8', mode='r', offset=column.offsets, shape=(3,)
+            )
+            data = numpy.memmap(
+                path, dtype='u1', mode='r', offset=column.offset, shape=(offsets[-1],)
+            )
+            self.assertEqual(data[offsets[1] : offsets[2]].tobytes(), b'Vegeta')
+
+
+class ColumnarEndpointTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('api:reconciliation-list')
+
+    def reconcile(self, output_format):
+        return self.client.post(
+            self.url,
+            {
+                'source_file': make_csv_file(
+                    [{'id': '1', 'zeni': '100'}, {'id': '2', 'zeni': '1'}]
+                ),
+                'target_file': make_csv_file([{'id': '1', 'zeni': '150'}]),
+                'output_format': output_format,
+            },
+            format='multipart',
+        )
+
+    def test_npz_output(self):
+        """Reports should download as .npz, straight away and once stored."""
+        response = self.reconcile('npz')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('reconciliation.npz', response['Content-Disposition'])
+        path = write_npz(response.streaming_content)
+        self.addCleanup(os.remove, path)
+        with NpzReport(path) as report:
+            self.assertEqual(list(report['missing_in_target/key']), ['2'])
+            self.assertEqual(list(report['discrepancies/target']), ['150'])
+
+        report_id = self.reconcile('json').data['id']
+        response = self.client.get(
+            reverse('api:reconciliation-detail', kwargs={'pk': report_id}),
+            {'output': 'npz'},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = b''.join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(data)) as bundle:
+            self.assertIn('discrepancies/source/data.npy', bundle.namelist())
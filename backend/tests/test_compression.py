@@ -0,0 +1,171 @@
+import bz2
+import gzip
+import io
+import json
+import lzma
+import zipfile
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api.compression import CompressionError, detect_compression
+from api.reconciliation_engine import iter_csv, parse_csv
+from tests.utils import make_csv_file
+
+
+def zipped(*members):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name, data in members:
+            bundle.writestr(name, data)
+
+    return output.getvalue()
+
+
+class CompressedInputTests(TestCase):
+    def setUp(self):
+        self.rows = [{'id': str(i), 'name': f'Saiyan {i}'} for i in range(1000)]
+        self.data = make_csv_file(self.rows).getvalue()
+
+    def test_compressed_uploads_are_detected_and_inflated(self):
+        """Every supported format should parse to the rows of the plain CSV."""
+        for compression, data in (
+            ('gzip', gzip.compress(self.data)),
+            ('bz2', bz2.compress(self.data)),
+            ('xz', lzma.compress(self.data)),
+            ('zip', zipped(('ledger.csv', self.data))),
+            (None, self.data),
+        ):
+            with self.subTest(compression=compression):
+                file_obj = io.BytesIO(data)
+
+                self.assertEqual(detect_compression(file_obj), compression)
+                self.assertEqual(file_obj.tell(), 0)
+                self.assertEqual(parse_csv(file_obj), self.rows)
+
+    def test_concatenated_gzip_members(self):
+        """Gzip files made of several members should be read to the end."""
+        half = self.data.index(b'\n', len(self.data) // 2) + 1
+        data = gzip.compress(self.data[:half]) + gzip.compress(self.data[half:])
+
+        self.assertEqual(parse_csv(io.BytesIO(data)), self.rows)
+
+    def test_zip_bundles_pick_their_csv(self):
+        """Zip bundles should hold a single CSV, whatever else they hold."""
+        data = zipped(('README.txt', b'Ledger export'), ('ledger.csv', self.data))
+        self.assertEqual(parse_csv(io.BytesIO(data)), self.rows)
+
+        data = zipped(('source.csv', self.data), ('target.csv', self.data))
+        with self.assertRaises(CompressionError):
+            parse_csv(io.BytesIO(data))
+
+    def test_corrupt_uploads_raise_compression_errors(self):
+        """Truncated or corrupt uploads should fail with a CompressionError."""
+        compressed = gzip.compress(self.data)
+
+        for data in (compressed[: len(compressed) // 2], compressed[:20] + b'x' * 50):
+            with self.subTest(size=len(data)), self.assertRaises(CompressionError):
+                parse_csv(io.BytesIO(data))
+
+    def test_zstd_needs_zstandard(self):
+        """zstd uploads should be refused clearly when zstandard is missing."""
+        with (
+            patch('api.compression.zstandard', None),
+            self.assertRaises(CompressionError),
+        ):
+            iter_csv(io.BytesIO(b'\x28\xb5\x2f\xfd' + b'\x00' * 10))
+
+
+class CompressedEndpointTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('api:reconciliation-list')
+
+    def test_compressed_uploads_reconcile(self):
+        """Compressed uploads should reconcile like plain CSVs."""
+        source = make_csv_file([{'id': '1', 'zeni': '100'}, {'id': '2', 'zeni': '1'}])
+        target = make_csv_file([{'id': '1', 'zeni': '150'}])
+
+        response = self.client.post(
+            self.url,
+            {
+                'source_file': io.BytesIO(gzip.compress(source.getvalue())),
+                'target_file': io.BytesIO(bz2.compress(target.getvalue())),
+                'partitioned': True,
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['missing_in_target']), 1)
+        self.assertEqual(len(response.data['discrepancies']), 1)
+
+        response = self.client.post(
+            self.url,
+            {
+                'source_file': io.BytesIO(gzip.compress(source.getvalue())[:30]),
+                'target_file': target,
+            },
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_exports_are_compressed(self):
+        """Clients that accept gzip should get compressed CSV and JSON reports."""
+        rows = [{'id': str(i), 'zeni': str(i)} for i in range(500)]
+
+        response = self.client.post(
+            self.url,
+            {
+                'source_file': make_csv_file(rows),
+                'target_file': make_csv_file(rows[1:]),
+                'output_format': 'csv',
+            },
+            format='multipart',
+            HTTP_ACCEPT_ENCODING='gzip, deflate',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = gzip.decompress(b''.join(response.streaming_content)).decode()
+        self.assertTrue(body.startswith('section,key,field,source,target'))
+
+        response = self.client.post(
+            self.url,
+            {
+                'source_file': make_csv_file(rows),
+                'target_file': make_csv_file(rows[1:]),
+            },
+            format='multipart',
+            HTTP_ACCEPT_ENCODING='gzip',
+        )
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        report_id = json.loads(gzip.decompress(response.content))['id']
+
+        response = self.client.get(
+            reverse('api:reconciliation-detail', kwargs={'pk': report_id}),
+            HTTP_ACCEPT_ENCODING='gzip',
+        )
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_other_responses_are_not_compressed(self):
+        """Responses other than exports should never be gzipped, against BREACH."""
+        for _ in range(5):
+            self.client.post(
+                self.url,
+                {
+                    'source_file': make_csv_file([{'id': '1'}]),
+                    'target_file': make_csv_file([{'id': '2'}]),
+                    'output_format': 'html',
+                },
+                format='multipart',
+                HTTP_ACCEPT_ENCODING='gzip',
+            )
+
+        for url in (reverse('api:reconciliation-list'), reverse('metrics')):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertFalse(response.has_header('Content-Encoding'))
@@ -0,0 +1,159 @@
+import tempfile
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from api.engines import (
+    ENGINES,
+    columnar_engine,
+    compare_records,
+    external_sort,
+    hash_engine,
+    sort_merge_engine,
+)
+from api.reconciliation_engine import build_key
+
+
+def by_id(records):
+    return sorted(records, key=lambda record: record['id'])
+
+
+class EnginesTests(TestCase):
+    def setUp(self):
+        self.source_data = [
+            {'id': '1', 'name': 'goku', 'zeni': '100'},
+            {'id': '2', 'name': 'gohan', 'zeni': '200'},
+            {'id': '3', 'name': 'goten', 'zeni': '300'},
+            {'id': '4', 'name': 'vegeta', 'zeni': None},
+        ]
+        self.target_data = [
+            {'id': '1', 'name': 'goku', 'zeni': '100'},
+            {'id': '2', 'name': 'gohan', 'zeni': '999'},
+            {'id': '4', 'name': 'vegeta'},
+            {'id': '5', 'name': 'trunks', 'zeni': '500'},
+        ]
+
+    def test_all_engines_are_registered(self):
+        """Every engine should be selectable by name."""
+        self.assertEqual(ENGINES['hash'], hash_engine)
+        self.assertEqual(ENGINES['columnar'], columnar_engine)
+        self.assertEqual(ENGINES['sort_merge'], sort_merge_engine)
+
+    def assertSameResults(self, result, expected):
+        self.assertEqual(result[0], expected[0])
+        for section in range(1, 6):
+            self.assertEqual(by_id(result[section]), by_id(expected[section]))
+
+    def test_columnar_engine_matches_hash_engine(self):
+        """The columnar engine should produce exactly what the hash engine does."""
+        expected = hash_engine(self.source_data, self.target_data, key=build_key)
+        result = columnar_engine(self.source_data, self.target_data, key=build_key)
+
+        self.assertSameResults(result, expected)
+
+    def test_columnar_engine_reports_field_differences(self):
+        """Only the differing fields should end up in a discrepancy."""
+        fields, missing_in_target, missing_in_source, discrepancies, *_ = (
+            columnar_engine(self.source_data, self.target_data, key=build_key)
+        )
+
+        self.assertEqual(fields, {'id', 'name', 'zeni'})
+        self.assertEqual(missing_in_target, [self.source_data[2]])
+        self.assertEqual(missing_in_source, [self.target_data[3]])
+        self.assertEqual(
+            discrepancies,
+            [{'id': '2', 'differences': {'zeni': {'source': '200', 'target': '999'}}}],
+        )
+
+    def test_sort_merge_engine_skips_sorting_presorted_inputs(self):
+        """Sorted, re-iterable inputs should be merged without sorting them."""
+        expected = hash_engine(self.source_data, self.target_data, key=build_key)
+
+        with patch('api.engines.external_sort') as mock_external_sort:
+            result = sort_merge_engine(
+                self.source_data, self.target_data, key=build_key
+            )
+
+        mock_external_sort.assert_not_called()
+        self.assertSameResults(result, expected)
+
+    def test_sort_merge_engine_orders_numeric_keys_by_value(self):
+        """Inputs sorted by numeric key (2 before 10) should count as sorted."""
+        source_data = [{'id': str(i), 'zeni': str(i)} for i in range(1, 25)]
+        source_data += [{'id': 'A1', 'zeni': '1'}, {'id': 'B', 'zeni': '2'}]
+        target_data = [dict(record) for record in source_data[::2]]
+        target_data[3]['zeni'] = '0'
+        expected = hash_engine(source_data, target_data, key=build_key)
+
+        with patch('api.engines.external_sort') as mock_external_sort:
+            result = sort_merge_engine(source_data, target_data, key=build_key)
+
+        mock_external_sort.assert_not_called()
+        self.assertSameResults(result, expected)
+
+        # Sorting puts numeric keys first, by value, then the other keys as text
+        records = [{'id': value} for value in ('10', 'x', '9', '009', '0', '')]
+        with tempfile.TemporaryDirectory() as directory:
+            result = list(external_sort(records, build_key, directory))
+        self.assertEqual(
+            [record['id'] for record in result], ['0', '009', '9', '10', '', 'x']
+        )
+
+    def test_sort_merge_engine_sorts_unsorted_inputs_on_disk(self):
+        """Unsorted inputs should be spilled to sorted runs and merged back."""
+        source_data = list(reversed(self.source_data)) * 2
+        target_data = iter(list(reversed(self.target_data)))
+        expected = hash_engine(source_data, self.target_data, key=build_key)
+
+        with patch('api.engines.SORT_RUN_SIZE', 3):
+            result = sort_merge_engine(source_data, target_data, key=build_key)
+
+        self.assertSameResults(result, expected)
+
+    def test_every_engine_reports_duplicate_keys(self):
+        """Records shadowed by a later record with the same key are reported."""
+        source_data = [
+            {'id': '1', 'zeni': '100'},
+            {'id': '1', 'zeni': '150'},
+            {'zeni': '1'},
+            {'zeni': '2'},
+            {'id': '2', 'zeni': '200'},
+        ]
+        target_data = [{'id': '2', 'zeni': '250'}, {'id': '2', 'zeni': '200'}]
+
+        for name, engine in ENGINES.items():
+            with self.subTest(engine=name):
+                _, missing_in_target, _, discrepancies, dup_source, dup_target = engine(
+                    source_data, target_data, key=build_key
+                )
+
+                self.assertCountEqual(
+                    dup_source, [{'id': '1', 'zeni': '100'}, {'zeni': '1'}]
+                )
+                self.assertEqual(dup_target, [{'id': '2', 'zeni': '250'}])
+                self.assertEqual(discrepancies, [])
+                self.assertEqual(len(missing_in_target), 2)
+
+    def test_compare_records_skips_identical_records(self):
+        """Identical records have no differences but their fields are still seen."""
+        fields = set()
+
+        self.assertEqual(
+            compare_records(self.source_data[0], self.target_data[0], fields), {}
+        )
+        self.assertEqual(fields, {'id', 'name', 'zeni'})
+        # A missing field and a None field are not a difference either
+        self.assertEqual(
+            compare_records(self.source_data[3], self.target_data[2], fields), {}
+        )
+
+    def test_external_sort_is_stable(self):
+        """Duplicate keys should come back in input order across spilled runs."""
+        records = [{'id': str(i % 3), 'n': i} for i in range(10)] + [{'n': 10}]
+
+        with tempfile.TemporaryDirectory() as directory:
+            result = list(external_sort(records, build_key, directory, run_size=4))
+
+        self.assertEqual(
+            [record['n'] for record in result], [10, 0, 3, 6, 9, 1, 4, 7, 2, 5, 8]
+        )
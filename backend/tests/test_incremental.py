@@ -0,0 +1,361 @@
+import json
+import os
+import tempfile
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api.incremental import Snapshot, SnapshotError, fingerprinter
+from api.instrumentation import Instrumentation
+from api.keys import KeySpec
+from api.matching import CompareSpec
+from api.pipeline import run_reconciliation
+from api.storage import SECTIONS, get_report_store
+from tests.utils import make_csv_file
+
+
+def canonical(sections):
+    return [sorted(json.dumps(entry, sort_keys=True) for entry in s) for s in sections]
+
+
+class IncrementalTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(SNAPSHOTS_ROOT=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.source_rows = [
+            {'id': str(i), 'name': f'Saiyan {i}', 'zeni': str(i * 100)}
+            for i in range(50)
+        ]
+        self.target_rows = [
+            {'id': str(i), 'name': f'Saiyan {i}', 'zeni': str(i * 100 + (i % 10 == 0))}
+            for i in range(5, 55)
+        ]
+
+    def reconcile(self, source_rows, target_rows, **options):
+        instrumentation = Instrumentation()
+        report_id, fields, _, *sections = run_reconciliation(
+            make_csv_file(source_rows),
+            make_csv_file(target_rows),
+            instrumentation=instrumentation,
+            **options,
+        )
+
+        return report_id, sections, instrumentation.as_dict()
+
+    def test_fingerprints_ignore_column_order(self):
+        """Rows should fingerprint by content, not by the order of their columns."""
+        fingerprint = fingerprinter(['id', 'zeni'])
+
+        self.assertEqual(
+            fingerprint({'id': '1', 'zeni': '100'}),
+            fingerprinter(['zeni', 'id'])({'zeni': '100', 'id': '1'}),
+        )
+        self.assertNotEqual(
+            fingerprint({'id': '1', 'zeni': '100'}),
+            fingerprint({'id': '1', 'zeni': '101'}),
+        )
+        self.assertNotEqual(
+            fingerprint({'id': '1', 'zeni': None}),
+            fingerprint({'id': '1', 'zeni': ''}),
+        )
+
+    def test_full_uploads_only_recompare_the_churn(self):
+        """
+        A run on top of a snapshot should give the same report as a run from
+        scratch, while only normalizing the changed rows.
+        """
+        previous, _, _ = self.reconcile(
+            self.source_rows, self.target_rows, snapshot=True
+        )
+
+        source_rows = [dict(row) for row in self.source_rows[:-1]]  # 49 removed
+        source_rows[21]['zeni'] = '42'  # changed
+        source_rows.append({'id': '100', 'name': 'Broly', 'zeni': '0'})  # added
+        target_rows = [dict(row) for row in self.target_rows]
+        target_rows[5]['zeni'] = '1000'  # 10 fixed, the target now agrees
+
+        report_id, sections, metrics = self.reconcile(
+            source_rows, target_rows, previous=previous
+        )
+        _, expected, _ = self.reconcile(source_rows, target_rows)
+
+        self.assertEqual(canonical(sections), canonical(expected))
+        self.assertEqual(metrics['normalize']['rows'], 3)
+
+        report = get_report_store().get(report_id)
+        self.assertEqual(report.previous, previous)
+        self.assertEqual(
+            report.changes['keys']['source'],
+            {'added': 1, 'changed': 1, 'removed': 1, 'unchanged': 48},
+        )
+        self.assertEqual(
+            report.changes['keys']['target'],
+            {'added': 0, 'changed': 1, 'removed': 0, 'unchanged': 49},
+        )
+        discrepancies = report.changes['sections']['discrepancies']
+        self.assertEqual(
+            sorted(entry['id'] for entry in discrepancies['removed']), ['10']
+        )
+        self.assertEqual([entry['id'] for entry in discrepancies['added']], ['21'])
+
+        # The snapshot moved on to the new report
+        self.assertFalse(os.path.exists(Snapshot.path_for(previous)))
+        self.assertTrue(os.path.exists(Snapshot.path_for(report_id)))
+
+    def test_delta_uploads(self):
+        """Deltas should upsert their rows and remove the keys marked deleted."""
+        previous, _, _ = self.reconcile(
+            self.source_rows, self.target_rows, snapshot=True
+        )
+
+        source_delta = [
+            {'id': '3', 'name': 'Saiyan 3', 'zeni': '42', '_deleted': ''},
+            {'id': '4', 'name': '', 'zeni': '', '_deleted': 'true'},
+        ]
+        target_delta = [{'id': '60', 'name': 'Cell', 'zeni': '0', '_deleted': ''}]
+        report_id, sections, metrics = self.reconcile(
+            source_delta, target_delta, previous=previous, delta=True
+        )
+
+        source_rows = [dict(row) for row in self.source_rows if row['id'] != '4']
+        source_rows[3]['zeni'] = '42'
+        target_rows = self.target_rows + [{'id': '60', 'name': 'Cell', 'zeni': '0'}]
+        _, expected, _ = self.reconcile(source_rows, target_rows)
+
+        self.assertEqual(canonical(sections), canonical(expected))
+        self.assertEqual(metrics['normalize']['rows'], 2)
+        self.assertEqual(
+            get_report_store().get(report_id).changes['keys']['source'],
+            {'added': 0, 'changed': 1, 'removed': 1, 'unchanged': 48},
+        )
+
+    def test_duplicates_are_recomputed(self):
+        """Duplicate keys in a full upload should be reported like in a full run."""
+        previous, _, _ = self.reconcile(
+            self.source_rows, self.target_rows, snapshot=True
+        )
+
+        source_rows = self.source_rows + [{'id': '7', 'name': 'Raditz', 'zeni': '1'}]
+        _, sections, _ = self.reconcile(
+            source_rows, self.target_rows, previous=previous
+        )
+
+        self.assertEqual(
+            list(sections[SECTIONS.index('duplicates_in_source')]),
+            [{'id': '7', 'name': 'saiyan 7', 'zeni': '700'}],
+        )
+
+    def test_reports_are_stored_on_top_of_the_first_of_their_chain(self):
+        """
+        Runs should only store what they drop from and add to the first report
+        of their chain, with every store, until that outgrows it.
+        """
+        for store in (
+            'api.storage.InMemoryReportStore',
+            'api.storage.DatabaseReportStore',
+            'api.storage.SegmentReportStore',
+        ):
+            with (
+                self.subTest(store=store),
+                tempfile.TemporaryDirectory() as reports,
+                self.settings(RECONCILIATION_REPORT_STORE=store, REPORTS_ROOT=reports),
+            ):
+                first, _, _ = self.reconcile(
+                    self.source_rows, self.target_rows, snapshot=True
+                )
+                previous = first
+                source_rows = [dict(row) for row in self.source_rows]
+                for run in range(3):
+                    source_rows[7 + run * 7]['zeni'] = str(run)
+                    previous, sections, _ = self.reconcile(
+                        source_rows, self.target_rows, previous=previous
+                    )
+                    _, expected, _ = self.reconcile(source_rows, self.target_rows)
+                    self.assertEqual(canonical(sections), canonical(expected))
+
+                store_instance = get_report_store()
+                report = store_instance.get(previous)
+                self.assertEqual(report.base['report'], first)
+                discrepancies = report.discrepancies
+                self.assertEqual(len(discrepancies.own), 3)
+                self.assertEqual(
+                    store_instance.summary(previous).counts['discrepancies'],
+                    len(discrepancies),
+                )
+                self.assertEqual(
+                    store_instance.page(previous, 'discrepancies', 1, 2),
+                    list(discrepancies)[1:3],
+                )
+
+                # Changing every row outgrows the first report
+                source_rows = [
+                    {**row, 'zeni': str(int(row['zeni']) + 1)} for row in source_rows
+                ]
+                report_id, sections, _ = self.reconcile(
+                    source_rows, self.target_rows, previous=previous
+                )
+                _, expected, _ = self.reconcile(source_rows, self.target_rows)
+                self.assertEqual(canonical(sections), canonical(expected))
+                self.assertIsNone(store_instance.get(report_id).base)
+
+    def test_only_the_latest_report_of_a_chain_can_be_built_on(self):
+        """Reports whose snapshot moved on, or that never had one, are refused."""
+        first, _, _ = self.reconcile(self.source_rows, self.target_rows, snapshot=True)
+        self.reconcile(self.source_rows, self.target_rows, previous=first)
+        plain, _, _ = self.reconcile(self.source_rows, self.target_rows)
+
+        for previous in (first, plain, 'missing'):
+            with self.subTest(previous=previous):
+                with self.assertRaises(SnapshotError):
+                    self.reconcile(
+                        self.source_rows, self.target_rows, previous=previous
+                    )
+
+    def test_runs_keep_the_key_of_their_chain(self):
+        """Building on a report matched on another key is refused."""
+        previous, _, _ = self.reconcile(
+            self.source_rows, self.target_rows, snapshot=True
+        )
+
+        with self.assertRaises(SnapshotError):
+            self.reconcile(
+                self.source_rows,
+                self.target_rows,
+                previous=previous,
+                key=KeySpec.parse('name'),
+            )
+        # The refused run handed the snapshot back
+        self.assertTrue(os.path.exists(Snapshot.path_for(previous)))
+
+    def test_runs_keep_the_comparisons_of_their_chain(self):
+        """Building on a report compared with another spec is refused."""
+        compare = CompareSpec.parse('zeni:numeric=1')
+        previous, _, _ = self.reconcile(
+            self.source_rows, self.target_rows, snapshot=True, compare=compare
+        )
+
+        for other in (CompareSpec(), CompareSpec.parse('zeni:numeric=2')):
+            with self.subTest(compare=str(other)):
+                with self.assertRaises(SnapshotError):
+                    self.reconcile(
+                        self.source_rows,
+                        self.target_rows,
+                        previous=previous,
+                        compare=other,
+                    )
+                self.assertTrue(os.path.exists(Snapshot.path_for(previous)))
+
+        report_id, sections, _ = self.reconcile(
+            self.source_rows, self.target_rows, previous=previous, compare=compare
+        )
+        # Off by one zeni is within the tolerance
+        self.assertEqual(len(sections[2]), 0)
+
+    def test_endpoint_inherits_the_key_of_the_chain(self):
+        """Runs that build on a report without sending a key use the chain's."""
+        client = APIClient()
+        url = reverse('api:reconciliation-list')
+        response = client.post(
+            url,
+            {
+                'source_file': make_csv_file(self.source_rows),
+                'target_file': make_csv_file(self.target_rows),
+                'key': 'id, name',
+                'snapshot': True,
+            },
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        key = response.data['key']
+
+        response = client.post(
+            url,
+            {
+                'source_file': make_csv_file(self.source_rows),
+                'target_file': make_csv_file(self.target_rows),
+                'previous': response.data['id'],
+            },
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['key'], key)
+        self.assertEqual(KeySpec.parse(key).columns, ('id', 'name'))
+
+    def test_incremental_endpoint(self):
+        """The create endpoint should keep snapshots and report the changes."""
+        client = APIClient()
+        url = reverse('api:reconciliation-list')
+
+        response = client.post(
+            url,
+            {
+                'source_file': make_csv_file(self.source_rows),
+                'target_file': make_csv_file(self.target_rows),
+                'snapshot': True,
+            },
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = client.post(
+            url,
+            {
+                'source_file': make_csv_file([{'id': '3', 'zeni': '1'}]),
+                'target_file': make_csv_file([{'id': '3', 'zeni': '1'}]),
+                'previous': response.data['id'],
+                'delta': True,
+            },
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['changes']['keys']['source']['changed'], 1)
+
+        response = client.post(
+            url,
+            {
+                'source_file': make_csv_file(self.source_rows),
+                'target_file': make_csv_file(self.target_rows),
+                'delta': True,
+            },
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('delta', response.data)
+
+        response = client.post(
+            url,
+            {
+                'source_file': make_csv_file(self.source_rows),
+                'target_file': make_csv_file(self.target_rows),
+                'previous': 'missing',
+            },
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('previous', response.data)
+
+        # Incremental runs do not go through the engines
+        for option, value in (
+            ('engine', 'sort_merge'),
+            ('partitioned', True),
+            ('fuzzy', 0.5),
+        ):
+            with self.subTest(option=option):
+                response = client.post(
+                    url,
+                    {
+                        'source_file': make_csv_file(self.source_rows),
+                        'target_file': make_csv_file(self.target_rows),
+                        'snapshot': True,
+                        option: value,
+                    },
+                    format='multipart',
+                )
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(option, response.data)
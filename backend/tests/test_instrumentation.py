@@ -0,0 +1,142 @@
+import io
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api.instrumentation import Instrumentation, MetricsRegistry
+from api.pipeline import run_reconciliation
+from api.storage import get_report_store
+from tests.utils import make_csv_file
+
+
+class InstrumentationTests(TestCase):
+    def test_phases_are_timed_exclusively(self):
+        """Time spent in a nested phase should not be charged to its parent."""
+        clock = iter(range(100))
+        instrumentation = Instrumentation(trace_memory=False)
+
+        with (
+            patch('time.perf_counter', lambda: next(clock)),
+            patch('time.thread_time', lambda: 0),
+        ):
+            with instrumentation.phase('outer'):  # 0
+                with instrumentation.phase('inner'):  # 1
+                    pass  # 2
+                pass  # 3
+
+        self.assertEqual(instrumentation.phases['outer'].wall, 2)
+        self.assertEqual(instrumentation.phases['inner'].wall, 1)
+
+    def test_iterate_counts_the_rows_of_each_phase(self):
+        """Streams pulled through each other should each count their own rows."""
+        instrumentation = Instrumentation(trace_memory=False)
+        rows = instrumentation.iterate('parse', range(1000), batch_size=64)
+        doubled = instrumentation.iterate('normalize', (row * 2 for row in rows))
+
+        self.assertEqual(sum(doubled), 999_000)
+        self.assertEqual(instrumentation.phases['parse'].rows, 1000)
+        self.assertEqual(instrumentation.phases['normalize'].rows, 1000)
+
+    def test_tracing_records_the_peak_memory(self):
+        """With memory tracing on, every phase should report its peak."""
+        instrumentation = Instrumentation(trace_memory=True)
+
+        with instrumentation.tracing(), instrumentation.phase('allocate'):
+            data = [bytes(1024) for _ in range(1000)]
+
+        self.assertGreater(instrumentation.phases['allocate'].peak_memory, 1_000_000)
+        self.assertEqual(len(data), 1000)
+
+    def test_server_timing_and_prometheus_output(self):
+        """Runs should render as a Server-Timing header and Prometheus samples."""
+        instrumentation = Instrumentation(trace_memory=False)
+        with instrumentation.phase('parse') as stats:
+            stats.rows = 10
+        registry = MetricsRegistry()
+        registry.record(instrumentation)
+        registry.record(instrumentation)
+
+        self.assertRegex(instrumentation.server_timing(), r'^parse;dur=\d+\.\d{3}$')
+        metrics = registry.render()
+        self.assertIn('reconciliation_runs_total 2\n', metrics)
+        self.assertIn('reconciliation_phase_rows_total{phase="parse"} 20\n', metrics)
+        self.assertNotIn('reconciliation_phase_peak_memory_bytes{', metrics)
+
+    def test_metrics_add_up_across_processes(self):
+        """Every worker process should add to and render the same totals."""
+        first = Instrumentation(trace_memory=False)
+        with first.phase('parse') as stats:
+            stats.rows = 10
+            stats.peak_memory = 500
+        second = Instrumentation(trace_memory=False)
+        with second.phase('parse') as stats:
+            stats.rows = 5
+            stats.peak_memory = 300
+        with second.phase('store'):
+            pass
+        MetricsRegistry().record(first)
+        MetricsRegistry().record(second)
+
+        metrics = MetricsRegistry().render()
+        self.assertIn('reconciliation_runs_total 2\n', metrics)
+        self.assertIn('reconciliation_phase_rows_total{phase="parse"} 15\n', metrics)
+        self.assertIn('reconciliation_phase_rows_total{phase="store"} 0\n', metrics)
+        self.assertIn(
+            'reconciliation_phase_peak_memory_bytes{phase="parse"} 500\n', metrics
+        )
+
+    def test_runs_store_their_metrics_on_the_report(self):
+        """A reconciliation should time every phase and keep it with its report."""
+        source = io.BytesIO(b'id,zeni\n1,100\n2,200\n')
+        target = io.BytesIO(b'id,zeni\n1,150\n')
+        instrumentation = Instrumentation(trace_memory=False)
+
+        report_id, *_ = run_reconciliation(
+            source, target, instrumentation=instrumentation
+        )
+
+        self.assertEqual(
+            list(instrumentation.phases), ['reconcile', 'parse', 'normalize', 'store']
+        )
+        self.assertEqual(instrumentation.phases['parse'].rows, 3)
+        metrics = get_report_store().get(report_id).metrics
+        self.assertEqual(set(metrics), {'reconcile', 'parse', 'normalize', 'store'})
+        self.assertEqual(metrics['normalize']['rows'], 3)
+
+
+class InstrumentationApiTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    @override_settings(RECONCILIATION_TRACE_MEMORY=True)
+    def test_reconciliation_reports_its_metrics(self):
+        """The API should expose the metrics of a run and add them up."""
+        response = self.client.post(
+            reverse('api:reconciliation-list'),
+            data={
+                'source_file': make_csv_file([{'id': '1', 'zeni': '100'}]),
+                'target_file': make_csv_file([{'id': '1', 'zeni': '150'}]),
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('normalize;dur=', response.headers['Server-Timing'])
+        self.assertEqual(response.data['metrics']['parse']['rows'], 2)
+        self.assertIsNotNone(response.data['metrics']['parse']['peak_memory_bytes'])
+
+        response = self.client.get(
+            reverse('api:reconciliation-detail', kwargs={'pk': response.data['id']})
+        )
+        self.assertEqual(response.data['metrics']['parse']['rows'], 2)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(
+            'reconciliation_phase_peak_memory_bytes{phase="parse"}',
+            response.content.decode(),
+        )
@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+from django.test import TestCase, override_settings
+
+from api.jobs import JOBS, Job, expire_jobs, get_job, submit_job
+from api.storage import REPORTS
+from tests.utils import make_csv_file, wait_for
+
+
+class JobsTests(TestCase):
+    def setUp(self):
+        self.uploads = tempfile.TemporaryDirectory()
+        self.addCleanup(self.uploads.cleanup)
+        jobs = tempfile.TemporaryDirectory()
+        self.addCleanup(jobs.cleanup)
+        settings = override_settings(JOBS_ROOT=jobs.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_submit_job_reconciles_in_the_background(self):
+        """A submitted job should store the report and clean up its uploads."""
+        source = make_csv_file([{'id': '1', 'zeni': '100'}, {'id': '2', 'zeni': '1'}])
+        target = make_csv_file([{'id': '1', 'zeni': '150'}])
+
+        with override_settings(UPLOADS_ROOT=self.uploads.name):
+            job = submit_job(source, target)
+            wait_for(job)
+
+        # Finished jobs are only kept on disk
+        self.assertNotIn(job.id, JOBS)
+        self.assertEqual(get_job(job.id), job.as_dict())
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.progress.phase, 'done')
+        self.assertEqual(
+            job.progress.counters,
+            {
+                'source_rows': 2,
+                'target_rows': 1,
+                'missing_in_target': 1,
+                'missing_in_source': 0,
+                'discrepancies': 1,
+                'duplicates_in_source': 0,
+                'duplicates_in_target': 0,
+            },
+        )
+        self.assertEqual(len(REPORTS[job.report_id].discrepancies), 1)
+        self.assertFalse(os.path.exists(os.path.dirname(job.source_path)))
+
+    def test_job_reports_failures(self):
+        """A job that cannot run should be marked as failed with the error."""
+        job = Job('/does/not/exist/source.csv', '/does/not/exist/target.csv')
+        job.run()
+
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('No such file', job.error)
+
+    def test_job_state_is_shared(self):
+        """Job state should be readable from its file, by any process."""
+        job = Job('/does/not/exist/source.csv', '/does/not/exist/target.csv')
+        job.save()
+
+        self.assertEqual(get_job(job.id)['status'], 'queued')
+        job.run()
+        self.assertEqual(get_job(job.id)['status'], 'failed')
+        self.assertIsNone(get_job('nope'))
+        self.assertIsNone(get_job('../etc'))
+
+    def test_old_job_states_expire(self):
+        """The state of jobs that have not changed in a while should be deleted."""
+        old = Job('source.csv', 'target.csv')
+        old.save()
+        os.utime(Job.path_for(old.id), (0, 0))
+        recent = Job('source.csv', 'target.csv')
+        recent.save()
+
+        expire_jobs(max_age=3600)
+
+        self.assertIsNone(get_job(old.id))
+        self.assertIsNotNone(get_job(recent.id))
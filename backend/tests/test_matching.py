@@ -0,0 +1,187 @@
+import pickle
+
+from django.test import TestCase
+
+from api.engines import ENGINES
+from api.keys import DEFAULT_KEY
+from api.matching import (
+    CompareSpec,
+    _neighbours,
+    date,
+    link_records,
+    numeric,
+    text,
+)
+from api.reconciliation_engine import build_key, normalize_record
+
+
+class ComparatorTests(TestCase):
+    def test_numeric_tolerance(self):
+        """Numbers should compare by value, within the tolerance."""
+        differs = numeric('0.01')
+
+        self.assertFalse(differs('100.00', '100'))
+        self.assertFalse(differs('1e2', '100.005'))
+        self.assertFalse(differs('1,000', '1000'))
+        self.assertFalse(differs('-1,234,567.5', '-1234567.50'))
+        self.assertTrue(differs('1,5', '15'))
+        self.assertTrue(differs('1,5', '1.5'))
+        self.assertTrue(differs('10,00', '1000'))
+        self.assertTrue(differs('100', '100.02'))
+        self.assertTrue(differs('100', 'one hundred'))
+        self.assertTrue(differs('100', None))
+        self.assertTrue(numeric()('100', '100.001'))
+        # Their difference overflows the decimal context
+        self.assertTrue(differs('9e999999', '-9e999999'))
+
+    def test_date_window(self):
+        """Dates and timestamps should compare within the window."""
+        differs = date('1')
+
+        self.assertFalse(
+            differs(
+                normalize_record({'d': '2025-01-01'})['d'],
+                normalize_record({'d': '2025-01-02'})['d'],
+            )
+        )
+        self.assertFalse(differs('2025-01-01t23:00:00', '2025-01-02t10:00:00z'))
+        self.assertTrue(differs('2025-01-01', '2025-01-03'))
+        self.assertTrue(differs('2025-01-01', 'soon'))
+
+    def test_text_ignores_case_and_whitespace(self):
+        """Text should compare without case or repeated whitespace."""
+        differs = text()
+
+        self.assertFalse(differs('Son  Goku', 'son goku'))
+        self.assertTrue(differs('son goku', 'son gohan'))
+
+
+class CompareSpecTests(TestCase):
+    def test_parse_round_trips(self):
+        """A comparison spec should parse into comparators and back."""
+        spec = CompareSpec.parse(' amount:numeric=0.01, value_date:date, name:text ')
+
+        self.assertEqual(
+            spec.comparators,
+            {
+                'amount': ('numeric', '0.01'),
+                'value_date': ('date', None),
+                'name': ('text', None),
+            },
+        )
+        self.assertEqual(str(spec), 'amount:numeric=0.01,value_date:date,name:text')
+        self.assertEqual(CompareSpec.parse(str(spec)), spec)
+        self.assertFalse(CompareSpec.parse(''))
+
+    def test_parse_rejects_invalid_specs(self):
+        """Unknown comparators and bad arguments should be refused."""
+        for spec in (
+            'amount',
+            'amount:soundex',
+            'amount:numeric=abc',
+            'amount:numeric=-1',
+            'name:text=1',
+            'value_date:date=soon',
+            'value_date:date=-1',
+            'value_date:date=inf',
+            'value_date:date=nan',
+            'value_date:date=1e12',
+        ):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                CompareSpec.parse(spec)
+
+    def test_specs_survive_pickling(self):
+        """Specs are sent to partition workers, which rebuild the comparators."""
+        spec = pickle.loads(pickle.dumps(CompareSpec.parse('amount:numeric=1')))
+
+        self.assertFalse(spec.functions['amount']('10', '10.5'))
+
+    def test_every_engine_uses_the_comparators(self):
+        """Values within tolerance should not be discrepancies for any engine."""
+        source_data = [
+            normalize_record(row)
+            for row in (
+                {'id': '1', 'amount': '100.00', 'name': 'Son Goku'},
+                {'id': '2', 'amount': '200', 'name': 'Gohan'},
+            )
+        ]
+        target_data = [
+            normalize_record(row)
+            for row in (
+                {'id': '1', 'amount': '1e2', 'name': 'Son  Goku'},
+                {'id': '2', 'amount': '250', 'name': 'Gohan'},
+            )
+        ]
+        spec = CompareSpec.parse('amount:numeric, name:text')
+
+        for name, engine in ENGINES.items():
+            with self.subTest(engine=name):
+                _, _, _, discrepancies, *_ = engine(
+                    source_data, target_data, key=build_key, compare=spec.functions
+                )
+
+                self.assertEqual(
+                    discrepancies,
+                    [
+                        {
+                            'id': '2',
+                            'differences': {
+                                'amount': {'source': '200', 'target': '250'}
+                            },
+                        }
+                    ],
+                )
+
+
+class LinkRecordsTests(TestCase):
+    def test_links_typos_in_keys(self):
+        """Missing records whose keys differ by a typo should be linked."""
+        missing_in_target = [
+            {'id': 'inv-1001', 'amount': '100', 'name': 'goku'},
+            {'id': 'inv-2002', 'amount': '200', 'name': 'gohan'},
+        ]
+        missing_in_source = [
+            {'id': 'inv-10001', 'amount': '100', 'name': 'goku'},
+            {'id': 'inv-3003', 'amount': '300', 'name': 'goten'},
+        ]
+
+        linked, missing_in_target, missing_in_source = link_records(
+            missing_in_target, missing_in_source, DEFAULT_KEY, set()
+        )
+
+        self.assertEqual(
+            linked,
+            [
+                {
+                    'id': 'inv-1001',
+                    'differences': {
+                        'id': {'source': 'inv-1001', 'target': 'inv-10001'}
+                    },
+                    'match': 'fuzzy',
+                }
+            ],
+        )
+        self.assertEqual([r['id'] for r in missing_in_target], ['inv-2002'])
+        self.assertEqual([r['id'] for r in missing_in_source], ['inv-3003'])
+
+    def test_does_not_link_different_records_with_close_keys(self):
+        """Close keys alone are not enough, the other fields need to agree."""
+        linked, missing_in_target, missing_in_source = link_records(
+            [{'id': 'inv-001', 'amount': '100', 'name': 'goku'}],
+            [{'id': 'inv-002', 'amount': '250', 'name': 'vegeta'}],
+            DEFAULT_KEY,
+            set(),
+        )
+
+        self.assertEqual(linked, [])
+        self.assertEqual(len(missing_in_target), 1)
+        self.assertEqual(len(missing_in_source), 1)
+
+    def test_candidates_stay_near_linear(self):
+        """Every key should only be scored against a window of neighbours."""
+        keys = [f'key-{i:05d}' for i in range(2000)]
+
+        candidates = _neighbours([keys], [keys[::-1]], 4)
+
+        self.assertLessEqual(len(candidates), 2 * 2000 * 3)
+        self.assertIn((0, 1999), candidates)
@@ -0,0 +1,127 @@
+import csv
+import io
+import itertools
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from api.engines import hash_engine
+from api.instrumentation import Instrumentation
+from api.parallel import (
+    _read_bucket,
+    partition_rows,
+    reconcile_partitioned,
+    split_records,
+)
+from api.reconciliation_engine import (
+    NormalizationCache,
+    build_key,
+    iter_csv,
+    normalize_record,
+)
+from tests.utils import make_csv_file
+
+
+def by_id(records):
+    return sorted(records, key=lambda record: record['id'])
+
+
+class ParallelTests(TestCase):
+    def test_partition_rows_routes_normalized_keys_together(self):
+        """Rows whose keys normalize to the same value should share a bucket."""
+        rows = [{'id': f' A{i} '} for i in range(20)] + [{'id': 'a3'}, {'name': 'x'}]
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = partition_rows(rows, 4, directory, 'source')
+            buckets = [list(_read_bucket(path)) for path in paths]
+
+        self.assertEqual(len(buckets), 4)
+        self.assertEqual(sum(len(bucket) for bucket in buckets), len(rows))
+        (bucket,) = [bucket for bucket in buckets if {'id': 'a3'} in bucket]
+        self.assertIn({'id': ' A3 '}, bucket)
+
+    def test_split_records_keeps_records_whole(self):
+        """Ranges should split on record boundaries, not on quoted newlines."""
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['id', 'memo'])
+        for i in range(200):
+            memo = f'line one\nsaid "{i}",\r\nline three' if i % 3 else f'plain {i}'
+            writer.writerow([str(i), memo])
+        data = output.getvalue().encode()
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as f:
+            f.write(data)
+        self.addCleanup(os.remove, f.name)
+
+        for parts in (1, 2, 7, 500):
+            with self.subTest(parts=parts):
+                fieldnames, ranges = split_records(f.name, parts)
+                rows = [
+                    row
+                    for start, end in ranges
+                    for row in csv.DictReader(
+                        io.StringIO(data[start:end].decode(), newline=''),
+                        fieldnames=fieldnames,
+                    )
+                ]
+
+                self.assertLessEqual(len(ranges), parts)
+                self.assertEqual(rows, list(iter_csv(io.BytesIO(data))))
+
+    def test_reconcile_partitioned_matches_single_run(self):
+        """Merged per-partition results should equal a single reconciliation."""
+        source_rows = [
+            {'id': str(i), 'name': f'Saiyan {i}', 'zeni': str(i * 100)}
+            for i in range(30)
+        ]
+        # Later rows shadow earlier ones, wherever the file is split
+        source_rows += [
+            {'id': str(i), 'name': f'Saiyan {i}', 'zeni': '0'} for i in (1, 2)
+        ]
+        target_rows = [
+            {'id': str(i), 'name': f'Saiyan {i}', 'zeni': str(i * 100 + i % 4)}
+            for i in range(5, 40)
+        ]
+        expected = hash_engine(
+            [normalize_record(row) for row in source_rows],
+            [normalize_record(row) for row in target_rows],
+            key=build_key,
+        )
+
+        cache = NormalizationCache()
+        result = reconcile_partitioned(
+            make_csv_file(source_rows),
+            make_csv_file(target_rows),
+            workers=3,
+            cache=cache,
+        )
+
+        self.assertEqual(result[0], expected[0])
+        for section in range(1, 6):
+            self.assertEqual(by_id(result[section]), by_id(expected[section]))
+        self.assertEqual(len(result[4]), 2)
+        self.assertEqual(cache.hits + cache.misses, 67 * 2)
+
+    def test_worker_cpu_time_is_charged_to_reconcile(self):
+        """The CPU time of the workers should count towards the reconcile phase."""
+        clock = itertools.count(step=5)
+        instrumentation = Instrumentation(trace_memory=False)
+
+        with (
+            patch(
+                'api.parallel.ProcessPoolExecutor',
+                lambda max_workers, mp_context: ThreadPoolExecutor(max_workers),
+            ),
+            patch('time.process_time', lambda: next(clock)),
+        ):
+            reconcile_partitioned(
+                make_csv_file([{'id': '1', 'zeni': '100'}]),
+                make_csv_file([{'id': '1', 'zeni': '150'}]),
+                workers=1,
+                instrumentation=instrumentation,
+            )
+
+        self.assertGreaterEqual(instrumentation.phases['reconcile'].cpu, 5)
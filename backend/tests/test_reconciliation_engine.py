@@ -4,10 +4,16 @@ from unittest.mock import MagicMock, patch
 from django.test import TestCase
 
 from api.reconciliation_engine import (
+    NormalizationCache,
+    RecordNormalizer,
     build_key,
     generate_csv,
     generate_html,
+    iter_csv,
+    iter_lines,
+    infer_column_type,
     normalize_record,
+    normalize_records,
     parse_csv,
     reconcile_data,
 )
@@ -39,6 +45,35 @@ class ReconciliationEngineTests(TestCase):
         parsed = parse_csv(empty_file)
         self.assertEqual(parsed, [])
 
+    def test_iter_csv_streams_rows(self):
+        """iter_csv should lazily yield rows instead of building a list."""
+        csv_file = make_csv_file([{'id': '1', 'name': 'Goku'}])
+        rows = iter_csv(csv_file)
+
+        self.assertNotIsInstance(rows, list)
+        self.assertEqual(list(rows), [{'id': '1', 'name': 'Goku'}])
+
+    def test_iter_lines_handles_characters_split_across_chunks(self):
+        """iter_lines should decode multi-byte characters split between chunks."""
+        data = 'id,name\r\n1,Vegéta\r\n2,"Trunks\nBriefs"'.encode('utf-8')
+        split_at = data.index('é'.encode('utf-8')) + 1
+        chunks = [data[:split_at], data[split_at:]]
+
+        self.assertEqual(
+            list(iter_lines(chunks)),
+            ['id,name\r\n', '1,Vegéta\r\n', '2,"Trunks\n', 'Briefs"'],
+        )
+
+    def test_parse_csv_reads_small_chunks(self):
+        """parse_csv should give the same rows however the upload is chunked."""
+        rows = [{'id': str(i), 'name': f'Saiyan {i}'} for i in range(50)]
+        csv_file = make_csv_file(rows)
+
+        with patch('api.reconciliation_engine.CHUNK_SIZE', 7):
+            parsed = list(iter_csv(csv_file))
+
+        self.assertEqual(parsed, rows)
+
     # -------------------------------------------------------------------------
     # normalize_record
     # -------------------------------------------------------------------------
@@ -72,6 +107,84 @@ class ReconciliationEngineTests(TestCase):
         result = normalize_record(record)
         self.assertEqual(result['not_a_date'], 'somestring')
 
+    def test_normalize_record_keeps_impossible_dates_as_strings(self):
+        """Dates that do not exist on the calendar should not be reformatted."""
+        record = {'leap': '2024-02-29', 'not_leap': '2025-02-29', 'short': '2025-1-5'}
+        result = normalize_record(record)
+
+        self.assertEqual(result['leap'], 'Thu, 29 February, 2024')
+        self.assertEqual(result['not_leap'], '2025-02-29')
+        self.assertEqual(result['short'], 'Sun, 5 January, 2025')
+
+    # -------------------------------------------------------------------------
+    # RecordNormalizer / normalize_records
+    # -------------------------------------------------------------------------
+    def test_infer_column_type(self):
+        """infer_column_type should classify columns from their name and values."""
+        self.assertEqual(infer_column_type('id', ['1', '2']), 'id')
+        self.assertEqual(infer_column_type('account_id', ['a1']), 'id')
+        self.assertEqual(infer_column_type('date', ['2025-01-01', '', None]), 'date')
+        self.assertEqual(infer_column_type('zeni', ['100', '-2.5', '1e3']), 'numeric')
+        self.assertEqual(infer_column_type('name', ['Goku', '2025-01-01']), 'text')
+        self.assertEqual(infer_column_type('empty', ['', None]), 'text')
+
+    def test_normalize_records_matches_normalize_record(self):
+        """The compiled normalizer should produce exactly what normalize_record does."""
+        rows = [
+            {'id': ' 1 ', 'date': '2025-01-01', 'zeni': '1E3', 'name': ' GOKU '},
+            {'id': '2', 'date': 'not a date', 'zeni': '2025-02-03', 'name': None},
+            {'id': '3', 'date': '2025-02-30', 'zeni': '7', 'name': '2025-3-4'},
+        ]
+        result = list(normalize_records(rows, sample_size=1))
+
+        self.assertEqual(result, [normalize_record(row) for row in rows])
+
+    def test_record_normalizer_uses_sampled_column_types(self):
+        """from_sample should compile a transform per column from the sampled rows."""
+        normalizer = RecordNormalizer.from_sample(
+            [{'id': '1', 'date': '2025-01-01', 'zeni': '100', 'name': 'Goku'}],
+            fieldnames=['id', 'date', 'zeni', 'name', 'extra'],
+        )
+
+        self.assertEqual(
+            normalizer.column_types,
+            {
+                'id': 'id',
+                'date': 'date',
+                'zeni': 'numeric',
+                'name': 'text',
+                'extra': 'text',
+            },
+        )
+
+    def test_normalization_cache_reuses_normalized_values(self):
+        """Repeated values should be normalized once and share one string object."""
+        cache = NormalizationCache()
+        source = [
+            {'id': str(i), 'ccy': ' KES ', 'date': '2025-01-01'} for i in range(3)
+        ]
+        target = [{'id': '9', 'ccy': ' KES ', 'date': '2025-01-01'}]
+
+        rows = list(normalize_records(source, cache=cache))
+        rows += list(normalize_records(target, cache=cache))
+
+        self.assertEqual(rows[0]['ccy'], 'kes')
+        self.assertTrue(all(row['ccy'] is rows[0]['ccy'] for row in rows))
+        self.assertTrue(all(row['date'] is rows[0]['date'] for row in rows))
+        # ids are never cached, the other two columns miss once each
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['hits'], 6)
+
+    def test_normalization_cache_is_bounded(self):
+        """A column's intern table should stop growing at max_size."""
+        cache = NormalizationCache(max_size=2)
+        rows = [{'name': f'Saiyan {i}'} for i in range(5)]
+
+        result = list(normalize_records(rows, cache=cache))
+
+        self.assertEqual(result, [normalize_record(row) for row in rows])
+        self.assertEqual(cache.stats()['size'], 2)
+
     # -------------------------------------------------------------------------
     # build_key
     # -------------------------------------------------------------------------
@@ -101,7 +214,7 @@ class ReconciliationEngineTests(TestCase):
             {'id': '1', 'name': 'goku'},
             {'id': '2', 'name': 'gohan'},
         ]
-        report_id, fields, missing_in_target, missing_in_source, discrepancies = (
+        report_id, fields, missing_in_target, missing_in_source, discrepancies, *_ = (
             reconcile_data(source_data, target_data)
         )
         self.assertEqual(fields, {'id', 'name'})
@@ -122,7 +235,7 @@ class ReconciliationEngineTests(TestCase):
             {'id': '1', 'name': 'goku', 'tax': '999'},  # mismatch in 'tax'
             # '2' is missing
         ]
-        report_id, fields, missing_in_target, missing_in_source, discrepancies = (
+        report_id, fields, missing_in_target, missing_in_source, discrepancies, *_ = (
             reconcile_data(source_data, target_data)
         )
 
@@ -145,12 +258,13 @@ class ReconciliationEngineTests(TestCase):
     # -------------------------------------------------------------------------
     def test_generate_csv_creates_proper_csv_content(self):
         """
-        generate_csv should produce CSV lines that reflect the reconciliation results.
+        generate_csv should produce CSV lines that reflect the reconciliation results,
+        with one column per record field.
         """
         # Prepare some dummy results
         results = {
             'missing_in_target': [{'id': '2', 'name': 'Gohan'}],
-            'missing_in_source': [{'id': '3', 'name': 'Bulma'}],
+            'missing_in_source': [{'id': '3', 'name': 'Bulma', 'city': 'West'}],
             'discrepancies': [
                 {
                     'id': '1',
@@ -159,25 +273,19 @@ class ReconciliationEngineTests(TestCase):
             ],
         }
 
-        # generate_csv is defined with signature generate_csv(self, results),
-        # but typically it wouldn't need 'self'. We'll pass None or a dummy for 'self'.
-        csv_file = generate_csv(results)
-        csv_file.seek(0)
-        csv_data = csv_file.read()
-
-        # Now let's check the contents
-        csv_rows = csv_data.splitlines()
-        # First row: "Section,Record"
-        self.assertEqual(csv_rows[0], 'Section,Record')
-        # Next rows might be:
-        # missing_in_target,"{'id': '2', 'name': 'Gohan'}"
-        # missing_in_source,"{'id': '3', 'name': 'Bulma'}"
-        # discrepancy,"{'id': '1', 'differences': {'tax': {'source': '100', 'target': '200'}}}"
-        self.assertIn("missing_in_target,\"{'id': '2', 'name': 'Gohan'}\"", csv_rows[1])
-        self.assertIn("missing_in_source,\"{'id': '3', 'name': 'Bulma'}\"", csv_rows[2])
-        self.assertIn(
-            "discrepancy,\"{'id': '1', 'differences': {'tax': {'source': '100', 'target': '200'}}}\"",
-            csv_rows[3],
+        csv_file = generate_csv(results, fields={'id', 'name', 'tax'})
+
+        # Rows are generated lazily, one line at a time
+        self.assertNotIsInstance(csv_file, (list, str))
+        csv_rows = ''.join(csv_file).splitlines()
+        self.assertEqual(
+            csv_rows,
+            [
+                'section,key,field,source,target,id,name,tax,city',
+                'missing_in_target,2,,,,2,Gohan,,',
+                'missing_in_source,3,,,,3,Bulma,,West',
+                'discrepancy,1,tax,100,200',
+            ],
         )
 
     # -------------------------------------------------------------------------
@@ -188,14 +296,18 @@ class ReconciliationEngineTests(TestCase):
         generate_html should call Django's template rendering with the correct context.
         """
         results = {
-            'missing_in_target': [{'id': '2'}],
-            'missing_in_source': [{'id': '3'}],
-            'discrepancies': [
-                {
-                    'id': '1',
-                    'differences': {'tax': {'source': '100', 'target': '999'}},
-                }
-            ],
+            'id': 1,
+            'counts': {
+                'missing_in_target': 1,
+                'missing_in_source': 1,
+                'discrepancies': 1,
+            },
+            'fields': {'tax': 1},
+            'sections': {
+                'missing_in_target': '/api/v1/reconciliation/1/missing_in_target/',
+                'missing_in_source': '/api/v1/reconciliation/1/missing_in_source/',
+                'discrepancies': '/api/v1/reconciliation/1/discrepancies/',
+            },
         }
 
         mock_template = MagicMock()
@@ -0,0 +1,129 @@
+import json
+import pickle
+import sys
+import tempfile
+
+from django.test import TestCase
+
+from api.engines import ENGINES, external_sort
+from api.reconciliation_engine import (
+    build_key,
+    normalize_records,
+    reconcile_data,
+)
+from api.records import Record, as_dict, plain_sections, record_type
+
+
+class RecordTests(TestCase):
+    def setUp(self):
+        self.Saiyan = record_type(('id', 'name', 'zeni'))
+        self.record = self.Saiyan(('1', 'goku', '100'))
+
+    def test_records_read_like_dicts(self):
+        """Records should be read by column, like the dicts they replace."""
+        record = self.record
+
+        self.assertEqual(record['name'], 'goku')
+        self.assertEqual(record.get('zeni'), '100')
+        self.assertIsNone(record.get('missing'))
+        self.assertEqual(record.get('missing', ''), '')
+        self.assertIn('id', record)
+        self.assertNotIn('goku', record)
+        self.assertEqual(list(record), ['id', 'name', 'zeni'])
+        self.assertEqual(record.keys() | {'extra'}, {'id', 'name', 'zeni', 'extra'})
+        self.assertEqual(list(record.values()), ['1', 'goku', '100'])
+        self.assertEqual(dict(record), {'id': '1', 'name': 'goku', 'zeni': '100'})
+        with self.assertRaises(KeyError):
+            record['missing']
+
+    def test_records_compare_by_items(self):
+        """Records should equal dicts and records with the same items."""
+        same = {'zeni': '100', 'name': 'goku', 'id': '1'}
+        reordered = record_type(('zeni', 'name', 'id'))(('100', 'goku', '1'))
+        other = record_type(('id', 'name', 'power'))(('1', 'goku', '100'))
+
+        self.assertEqual(self.record, same)
+        self.assertEqual(same, self.record)
+        self.assertEqual(self.record, reordered)
+        self.assertNotEqual(self.record, other)
+        self.assertNotEqual(self.record, self.Saiyan(('1', 'goku', '101')))
+        self.assertNotEqual(self.record, ('1', 'goku', '100'))
+
+    def test_records_are_smaller_than_dicts(self):
+        """A record should take well under half the memory of the same dict."""
+        self.assertLess(
+            sys.getsizeof(self.record) * 2, sys.getsizeof(as_dict(self.record))
+        )
+
+    def test_records_survive_pickling(self):
+        """Records are spilled to disk by the external sort, in every protocol."""
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                record = pickle.loads(pickle.dumps(self.record, protocol))
+
+                self.assertIs(type(record), self.Saiyan)
+                self.assertEqual(record, self.record)
+
+        records = [self.Saiyan((str(i), 'goku', '100')) for i in range(9, -1, -1)]
+        with self.subTest('external sort'), tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(
+                list(external_sort(records, build_key, tmp, run_size=3)),
+                sorted(records, key=build_key),
+            )
+
+    def test_as_dict(self):
+        """as_dict should turn records into dicts and leave dicts alone."""
+        row = {'id': '1'}
+
+        self.assertIs(as_dict(row), row)
+        self.assertIs(type(as_dict(self.record)), dict)
+        self.assertEqual(as_dict(self.record), self.record)
+
+    def test_plain_sections(self):
+        """Record sections should come out as dicts, where json reads their items."""
+        self.assertEqual(json.dumps(self.record), '["id", "name", "zeni"]')
+
+        discrepancies = [{'id': '1', 'differences': {}}]
+        sections = plain_sections([[self.record], [], discrepancies, [self.record], []])
+
+        self.assertIs(type(sections[0][0]), dict)
+        self.assertEqual(json.loads(json.dumps(sections[0])), [as_dict(self.record)])
+        self.assertIs(sections[2], discrepancies)
+        self.assertIs(type(sections[3][0]), dict)
+
+
+class NormalizedRecordTests(TestCase):
+    def test_normalizer_produces_records(self):
+        """Rows with the columns of the file come out as records, others as dicts."""
+        rows = [
+            {'id': ' 1 ', 'name': 'GOKU'},
+            {'id': '2', 'name': 'Gohan', 'power': '9001'},
+        ]
+
+        first, second = normalize_records(rows, sample_size=1)
+
+        self.assertIsInstance(first, Record)
+        self.assertEqual(first, {'id': '1', 'name': 'goku'})
+        self.assertNotIsInstance(second, Record)
+
+    def test_results_hold_plain_dicts(self):
+        """The record sections of results should be dicts, ready for JSON."""
+        source = [
+            {'id': '1', 'name': 'Goku'},
+            {'id': '2', 'name': 'Gohan'},
+            {'id': '2', 'name': 'Goten'},
+        ]
+        target = [{'id': '1', 'name': 'Kakarot'}, {'id': '3', 'name': 'Vegeta'}]
+
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                _, _, *sections = reconcile_data(
+                    list(normalize_records(source)),
+                    list(normalize_records(target)),
+                    engine=engine,
+                )
+
+                json.dumps(sections)
+                for section in sections:
+                    for entry in section:
+                        self.assertIs(type(entry), dict)
@@ -0,0 +1,418 @@
+import dataclasses
+import datetime
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api import storage
+from api.models import Report, ReportRecord
+from api.reconciliation_engine import reconcile_data
+from api.segments import SegmentSection
+from api.storage import (
+    DatabaseReportStore,
+    InMemoryReportStore,
+    LayeredSection,
+    SegmentReportStore,
+    StoredReport,
+    get_report_store,
+)
+from tests.utils import make_csv_file
+
+REPORT = {
+    'fields': {'id', 'name', 'zeni'},
+    'missing_in_target': [{'id': '2', 'name': 'gohan', 'zeni': '200'}],
+    'missing_in_source': [
+        {'id': '3', 'name': 'goten', 'zeni': '300'},
+        {'id': '4', 'name': 'trunks', 'zeni': None},
+    ],
+    'discrepancies': [
+        {'id': '1', 'differences': {'zeni': {'source': '100', 'target': '150'}}}
+    ],
+}
+
+
+class LayeredSectionTests(TestCase):
+    def test_entries_skip_the_dropped_positions(self):
+        """Layered sections should read like the list they stand for."""
+        base = tuple(range(10))
+        section = LayeredSection(base, [0, 3, 4, 9], ('a', 'b'))
+        expected = [1, 2, 5, 6, 7, 8, 'a', 'b']
+
+        self.assertEqual(len(section), len(expected))
+        self.assertEqual(list(section), expected)
+        for start in range(len(expected)):
+            for stop in range(start, len(expected) + 1):
+                self.assertEqual(section[start:stop], expected[start:stop])
+        self.assertEqual(section[::-3], expected[::-3])
+        self.assertEqual(section[-1], 'b')
+        with self.assertRaises(IndexError):
+            section[8]
+
+
+class InMemoryReportStoreTests(TestCase):
+    def test_save_and_get(self):
+        """Reports should be stored under increasing ids."""
+        store = InMemoryReportStore(reports={})
+
+        self.assertEqual(store.save(REPORT), '1')
+        self.assertEqual(store.save(REPORT), '2')
+        self.assertEqual(store.get('1').discrepancies, tuple(REPORT['discrepancies']))
+        self.assertEqual(store.get('2').id, '2')
+        self.assertIsNone(store.get('3'))
+
+        store.delete('2')
+        self.assertIsNone(store.get('2'))
+        self.assertIsNone(store.summary('2'))
+
+    def test_ids_continue_after_existing_reports(self):
+        """A store opened on existing reports should not reuse their ids."""
+        reports = {
+            report_id: StoredReport.build(report_id, datetime.datetime.now(), REPORT)
+            for report_id in ('1', '7')
+        }
+        store = InMemoryReportStore(reports=reports)
+
+        self.assertEqual(store.save(REPORT), '8')
+        self.assertEqual([summary.id for summary in store.summaries()], ['1', '7', '8'])
+
+    def test_concurrent_saves_never_lose_a_report(self):
+        """Hundreds of parallel saves should all get their own id."""
+        store = InMemoryReportStore(reports={})
+        barrier = threading.Barrier(16)
+
+        def save(i):
+            if i < 16:
+                barrier.wait()
+            return store.save(
+                {**REPORT, 'discrepancies': [{'id': i, 'differences': {}}]}
+            )
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            ids = list(executor.map(save, range(500)))
+
+        self.assertEqual(len(set(ids)), 500)
+        self.assertEqual(len(store.reports), 500)
+        self.assertEqual(
+            sorted(store.reports[i].discrepancies[0]['id'] for i in ids),
+            list(range(500)),
+        )
+
+    @override_settings(RECONCILIATION_REPORT_STORE='api.storage.InMemoryReportStore')
+    def test_concurrent_requests_share_the_store(self):
+        """The store should be built once, even by concurrent first requests."""
+        barrier = threading.Barrier(16)
+
+        def load(_):
+            barrier.wait()
+            return get_report_store()
+
+        with (
+            patch.dict(storage._STORES, clear=True),
+            ThreadPoolExecutor(max_workers=16) as executor,
+        ):
+            stores = list(executor.map(load, range(16)))
+
+        self.assertEqual(len({id(store) for store in stores}), 1)
+
+    @override_settings(RECONCILIATION_REPORT_STORE='api.storage.InMemoryReportStore')
+    def test_concurrent_reconciliations_never_lose_a_report(self):
+        """Parallel reconciliations should each end up with their own report."""
+        store = get_report_store()
+        before = len(store.reports)
+
+        def reconcile(i):
+            report_id, *_ = reconcile_data(
+                [{'id': '1', 'zeni': str(i)}], [{'id': '1', 'zeni': '-1'}]
+            )
+            return report_id
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            ids = list(executor.map(reconcile, range(300)))
+
+        self.assertEqual(len(set(ids)), 300)
+        self.assertEqual(len(store.reports), before + 300)
+        for i, report_id in enumerate(ids):
+            differences = store.get(report_id).discrepancies[0]['differences']
+            self.assertEqual(differences['zeni']['source'], str(i))
+
+    def test_stored_reports_are_immutable(self):
+        """Stored reports should be read-only and share the saved records."""
+        store = InMemoryReportStore(reports={})
+        report = store.get(store.save(REPORT))
+
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            report.discrepancies = ()
+        self.assertIsInstance(report.missing_in_source, tuple)
+        self.assertIs(report.sections()['discrepancies'], report.discrepancies)
+        self.assertIs(report.discrepancies[0], REPORT['discrepancies'][0])
+
+    def test_summaries(self):
+        """summaries should count the records of every section."""
+        store = InMemoryReportStore(reports={})
+        store.save(REPORT)
+
+        (summary,) = store.summaries()
+        self.assertEqual(summary.id, '1')
+        self.assertEqual(
+            summary.counts,
+            {
+                'missing_in_target': 1,
+                'missing_in_source': 2,
+                'discrepancies': 1,
+                'duplicates_in_source': 0,
+                'duplicates_in_target': 0,
+            },
+        )
+        self.assertEqual(summary.fields, {'zeni': 1})
+        self.assertEqual(
+            summary.created_at_display,
+            summary.created_at.strftime('%I:%M %p on %a, %-d %B, %Y'),
+        )
+
+    def test_summaries_are_indexed_when_saved(self):
+        """Reading summaries should not go back to the stored reports."""
+        store = InMemoryReportStore(reports={})
+        report_id = store.save(REPORT)
+        store.reports.clear()
+
+        self.assertEqual(store.summary(report_id).counts['missing_in_source'], 2)
+        self.assertEqual(len(store.summaries()), 1)
+        self.assertIsNone(store.summary('2'))
+
+
+class DatabaseReportStoreTests(TestCase):
+    def test_save_writes_records_in_batches(self):
+        """Every record should be written, in order, with bulk_create batches."""
+        store = DatabaseReportStore(batch_size=2)
+
+        with self.assertNumQueries(5):
+            # savepoint, report, two batches of records, release savepoint
+            report_id = store.save(REPORT)
+
+        self.assertEqual(Report.objects.get(pk=report_id).missing_in_source_count, 2)
+        self.assertEqual(ReportRecord.objects.filter(report_id=report_id).count(), 4)
+
+    def test_get_round_trips_the_report(self):
+        """get should give back the report that was saved."""
+        store = DatabaseReportStore()
+        report = store.get(store.save(REPORT))
+
+        self.assertEqual(report.fields, REPORT['fields'])
+        for section in ('missing_in_target', 'missing_in_source', 'discrepancies'):
+            self.assertEqual(list(getattr(report, section)), REPORT[section])
+        self.assertIsNone(store.get('999'))
+        self.assertIsNone(store.get('not-a-number'))
+
+        store.delete(report.id)
+        self.assertIsNone(store.get(report.id))
+        self.assertFalse(ReportRecord.objects.exists())
+
+    def test_summaries(self):
+        """summaries should come from the report rows alone."""
+        store = DatabaseReportStore()
+        report_id = store.save(REPORT)
+
+        with self.assertNumQueries(1):
+            (summary,) = store.summaries()
+
+        self.assertEqual(summary.id, report_id)
+        self.assertEqual(summary.counts['missing_in_source'], 2)
+        self.assertEqual(summary.fields, {'zeni': 1})
+
+        with self.assertNumQueries(1):
+            self.assertEqual(store.summary(report_id), summary)
+        self.assertIsNone(store.summary('999'))
+        self.assertIsNone(store.summary('not-a-number'))
+
+    def test_pages_are_read_by_position(self):
+        """page should read one slice of a section, not the whole report."""
+        store = DatabaseReportStore()
+        report_id = store.save(REPORT)
+
+        with self.assertNumQueries(2):
+            # the report row, then the slice of its records
+            self.assertEqual(
+                store.page(report_id, 'missing_in_source', 1, 10),
+                REPORT['missing_in_source'][1:],
+            )
+        self.assertEqual(store.page(report_id, 'missing_in_source', 5, 10), [])
+        self.assertIsNone(store.page('999', 'missing_in_source', 0, 10))
+
+        section = store.section(report_id, 'missing_in_source')
+        with self.assertNumQueries(1):
+            self.assertEqual(section[:1], REPORT['missing_in_source'][:1])
+        self.assertEqual(len(section), 2)
+        self.assertEqual(section[-1], REPORT['missing_in_source'][-1])
+
+    @override_settings(RECONCILIATION_REPORT_STORE='api.storage.DatabaseReportStore')
+    def test_reports_api_uses_the_configured_store(self):
+        """The reconciliation endpoints should read and write the database."""
+        self.assertIsInstance(get_report_store(), DatabaseReportStore)
+        client = APIClient()
+        response = client.post(
+            reverse('api:reconciliation-list'),
+            data={
+                'source_file': make_csv_file([{'id': '1', 'zeni': '100'}]),
+                'target_file': make_csv_file([{'id': '1', 'zeni': '150'}]),
+            },
+            format='multipart',
+        )
+        report_id = response.data['id']
+
+        self.assertTrue(Report.objects.filter(pk=report_id).exists())
+        response = client.get(
+            reverse('api:reconciliation-detail', kwargs={'pk': report_id})
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['discrepancies'][0]['id'], '1')
+
+        response = client.get(
+            reverse(
+                'api:reconciliation-section',
+                kwargs={'pk': report_id, 'section': 'discrepancies'},
+            ),
+            {'key_from': '1'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['id'] for entry in response.data['results']], ['1'])
+
+
+class SegmentReportStoreTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(
+            REPORTS_ROOT=directory.name,
+            RECONCILIATION_REPORT_STORE='api.storage.SegmentReportStore',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.directory = directory.name
+
+    def test_get_round_trips_the_report(self):
+        """get should give back the report that was saved, from its segment file."""
+        store = SegmentReportStore()
+        report_id = store.save({**REPORT, 'metrics': {'phases': {}}})
+        report = store.get(report_id)
+
+        self.assertEqual(os.listdir(self.directory), [f'{report_id}.segment'])
+        self.assertEqual(report.fields, REPORT['fields'])
+        self.assertEqual(report.metrics, {'phases': {}})
+        for section in ('missing_in_target', 'missing_in_source', 'discrepancies'):
+            self.assertEqual(list(getattr(report, section)), REPORT[section])
+        self.assertEqual(len(report.duplicates_in_source), 0)
+        self.assertIsNone(store.get('abc123'))
+        self.assertIsNone(store.get('../etc'))
+
+        store.delete(report_id)
+        self.assertIsNone(store.get(report_id))
+        self.assertIsNone(store.summary(report_id))
+
+    def test_metrics_are_saved_next_to_the_segment(self):
+        """Metrics saved after a report should be read back, and deleted with it."""
+        store = SegmentReportStore()
+        report_id = store.save({**REPORT, 'metrics': {'parse': {}}})
+
+        store.save_metrics(report_id, {'parse': {}, 'store': {}})
+
+        self.assertEqual(store.get(report_id).metrics, {'parse': {}, 'store': {}})
+        store.delete(report_id)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_sections_are_read_lazily(self):
+        """Sections should decode entries as they are indexed, not up front."""
+        store = SegmentReportStore()
+        rows = [{'id': str(i), 'zeni': str(i)} for i in range(1000)]
+        report = store.get(store.save({**REPORT, 'missing_in_target': rows}))
+        section = report.missing_in_target
+
+        self.assertIsInstance(section, SegmentSection)
+        self.assertEqual(len(section), 1000)
+        self.assertEqual(section[-1], rows[-1])
+        self.assertEqual(section[10:13], rows[10:13])
+        self.assertEqual(section.tolist(), rows)
+        with self.assertRaises(IndexError):
+            section[1000]
+
+    def test_key_ranges_use_the_key_index(self):
+        """key_range should find the entries of a key range, in section order."""
+        store = SegmentReportStore()
+        rows = [{'id': f'{i:03}', 'zeni': str(i)} for i in reversed(range(100))]
+        report = store.get(store.save({**REPORT, 'missing_in_target': rows}))
+
+        self.assertEqual(
+            list(report.missing_in_target.key_range('010', '012')),
+            [
+                {'id': '012', 'zeni': '12'},
+                {'id': '011', 'zeni': '11'},
+                {'id': '010', 'zeni': '10'},
+            ],
+        )
+        self.assertEqual(len(report.missing_in_target.key_range(key_from='095')), 5)
+        self.assertEqual(len(report.missing_in_target.key_range(key_to='x')), 100)
+        self.assertEqual(len(report.missing_in_target.key_range('a', 'b')), 0)
+        self.assertEqual(
+            [d['id'] for d in report.discrepancies.key_range('1', '1')], ['1']
+        )
+
+    def test_summaries(self):
+        """summaries should come from the segment footers, oldest first."""
+        store = SegmentReportStore()
+        first = store.save(REPORT)
+        second = store.save({**REPORT, 'discrepancies': []})
+
+        summaries = store.summaries()
+
+        self.assertEqual([summary.id for summary in summaries], [first, second])
+        self.assertEqual(summaries[0].counts['missing_in_source'], 2)
+        self.assertEqual(summaries[0].fields, {'zeni': 1})
+        self.assertEqual(summaries[1].counts['discrepancies'], 0)
+        self.assertEqual(store.summary(first), summaries[0])
+
+    def test_reports_api_uses_segments(self):
+        """Pages, key ranges and exports should read through the segment store."""
+        self.assertIsInstance(get_report_store(), SegmentReportStore)
+        client = APIClient()
+        source = [{'id': f'{i:03}', 'zeni': str(i)} for i in range(300)]
+        response = client.post(
+            reverse('api:reconciliation-list'),
+            data={
+                'source_file': make_csv_file(source),
+                'target_file': make_csv_file(source[:1]),
+            },
+            format='multipart',
+        )
+        report_id = response.data['id']
+        url = reverse(
+            'api:reconciliation-section',
+            kwargs={'pk': report_id, 'section': 'missing_in_target'},
+        )
+
+        ids = []
+        response = client.get(url, {'limit': 100})
+        while True:
+            ids += [record['id'] for record in response.data['results']]
+            if response.data['next'] is None:
+                break
+            response = client.get(response.data['next'])
+        self.assertEqual(sorted(ids), [row['id'] for row in source[1:]])
+
+        response = client.get(url, {'key_from': '100', 'key_to': '102'})
+        self.assertEqual(
+            sorted(record['id'] for record in response.data['results']),
+            ['100', '101', '102'],
+        )
+        self.assertIsNone(response.data['next'])
+
+        response = client.get(
+            reverse('api:reconciliation-detail', kwargs={'pk': report_id}),
+            {'output': 'csv'},
+        )
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 300)
@@ -0,0 +1,314 @@
+import io
+import os
+import tempfile
+import threading
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api.jobs import JOBS
+from api.reconciliation_engine import iter_csv
+from api.uploads import ChunkedUpload, UploadError
+from tests.utils import make_csv_file, wait_for
+
+
+def chunks_of(data, chunk_size):
+    return [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(UPLOADS_ROOT=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.data = make_csv_file(
+            [{'id': str(i), 'zeni': str(i * 100)} for i in range(100)]
+        ).getvalue()
+
+    def test_chunks_land_in_any_order(self):
+        """Chunks sent out of order should add up to the uploaded file."""
+        upload = ChunkedUpload.create(len(self.data), chunk_size=100)
+        chunks = chunks_of(self.data, 100)
+
+        for index in reversed(range(len(chunks))):
+            upload.write_chunk(index, io.BytesIO(chunks[index]))
+        upload = ChunkedUpload.get(upload.id)
+        upload.complete()
+
+        self.assertTrue(upload.is_complete)
+        self.assertEqual(upload.missing(), [])
+        with upload.open() as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_interrupted_chunks_are_sent_again(self):
+        """A chunk cut short should not count as received, nor complete the upload."""
+        upload = ChunkedUpload.create(len(self.data), chunk_size=100)
+        chunks = chunks_of(self.data, 100)
+        for index, chunk in enumerate(chunks[:-1]):
+            upload.write_chunk(index, io.BytesIO(chunk))
+
+        with self.assertRaises(UploadError):
+            upload.write_chunk(1, io.BytesIO(chunks[1][:50]))
+        with self.assertRaises(UploadError):
+            upload.write_chunk(2, io.BytesIO(chunks[2] + b'extra'))
+        with self.assertRaises(UploadError):
+            upload.write_chunk(len(chunks), io.BytesIO(b''))
+        self.assertEqual(upload.missing(), [1, 2, len(chunks) - 1])
+        with self.assertRaises(UploadError):
+            upload.complete()
+
+        for index in upload.missing():
+            upload.write_chunk(index, io.BytesIO(chunks[index]))
+        upload.complete()
+        with upload.open() as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_readers_follow_the_chunks_as_they_land(self):
+        """Rows should be parsed while the rest of the upload is still coming."""
+        upload = ChunkedUpload.create(len(self.data), chunk_size=64)
+        chunks = chunks_of(self.data, 64)
+        upload.write_chunk(0, io.BytesIO(chunks[0]))
+        parsed = threading.Event()
+
+        def send_the_rest():
+            parsed.wait(5)
+            for index, chunk in enumerate(chunks[1:], start=1):
+                upload.write_chunk(index, io.BytesIO(chunk))
+
+        sender = threading.Thread(target=send_the_rest)
+        sender.start()
+        self.addCleanup(sender.join)
+
+        with upload.open(timeout=5) as f:
+            rows = iter_csv(f)
+            self.assertEqual(next(rows), {'id': '0', 'zeni': '0'})
+            # The first row was read before the other chunks were sent
+            parsed.set()
+            self.assertEqual(len(list(rows)), 99)
+
+    def test_readers_time_out(self):
+        """Waiting for a chunk that never comes should fail, not hang."""
+        upload = ChunkedUpload.create(len(self.data), chunk_size=100)
+
+        with upload.open(timeout=0.1) as f, self.assertRaises(UploadError):
+            f.read()
+
+    def test_readers_stop_when_the_upload_is_deleted(self):
+        """A reader waiting on a deleted upload should fail, not wait it out."""
+        upload = ChunkedUpload.create(len(self.data), chunk_size=100)
+
+        with upload.open(timeout=60) as f:
+            upload.delete()
+            with self.assertRaises(UploadError):
+                f.read()
+
+    def test_abandoned_uploads_expire(self):
+        """Uploads left incomplete for too long should be deleted."""
+        abandoned = ChunkedUpload.create(len(self.data), chunk_size=100)
+        recent = ChunkedUpload.create(len(self.data), chunk_size=100)
+        completed = ChunkedUpload.create(10, chunk_size=100)
+        completed.write_chunk(0, io.BytesIO(self.data[:10]))
+        completed.complete()
+        for upload in (abandoned, completed):
+            os.utime(upload._chunks_path, (0, 0))
+        os.utime(abandoned.directory, (0, 0))
+
+        self.assertEqual(ChunkedUpload.expire(max_age=3600), [abandoned.id])
+        self.assertIsNone(ChunkedUpload.get(abandoned.id))
+        self.assertIsNotNone(ChunkedUpload.get(recent.id))
+        self.assertIsNotNone(ChunkedUpload.get(completed.id))
+
+    def test_unused_completed_uploads_expire(self):
+        """Completed uploads left unread for too long should be deleted."""
+        unused, used = (ChunkedUpload.create(10, chunk_size=100) for _ in range(2))
+        for upload in (unused, used):
+            upload.write_chunk(0, io.BytesIO(self.data[:10]))
+            upload.complete()
+            os.utime(upload._chunks_path, (0, 0))
+            os.utime(upload.directory, (0, 0))
+        used.open().close()
+
+        self.assertEqual(ChunkedUpload.expire(max_age=3600), [unused.id])
+        self.assertIsNone(ChunkedUpload.get(unused.id))
+        self.assertIsNotNone(ChunkedUpload.get(used.id))
+
+
+class UploadEndpointTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Tiny chunks, so that small files make many of them
+        settings = override_settings(
+            UPLOADS_ROOT=directory.name,
+            JOBS_ROOT=os.path.join(directory.name, 'jobs'),
+            RECONCILIATION_UPLOAD_MIN_CHUNK_SIZE=1,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.client = APIClient()
+        self.url = reverse('api:reconciliation-list')
+        self.source = make_csv_file(
+            [{'id': str(i), 'zeni': str(i * 100)} for i in range(50)]
+        ).getvalue()
+        self.target = make_csv_file(
+            [{'id': str(i), 'zeni': str(i * 100 + (i == 7))} for i in range(1, 50)]
+        ).getvalue()
+
+    def start(self, data, chunk_size=128):
+        response = self.client.post(
+            reverse('api:reconciliation-uploads'),
+            {'size': len(data), 'chunk_size': chunk_size},
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        return response.data
+
+    def put(self, upload, index, chunk):
+        return self.client.generic(
+            'PUT',
+            f'{upload["upload_url"]}{index}/',
+            chunk,
+            content_type='application/octet-stream',
+        )
+
+    def send(self, data, chunk_size=128):
+        upload = self.start(data, chunk_size)
+        for index, chunk in enumerate(chunks_of(data, chunk_size)):
+            self.assertEqual(self.put(upload, index, chunk).status_code, 200)
+        response = self.client.post(f'{upload["upload_url"]}complete/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return upload
+
+    def test_uploads_resume(self):
+        """Clients should find out which chunks are missing and send just those."""
+        upload = self.start(self.source)
+        chunks = chunks_of(self.source, 128)
+        self.put(upload, 0, chunks[0])
+        response = self.put(upload, 1, chunks[1][:10])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(f'{upload["upload_url"]}complete/')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        response = self.client.get(upload['upload_url'])
+        self.assertEqual(response.data['missing'], [[1, len(chunks) - 1]])
+        self.assertEqual(response.data['missing_count'], len(chunks) - 1)
+        for first, last in response.data['missing']:
+            for index in range(first, last + 1):
+                self.put(upload, index, chunks[index])
+        response = self.client.post(f'{upload["upload_url"]}complete/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['complete'])
+
+    def test_upload_sizes_are_bounded(self):
+        """Uploads too large, or cut in chunks too small, should be refused."""
+        url = reverse('api:reconciliation-uploads')
+
+        with self.settings(
+            RECONCILIATION_UPLOAD_MAX_SIZE=1000,
+            RECONCILIATION_UPLOAD_MIN_CHUNK_SIZE=100,
+        ):
+            for data, field in (
+                ({'size': 1001}, 'size'),
+                ({'size': 1000, 'chunk_size': 99}, 'chunk_size'),
+            ):
+                with self.subTest(data=data):
+                    response = self.client.post(url, data, format='json')
+
+                    self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                    self.assertIn(field, response.data)
+
+            response = self.client.post(
+                url, {'size': 1000, 'chunk_size': 300}, format='json'
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.data['missing'], [[0, 3]])
+
+    def test_missing_chunks_are_ranges(self):
+        """Missing chunks should be reported as ranges, not one by one."""
+        upload = self.start(self.source, chunk_size=64)
+        chunks = chunks_of(self.source, 64)
+        for index in (0, 1, 3):
+            self.put(upload, index, chunks[index])
+
+        response = self.put(upload, 4, chunks[4])
+
+        self.assertEqual(response.data['missing'], [[2, 2], [5, len(chunks) - 1]])
+
+    def test_reconcile_uploads(self):
+        """Completed uploads should reconcile like files, and be used up."""
+        source = self.send(self.source)
+        target = self.send(self.target)
+
+        response = self.client.post(
+            self.url,
+            {'source_upload': source['id'], 'target_upload': target['id']},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['missing_in_target'], [{'id': '0', 'zeni': '0'}])
+        self.assertEqual(response.data['discrepancies'][0]['id'], '7')
+        self.assertIsNone(ChunkedUpload.get(source['id']))
+
+    def test_jobs_start_before_the_uploads_complete(self):
+        """Jobs should read uploads as their chunks land."""
+        source = self.start(self.source)
+        target = self.send(self.target)
+
+        response = self.client.post(
+            self.url,
+            {
+                'source_upload': source['id'],
+                'target_upload': target['id'],
+                'asynchronous': True,
+                'partitioned': True,
+            },
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = JOBS[response.data['job_id']]
+
+        for index, chunk in enumerate(chunks_of(self.source, 128)):
+            self.put(source, index, chunk)
+        wait_for(job, timeout=30)
+
+        self.assertEqual(job.status, 'completed', job.error)
+        self.assertEqual(job.progress.counters['discrepancies'], 1)
+        self.assertFalse(os.path.exists(ChunkedUpload.path_for(source['id'])))
+
+    def test_invalid_uploads_are_refused(self):
+        """Unknown uploads, incomplete uploads and missing inputs give a 400."""
+        source = self.start(self.source)
+        target = self.send(self.target)
+
+        for data, field in (
+            (
+                {'source_upload': 'abc123', 'target_upload': target['id']},
+                'source_upload',
+            ),
+            (
+                {'source_upload': source['id'], 'target_upload': target['id']},
+                'source_upload',
+            ),
+            ({'target_upload': target['id']}, 'source_file'),
+        ):
+            with self.subTest(data=data):
+                response = self.client.post(self.url, data, format='json')
+
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(field, response.data)
+
+        response = self.client.get(
+            reverse('api:reconciliation-upload', kwargs={'upload_id': 'abc123'})
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
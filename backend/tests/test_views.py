@@ -1,9 +1,15 @@
-from django.test import TestCase
+import dataclasses
+import os
+import tempfile
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from tests.utils import make_csv_file
+from api.storage import get_report_store
+from tests.utils import make_csv_file, wait_for
 
 RECONCILIATION_LIST_URL = reverse('api:reconciliation-list')
 
@@ -35,6 +41,7 @@ class ReconciliationTest(TestCase):
         self.assertEqual(len(response.data['missing_in_target']), 0)
         self.assertEqual(len(response.data['missing_in_source']), 0)
         self.assertEqual(len(response.data['discrepancies']), 0)
+        self.assertEqual(response.data['normalization_cache']['hits'], 4)
 
     def test_reconciliation_partial_mismatch(self):
         """
@@ -70,3 +77,489 @@ class ReconciliationTest(TestCase):
             discrepancy = data['discrepancies'][0]
             self.assertEqual(discrepancy['id'], '1')
             self.assertIn('name', discrepancy['differences'])
+
+    def test_reconciliation_with_columnar_engine(self):
+        """
+        The columnar engine can be picked per request and gives the same results.
+        """
+        source_rows = [
+            {'id': '1', 'name': 'Goku', 'zeni': '100'},
+            {'id': '2', 'name': 'Gohan', 'zeni': '200'},
+        ]
+        target_rows = [{'id': '1', 'name': 'Goku', 'zeni': '150'}]
+
+        response = self.client.post(
+            self.url,
+            data={
+                'source_file': make_csv_file(source_rows),
+                'target_file': make_csv_file(target_rows),
+                'engine': 'columnar',
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['missing_in_target']), 1)
+        self.assertEqual(
+            response.data['discrepancies'],
+            [{'id': '1', 'differences': {'zeni': {'source': '100', 'target': '150'}}}],
+        )
+
+    def test_reconciliation_with_sort_merge_engine(self):
+        """
+        The sort-merge engine re-reads the uploads instead of indexing them.
+        """
+        source_rows = [
+            {'id': '2', 'name': 'Gohan', 'zeni': '200'},
+            {'id': '1', 'name': 'Goku', 'zeni': '100'},
+        ]
+        target_rows = [
+            {'id': '1', 'name': 'Goku', 'zeni': '150'},
+            {'id': '3', 'name': 'Goten', 'zeni': '300'},
+        ]
+
+        response = self.client.post(
+            self.url,
+            data={
+                'source_file': make_csv_file(source_rows),
+                'target_file': make_csv_file(target_rows),
+                'engine': 'sort_merge',
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['missing_in_target'][0]['id'], '2')
+        self.assertEqual(response.data['missing_in_source'][0]['id'], '3')
+        self.assertEqual(
+            response.data['discrepancies'],
+            [{'id': '1', 'differences': {'zeni': {'source': '100', 'target': '150'}}}],
+        )
+
+    def test_reconciliation_partitioned(self):
+        """
+        Partitioned reconciliations run in worker processes with the same results.
+        """
+        source_rows = [
+            {'id': '1', 'name': 'Goku', 'zeni': '100'},
+            {'id': '2', 'name': 'Gohan', 'zeni': '200'},
+        ]
+        target_rows = [{'id': '1', 'name': 'Goku', 'zeni': '150'}]
+
+        response = self.client.post(
+            self.url,
+            data={
+                'source_file': make_csv_file(source_rows),
+                'target_file': make_csv_file(target_rows),
+                'partitioned': True,
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['missing_in_target'][0]['id'], '2')
+        self.assertEqual(len(response.data['discrepancies']), 1)
+
+    def test_reconciliation_asynchronous_job(self):
+        """
+        Asynchronous reconciliations return 202 with a job that can be polled.
+        """
+        source_rows = [
+            {'id': '1', 'name': 'Goku', 'zeni': '100'},
+            {'id': '2', 'name': 'Gohan', 'zeni': '200'},
+        ]
+        target_rows = [{'id': '1', 'name': 'Goku', 'zeni': '150'}]
+
+        with (
+            tempfile.TemporaryDirectory() as uploads,
+            override_settings(
+                UPLOADS_ROOT=uploads, JOBS_ROOT=os.path.join(uploads, 'jobs')
+            ),
+        ):
+            response = self.client.post(
+                self.url,
+                data={
+                    'source_file': make_csv_file(source_rows),
+                    'target_file': make_csv_file(target_rows),
+                    'asynchronous': True,
+                },
+                format='multipart',
+            )
+
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            wait_for(response.data['job_id'])
+            response = self.client.get(response.data['status_url'])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'completed')
+        self.assertEqual(response.data['phase'], 'done')
+        self.assertEqual(response.data['counters']['source_rows'], 2)
+        self.assertEqual(response.data['counters']['discrepancies'], 1)
+        self.assertTrue(response.data['report_url'].endswith('?output=html'))
+
+    def test_reconciliation_job_not_found(self):
+        """
+        Polling an unknown job gives a 404.
+        """
+        response = self.client.get(
+            reverse('api:reconciliation-job', kwargs={'job_id': 'nope'})
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_reconciliation_streams_csv(self):
+        """
+        CSV output is streamed with one column per field.
+        """
+        source_rows = [
+            {'id': '1', 'name': 'Goku', 'zeni': '100'},
+            {'id': '2', 'name': 'Gohan', 'zeni': '200'},
+        ]
+        target_rows = [{'id': '1', 'name': 'Goku', 'zeni': '150'}]
+
+        response = self.client.post(
+            self.url,
+            data={
+                'source_file': make_csv_file(source_rows),
+                'target_file': make_csv_file(target_rows),
+                'output_format': 'csv',
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            b''.join(response.streaming_content).decode().splitlines(),
+            [
+                'section,key,field,source,target,id,name,zeni',
+                'missing_in_target,2,,,,2,gohan,200',
+                'discrepancy,1,zeni,100,150',
+            ],
+        )
+
+    def test_reconciliation_with_composite_key(self):
+        """
+        Records are matched on the requested columns and duplicates are reported.
+        """
+        source_rows = [
+            {'account': 'A1', 'reference': 'INV-001', 'zeni': '100'},
+            {'account': 'A1', 'reference': 'INV-002', 'zeni': '200'},
+            {'account': 'A2', 'reference': 'INV-001', 'zeni': '300'},
+            {'account': 'A2', 'reference': 'INV 001', 'zeni': '300'},
+        ]
+        target_rows = [
+            {'account': 'A1', 'reference': 'inv001', 'zeni': '100'},
+            {'account': 'A1', 'reference': 'INV002', 'zeni': '250'},
+            {'account': 'A2', 'reference': 'INV/001', 'zeni': '300'},
+        ]
+
+        response = self.client.post(
+            self.url,
+            data={
+                'source_file': make_csv_file(source_rows),
+                'target_file': make_csv_file(target_rows),
+                'key': 'account, reference:alnum',
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['key'], 'account,reference:alnum')
+        # References match once transformed, the raw values still differ
+        discrepancies = {
+            discrepancy['id']: discrepancy['differences']
+            for discrepancy in response.data['discrepancies']
+        }
+        self.assertCountEqual(
+            discrepancies, [('a1', 'inv002'), ('a2', 'inv001'), ('a1', 'inv001')]
+        )
+        self.assertEqual(
+            discrepancies[('a1', 'inv002')]['zeni'], {'source': '200', 'target': '250'}
+        )
+        self.assertEqual(
+            response.data['duplicates_in_source'],
+            [{'account': 'a2', 'reference': 'inv-001', 'zeni': '300'}],
+        )
+        self.assertEqual(response.data['missing_in_target'], [])
+
+        report_url = reverse(
+            'api:reconciliation-section',
+            kwargs={'pk': response.data['id'], 'section': 'discrepancies'},
+        )
+        response = self.client.get(report_url, {'key_from': 'a1|inv002'})
+        self.assertCountEqual(
+            [tuple(result['id']) for result in response.data['results']],
+            [('a1', 'inv002'), ('a2', 'inv001')],
+        )
+
+    def test_reconciliation_with_tolerances_and_fuzzy_linking(self):
+        """
+        Values within tolerance match, and keys split by a typo are linked, with or
+        without partitioning.
+        """
+        source_rows = [
+            {'id': 'inv-1001', 'amount': '100.00', 'date': '2025-01-01'},
+            {'id': 'inv-2002', 'amount': '200', 'date': '2025-02-01'},
+        ]
+        target_rows = [
+            {'id': 'inv-1001', 'amount': '1e2', 'date': '2025-01-02'},
+            {'id': 'inv-20002', 'amount': '200.00', 'date': '2025-02-01'},
+        ]
+
+        for partitioned in (False, True):
+            with self.subTest(partitioned=partitioned):
+                response = self.client.post(
+                    self.url,
+                    data={
+                        'source_file': make_csv_file(source_rows),
+                        'target_file': make_csv_file(target_rows),
+                        'compare': 'amount:numeric=0.01, date:date=1',
+                        'fuzzy': 0.8,
+                        'partitioned': partitioned,
+                    },
+                    format='multipart',
+                )
+
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['missing_in_target'], [])
+                self.assertEqual(response.data['missing_in_source'], [])
+                self.assertEqual(
+                    response.data['discrepancies'],
+                    [
+                        {
+                            'id': 'inv-2002',
+                            'differences': {
+                                'id': {'source': 'inv-2002', 'target': 'inv-20002'}
+                            },
+                            'match': 'fuzzy',
+                        }
+                    ],
+                )
+
+    def test_reconciliation_rejects_invalid_comparisons(self):
+        """
+        Unknown comparators and out of range fuzzy thresholds are validation errors.
+        """
+        response = self.client.post(
+            self.url,
+            data={
+                'source_file': make_csv_file([{'id': '1'}]),
+                'target_file': make_csv_file([{'id': '1'}]),
+                'compare': 'amount:approximately',
+                'fuzzy': 2,
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('compare', response.data)
+        self.assertIn('fuzzy', response.data)
+
+        for compare in ('value_date:date=inf', 'value_date:date=-1'):
+            response = self.client.post(
+                self.url,
+                data={
+                    'source_file': make_csv_file([{'id': '1'}]),
+                    'target_file': make_csv_file([{'id': '1'}]),
+                    'compare': compare,
+                },
+                format='multipart',
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('compare', response.data)
+
+    def test_reconciliation_rejects_invalid_keys(self):
+        """
+        Unknown key transforms are a validation error.
+        """
+        response = self.client.post(
+            self.url,
+            data={
+                'source_file': make_csv_file([{'id': '1'}]),
+                'target_file': make_csv_file([{'id': '1'}]),
+                'key': 'id:soundex',
+            },
+            format='multipart',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('key', response.data)
+
+
+class ReconciliationReportSectionsTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        source_rows = [
+            {'id': str(i), 'name': f'Saiyan {i}', 'zeni': str(i * 100)}
+            for i in range(10, 30)
+        ]
+        target_rows = [
+            {
+                'id': str(i),
+                'name': f'Saiyan {i}' if i % 2 else 'Frieza',
+                'zeni': str(i * 100 + i % 3),
+            }
+            for i in range(10, 25)
+        ]
+        response = self.client.post(
+            RECONCILIATION_LIST_URL,
+            data={
+                'source_file': make_csv_file(source_rows),
+                'target_file': make_csv_file(target_rows),
+                'engine': 'sort_merge',
+            },
+            format='multipart',
+        )
+        self.report_id = response.data['id']
+
+    def section_url(self, section):
+        return reverse(
+            'api:reconciliation-section',
+            kwargs={'pk': self.report_id, 'section': section},
+        )
+
+    def test_section_pages_follow_the_cursor(self):
+        """
+        Following `next` should walk through the whole section without overlaps.
+        """
+        url = self.section_url('discrepancies') + '?limit=4'
+        keys = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 4)
+            keys += [discrepancy['id'] for discrepancy in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(keys, [str(i) for i in range(10, 25) if i % 2 == 0 or i % 3])
+
+    def test_section_filters_by_field_and_key_range(self):
+        """
+        `field` and `key_from`/`key_to` should narrow down the section.
+        """
+        response = self.client.get(
+            self.section_url('discrepancies'),
+            {'field': 'name', 'key_from': '12', 'key_to': '18'},
+        )
+
+        self.assertEqual(
+            [discrepancy['id'] for discrepancy in response.data['results']],
+            ['12', '14', '16', '18'],
+        )
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(
+            self.section_url('missing_in_target'), {'key_from': '28'}
+        )
+        self.assertEqual(
+            [record['id'] for record in response.data['results']], ['28', '29']
+        )
+
+    def test_section_rejects_invalid_cursors(self):
+        """
+        A cursor that was not handed out by the API should give a 404.
+        """
+        response = self.client.get(
+            self.section_url('discrepancies'), {'cursor': 'not-a-cursor'}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_summary_returns_counts_and_field_histogram(self):
+        """
+        The summary should only hold counts and per-field discrepancy counts.
+        """
+        response = self.client.get(
+            reverse('api:reconciliation-summary', kwargs={'pk': self.report_id})
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data['counts'],
+            {
+                'missing_in_target': 5,
+                'missing_in_source': 0,
+                'discrepancies': 13,
+                'duplicates_in_source': 0,
+                'duplicates_in_target': 0,
+            },
+        )
+        self.assertEqual(response.data['fields'], {'zeni': 10, 'name': 8})
+
+    def test_html_report_renders_the_summary_and_pages_in_sections(self):
+        """
+        The HTML report should hold the counts and section URLs but no records.
+        """
+        response = self.client.get(
+            reverse('api:reconciliation-detail', kwargs={'pk': self.report_id}),
+            {'output': 'html'},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        html = response.content.decode()
+        self.assertIn(f'data-url="{self.section_url("discrepancies")}"', html)
+        self.assertIn('Discrepancies (13)', html)
+        self.assertNotIn('Saiyan 28', html)
+
+    def test_html_report_answers_conditional_requests(self):
+        """
+        Repeat views of a report holding its ETag should get a 304.
+        """
+        url = reverse('api:reconciliation-detail', kwargs={'pk': self.report_id})
+        response = self.client.get(url, {'output': 'html'})
+        etag = response.headers['ETag']
+
+        response = self.client.get(url, {'output': 'html'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(
+            url, {'output': 'html'}, HTTP_IF_NONE_MATCH='"stale"'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_html_etags_follow_the_report_content(self):
+        """
+        Reports sharing an id and a timestamp (from other processes) should not
+        share an ETag, nor a cached page, and creating a report always renders it.
+        """
+        store = get_report_store()
+        summary = store.summary(self.report_id)
+        other = dataclasses.replace(
+            summary, counts={**summary.counts, 'discrepancies': 1}
+        )
+        url = reverse('api:reconciliation-detail', kwargs={'pk': self.report_id})
+        etag = self.client.get(url, {'output': 'html'}).headers['ETag']
+
+        with patch.object(type(store), 'summary', return_value=other):
+            response = self.client.get(url, {'output': 'html'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('Discrepancies (1)', response.content.decode())
+
+        response = self.client.post(
+            reverse('api:reconciliation-list'),
+            {
+                'source_file': make_csv_file([{'id': '1', 'zeni': '1'}]),
+                'target_file': make_csv_file([{'id': '1', 'zeni': '1'}]),
+                'output_format': 'html',
+            },
+            format='multipart',
+            HTTP_IF_NONE_MATCH='*',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_unknown_report_sections_are_not_found(self):
+        """
+        Sections and summaries of unknown reports should give a 404.
+        """
+        self.report_id = '999999'
+
+        response = self.client.get(self.section_url('discrepancies'))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get(
+            reverse('api:reconciliation-summary', kwargs={'pk': self.report_id})
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
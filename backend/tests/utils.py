@@ -1,5 +1,6 @@
 import csv
 import io
+import time
 
 
 def make_csv_file(rows):
@@ -15,3 +16,21 @@ def make_csv_file(rows):
             writer.writerow(row)
     output.seek(0)
     return io.BytesIO(output.getvalue().encode('utf-8'))
+
+
+def wait_for(job, timeout=10):
+    """
+    Block until a background reconciliation job (a `Job`, or the id of one) has
+    finished (or `timeout` passes).
+    """
+    from api.jobs import JOBS, get_job
+
+    def running():
+        if isinstance(job, str):
+            return get_job(job)['status'] in ('queued', 'running')
+        # Submitted jobs are done once they have left JOBS
+        return job.status in ('queued', 'running') or job.id in JOBS
+
+    deadline = time.monotonic() + timeout
+    while running() and time.monotonic() < deadline:
+        time.sleep(0.01)